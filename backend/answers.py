@@ -0,0 +1,63 @@
+"""
+Security answers for Halloween Poe Chat
+Answers are normalized once (case and surrounding whitespace ignored) and
+stored as keyed hashes (keyed BLAKE2b, hex) in users.answer_hashes, one
+fixed-size digest per answer. Checking an attempt hashes the submitted
+answers and compares digests, with no JSON parsing, and the plaintext
+answers are not kept in the users table.
+
+Environment:
+    ANSWER_HASH_KEY   secret for the answer hashes. Required unless DEBUG=true, which
+                      falls back to a fixed (public) development key.
+                      Changing it invalidates every stored answer.
+"""
+import os
+import hmac
+import hashlib
+import logging
+from typing import List
+
+logger = logging.getLogger("answers")
+
+DEVELOPMENT = os.getenv("DEBUG", "false").lower() == "true"
+
+if os.getenv("ANSWER_HASH_KEY"):
+    ANSWER_HASH_KEY = os.environ["ANSWER_HASH_KEY"].encode()
+elif DEVELOPMENT:
+    # Stored hashes must survive restarts, so unlike the token key this cannot be random
+    logger.warning("ANSWER_HASH_KEY not set: hashing answers with the development key")
+    ANSWER_HASH_KEY = b"halloween-poe-chat-development-key"
+else:
+    # The development key is in the source, so anyone with the hashes could test guesses offline
+    raise RuntimeError("ANSWER_HASH_KEY is not set; set it to a secret (or DEBUG=true to use the development key)")
+if len(ANSWER_HASH_KEY) > hashlib.blake2b.MAX_KEY_SIZE:
+    # Longer keys are hashed down, as HMAC does
+    ANSWER_HASH_KEY = hashlib.blake2b(ANSWER_HASH_KEY).digest()
+
+# 128-bit digests, so 32 hex characters per stored answer
+ANSWER_DIGEST_SIZE = 16
+ANSWER_DIGEST_CHARS = ANSWER_DIGEST_SIZE * 2
+
+# BLAKE2b's keyed mode is a MAC in one pass (cheaper than HMAC); keyed once, copied per answer
+_keyed = hashlib.blake2b(key=ANSWER_HASH_KEY, digest_size=ANSWER_DIGEST_SIZE)
+
+def normalize_answer(answer: str) -> str:
+    return answer.lower().strip()
+
+def hash_answer(answer: str) -> str:
+    digest = _keyed.copy()
+    digest.update(normalize_answer(answer).encode("utf-8"))
+    return digest.hexdigest()
+
+def hash_answers(answers: List[str]) -> str:
+    """The users.answer_hashes value for a list of answers"""
+    return "".join(hash_answer(answer) for answer in answers)
+
+def count_matching_answers(stored_hashes: str, answers: List[str]) -> int:
+    """Count answers whose hash matches the stored one in the same position"""
+    correct = 0
+    for i, answer in enumerate(answers[:len(stored_hashes) // ANSWER_DIGEST_CHARS]):
+        start = i * ANSWER_DIGEST_CHARS
+        if hmac.compare_digest(stored_hashes[start:start + ANSWER_DIGEST_CHARS], hash_answer(answer)):
+            correct += 1
+    return correct
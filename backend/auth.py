@@ -0,0 +1,116 @@
+"""
+Signed session tokens for Halloween Poe Chat
+POST /login returns a JWT (HS256, python-jose) carrying the user id,
+username and the version of the key that signed it. Endpoints and the
+websocket identify the caller by checking the signature, which is pure
+CPU work, instead of looking the user up by a client-supplied username.
+
+Keys are versioned so they can be rotated: new tokens are signed with the
+first key, tokens signed with any listed key still verify, and dropping a
+version from the list revokes every token signed with it.
+
+Environment:
+    AUTH_SECRET_KEYS        "version:secret" pairs, current key first, e.g. "2:new,1:old"
+                            (default: a random key per process, tokens do not survive restarts
+                            and only verify in the process that issued them, so serve.py
+                            refuses more than one worker without it)
+    AUTH_TOKEN_TTL_MINUTES  token lifetime (default 1440)
+    AUTH_REQUIRED           reject callers without a token instead of trusting usernames (default False)
+"""
+import os
+import time
+import logging
+import secrets
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from jose import jwt, JWTError
+
+logger = logging.getLogger("auth")
+
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL_MINUTES", "1440")) * 60
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "false").lower() == "true"
+ALGORITHM = "HS256"
+# Verified tokens remembered per process, so repeat requests skip the HMAC
+VERIFIED_TOKEN_CACHE_SIZE = 4096
+
+class AuthError(Exception):
+    pass
+
+class TokenClaims:
+    """Identity carried by a verified token"""
+
+    __slots__ = ("user_id", "username", "key_version", "expires_at")
+
+    def __init__(self, user_id: int, username: str, key_version: int, expires_at: int):
+        self.user_id = user_id
+        self.username = username
+        self.key_version = key_version
+        self.expires_at = expires_at
+
+def parse_keys(value: str) -> Tuple[int, Dict[int, str]]:
+    """Current key version and {version: secret} from "version:secret,..." """
+    keys = {}
+    current = None
+    for entry in value.split(","):
+        version, _, secret = entry.strip().partition(":")
+        if not secret:
+            raise ValueError("AUTH_SECRET_KEYS entries must look like 'version:secret'")
+        keys[int(version)] = secret
+        if current is None:
+            current = int(version)
+    return current, keys
+
+if os.getenv("AUTH_SECRET_KEYS"):
+    CURRENT_KEY_VERSION, SECRET_KEYS = parse_keys(os.environ["AUTH_SECRET_KEYS"])
+else:
+    logger.warning("AUTH_SECRET_KEYS not set: using a random signing key for this process")
+    CURRENT_KEY_VERSION, SECRET_KEYS = 1, {1: secrets.token_urlsafe(32)}
+
+def issue_token(user_id: int, username: str, ttl: int = AUTH_TOKEN_TTL) -> str:
+    claims = {
+        "sub": str(user_id),
+        "name": username,
+        "kv": CURRENT_KEY_VERSION,
+        "exp": int(time.time()) + ttl,
+    }
+    return jwt.encode(claims, SECRET_KEYS[CURRENT_KEY_VERSION], algorithm=ALGORITHM,
+                      headers={"kid": str(CURRENT_KEY_VERSION)})
+
+@lru_cache(maxsize=VERIFIED_TOKEN_CACHE_SIZE)
+def check_signature(token: str) -> TokenClaims:
+    try:
+        version = int(jwt.get_unverified_header(token).get("kid"))
+    except (JWTError, TypeError, ValueError):
+        raise AuthError("Malformed token")
+    secret = SECRET_KEYS.get(version)
+    if secret is None:
+        raise AuthError("Token signed with a retired key")
+    try:
+        claims = jwt.decode(token, secret, algorithms=[ALGORITHM])
+        if claims["kv"] != version:
+            raise AuthError("Token key version mismatch")
+        return TokenClaims(int(claims["sub"]), claims["name"], version, claims["exp"])
+    except JWTError as e:
+        raise AuthError(str(e))
+    except (KeyError, TypeError, ValueError):
+        raise AuthError("Token is missing claims")
+
+def verify_token(token: str) -> TokenClaims:
+    """Claims of a valid token, AuthError otherwise. No database access."""
+    claims = check_signature(token)
+    # Cached tokens still expire on time
+    if claims.expires_at <= time.time():
+        raise AuthError("Token has expired")
+    if claims.key_version not in SECRET_KEYS:
+        raise AuthError("Token signed with a retired key")
+    return claims
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """Token from an "Authorization: Bearer <token>" header value"""
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        raise AuthError("Expected a Bearer token")
+    return token.strip()
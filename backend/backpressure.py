@@ -0,0 +1,286 @@
+"""
+Websocket backpressure for Halloween Poe Chat
+Every packet the Socket.IO server sends to a room goes through a bounded
+per-connection queue that is drained only as fast as the client's
+transport takes packets. When a slow client's queue is full, presence
+events are coalesced (latest per user wins) and other packets are dropped
+by policy, so one slow reader cannot grow server memory or hold up a room.
+Inbound, each sender is rate limited (by user, across all of their
+connections to this worker) and oversized payloads rejected.
+
+Room emits are encoded once and handed to each member's queue in a loop
+(FanoutManager), rather than through one asyncio task per recipient, so
+large group rooms cost one encode plus a cheap enqueue per member.
+
+Environment:
+    WS_QUEUE_SIZE          max queued packets per connection (default 256)
+    WS_QUEUE_POLICY        "drop_oldest" (default) or "drop_newest" when a queue is full
+    WS_COALESCE_EVENTS     events where only the latest per user is kept (default "user_joined,user_left")
+    WS_TRANSPORT_WINDOW    packets handed to the transport before waiting for it to drain (default 32)
+    WS_RATE_LIMIT          messages per second per user (default 10, 0 = unlimited)
+    WS_RATE_BURST          burst allowance for the rate limit (default 20)
+    WS_MAX_PAYLOAD         max inbound Engine.IO packet in bytes (default 65536)
+    WS_MAX_MESSAGE_CHARS   max chat message length (default 4000)
+"""
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+from metrics import WS_OUTBOUND_QUEUED, WS_OUTBOUND_QUEUE_DEPTH, WS_DROPPED
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+WS_QUEUE_POLICY = os.getenv("WS_QUEUE_POLICY", "drop_oldest")
+WS_COALESCE_EVENTS = {event.strip() for event in os.getenv("WS_COALESCE_EVENTS", "user_joined,user_left").split(",") if event.strip()}
+WS_TRANSPORT_WINDOW = int(os.getenv("WS_TRANSPORT_WINDOW", "32"))
+WS_RATE_LIMIT = float(os.getenv("WS_RATE_LIMIT", "10"))
+WS_RATE_BURST = int(os.getenv("WS_RATE_BURST", "20"))
+WS_MAX_PAYLOAD = int(os.getenv("WS_MAX_PAYLOAD", "65536"))
+WS_MAX_MESSAGE_CHARS = int(os.getenv("WS_MAX_MESSAGE_CHARS", "4000"))
+
+# How long the drain task waits on a stalled transport before re-checking the connection
+DRAIN_POLL_SECONDS = 1.0
+
+def packet_header(eio_pkt) -> Tuple[Optional[str], int]:
+    """Event name and number of binary attachments of an encoded Socket.IO packet"""
+    data = eio_pkt.data
+    if not isinstance(data, str) or not data:
+        return None, 0
+    attachments = 0
+    if data[0] == "5":  # binary event: 5<attachments>-[...]
+        dash = data.find("-")
+        if dash > 1 and data[1:dash].isdigit():
+            attachments = int(data[1:dash])
+    bracket = data.find("[")
+    if bracket < 0 or not data.startswith('"', bracket + 1):
+        return None, attachments
+    end = data.find('"', bracket + 2)
+    return (data[bracket + 2:end] if end > 0 else None), attachments
+
+def cached_header(eio_pkt) -> Tuple[Optional[str], int]:
+    """packet_header, parsed once per packet: a room emit hands the same packet to every member"""
+    header = eio_pkt.__dict__.get("bp_header")
+    if header is None:
+        header = eio_pkt.bp_header = packet_header(eio_pkt)
+    return header
+
+def coalesce_key(event: Optional[str], eio_pkt) -> Optional[Tuple]:
+    """(event, username) for presence events, None for everything else"""
+    if event not in WS_COALESCE_EVENTS:
+        return None
+    try:
+        _, payload = json.loads(eio_pkt.data[eio_pkt.data.index("["):])[:2]
+        return (event, payload.get("username"))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+class OutboundQueue:
+    """Bounded send queue for one connection"""
+
+    def __init__(self, eio, eio_sid: str, maxsize: int = WS_QUEUE_SIZE,
+                 policy: str = WS_QUEUE_POLICY, window: int = WS_TRANSPORT_WINDOW):
+        self.eio = eio
+        self.eio_sid = eio_sid
+        self.maxsize = maxsize
+        self.policy = policy
+        self.window = window
+        self.groups: deque = deque()  # (coalesce key, [packets]) waiting for the transport
+        self.partial: Optional[List] = None  # binary packet still collecting attachments
+        self.attachments_expected = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    def transport_queue(self):
+        socket = self.eio.sockets.get(self.eio_sid)
+        return socket.queue if socket is not None else None
+
+    def transport_ready(self) -> bool:
+        queue = self.transport_queue()
+        return queue is None or queue.qsize() < self.window
+
+    async def send(self, eio_pkt):
+        # A binary event is a header plus attachment packets; queue and drop them together
+        if self.attachments_expected:
+            self.partial.append(eio_pkt)
+            self.attachments_expected -= 1
+            if self.attachments_expected:
+                return
+            group, self.partial = self.partial, None
+            event, _ = cached_header(group[0])
+        else:
+            event, attachments = cached_header(eio_pkt)
+            group = [eio_pkt]
+            if attachments:
+                self.partial, self.attachments_expected = group, attachments
+                return
+
+        if not self.groups and self.transport_ready():
+            for part in group:
+                await self.eio.send_packet(self.eio_sid, part)
+            return
+        self.enqueue(coalesce_key(event, group[0]), group)
+
+    def enqueue(self, key: Optional[Tuple], group: List):
+        if key is not None:
+            for index, (queued_key, _) in enumerate(self.groups):
+                if queued_key == key:
+                    self.groups[index] = (key, group)
+                    WS_DROPPED.inc(reason="coalesced")
+                    return
+
+        if len(self.groups) >= self.maxsize:
+            WS_DROPPED.inc(reason="queue_full")
+            if self.policy == "drop_newest":
+                return
+            self.groups.popleft()
+            WS_OUTBOUND_QUEUED.dec()
+
+        self.groups.append((key, group))
+        WS_OUTBOUND_QUEUED.inc()
+        WS_OUTBOUND_QUEUE_DEPTH.observe(len(self.groups))
+        if self.task is None:
+            self.task = asyncio.create_task(self.drain())
+
+    async def drain(self):
+        try:
+            while self.groups:
+                queue = self.transport_queue()
+                if queue is None:
+                    break
+                if queue.qsize() >= self.window:
+                    try:
+                        await asyncio.wait_for(queue.join(), DRAIN_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                _, group = self.groups.popleft()
+                WS_OUTBOUND_QUEUED.dec()
+                for eio_pkt in group:
+                    await self.eio.send_packet(self.eio_sid, eio_pkt)
+        finally:
+            self.task = None
+            self.clear()
+
+    def clear(self):
+        if self.groups:
+            WS_OUTBOUND_QUEUED.dec(len(self.groups))
+            self.groups.clear()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.clear()
+
+class BackpressureServer(socketio.AsyncServer):
+    """AsyncServer whose event packets go through per-connection OutboundQueues
+
+    The client manager sends every room and broadcast packet through
+    _send_eio_packet, once per recipient, which is the hook used here.
+
+    _send_eio_packet and _handle_eio_disconnect are private AsyncServer
+    methods; the overrides follow their python-socketio 5.12 signatures
+    (disconnect gained its `reason` argument in 5.12.0), which is why
+    requirements.txt pins python-socketio>=5.12.0. Check both when
+    upgrading.
+    """
+
+    def __init__(self, *args, queue_size: int = WS_QUEUE_SIZE, queue_policy: str = WS_QUEUE_POLICY, **kwargs):
+        kwargs.setdefault("max_http_buffer_size", WS_MAX_PAYLOAD)
+        super().__init__(*args, **kwargs)
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.outbound: Dict[str, OutboundQueue] = {}
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        queue = self.outbound.get(eio_sid)
+        if queue is None:
+            queue = self.outbound[eio_sid] = OutboundQueue(self.eio, eio_sid, self.queue_size, self.queue_policy)
+        await queue.send(eio_pkt)
+
+    async def _handle_eio_disconnect(self, eio_sid, reason):
+        queue = self.outbound.pop(eio_sid, None)
+        if queue is not None:
+            queue.close()
+        await super()._handle_eio_disconnect(eio_sid, reason)
+
+class FanoutManager(socketio.AsyncManager):
+    """AsyncManager whose room emits encode the packet once and enqueue it per member inline
+
+    OutboundQueue.send never waits on a slow client (it queues or drops), so
+    recipients can be served in a loop without a task each. Emits with an
+    ack callback need a packet per recipient and use the default path.
+    """
+
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if callback or namespace not in self.rooms:
+            return await super().emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                                      callback=callback, **kwargs)
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        skip = set(skip_sid) if isinstance(skip_sid, list) else {skip_sid}
+        # Snapshot the room: members can leave while packets are being queued
+        recipients = [eio_sid for sid, eio_sid in self.get_participants(namespace, room) if sid not in skip]
+        if not recipients:
+            return
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        eio_pkts = [eio_packet.Packet(eio_packet.MESSAGE, part) for part in encoded]
+        for eio_sid in recipients:
+            try:
+                for eio_pkt in eio_pkts:
+                    await self.server._send_eio_packet(eio_sid, eio_pkt)
+            except Exception:
+                self.server.logger.exception("Room emit to %s failed", eio_sid)
+
+class RedisFanoutManager(socketio.AsyncRedisManager, FanoutManager):
+    """Redis-backed manager; each worker delivers to its own members through FanoutManager.emit"""
+
+class RateLimiter:
+    """Token bucket per key: `rate` events per second, bursts up to `burst`"""
+
+    def __init__(self, rate: float = WS_RATE_LIMIT, burst: int = WS_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[Hashable, List[float]] = {}  # key -> [tokens, last refill]
+
+    def allow(self, key: Hashable) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now]
+        else:
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1.0:
+            return False
+        bucket[0] -= 1.0
+        return True
+
+    def forget(self, key: Hashable):
+        self.buckets.pop(key, None)
+
+    def prune(self):
+        """Drop buckets that have refilled completely: they hold nothing a new bucket would not"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        full = [key for key, (tokens, refilled) in self.buckets.items()
+                if tokens + (now - refilled) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
@@ -0,0 +1,108 @@
+"""
+Compact Socket.IO framing for Halloween Poe Chat
+Opt-in binary protocol for chat messages. A client selects it with
+`auth={"protocol": "compact"}` (or `?protocol=compact`) when connecting;
+everyone else keeps the JSON `message` events.
+
+Compact clients send `message_compact` with a msgpack array
+
+    [room_id, client_message_id, timestamp_ms, text]
+
+and receive `frames` events, each a msgpack array of one or more messages
+delivered to a room within the same tick:
+
+    [[room_id, sender_id, client_message_id, timestamp_ms, text, seq], ...]
+
+room_id is the connection id and sender_id the user id; the `join_chat`
+acknowledgement maps both to names. Timestamps are epoch milliseconds and
+seq is the message's per-connection sequence number (see message_log.py).
+
+Environment:
+    WS_FRAME_TICK_MS  how long messages are collected per room before a frame is sent (default 5)
+"""
+import os
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import msgpack
+
+from metrics import WS_COMPACT_FRAMES, WS_COMPACT_BYTES
+
+WS_FRAME_TICK = float(os.getenv("WS_FRAME_TICK_MS", "5")) / 1000.0
+
+PROTOCOL_COMPACT = "compact"
+
+def wants_compact(environ: Dict, auth: Optional[Dict]) -> bool:
+    if isinstance(auth, dict) and auth.get("protocol") == PROTOCOL_COMPACT:
+        return True
+    return f"protocol={PROTOCOL_COMPACT}" in environ.get("QUERY_STRING", "")
+
+def epoch_ms(value) -> int:
+    """Epoch milliseconds from an ISO string or epoch number (now if missing or invalid)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Seconds (e.g. time.time()) are far below any millisecond timestamp
+        return int(value * 1000) if value < 1e11 else int(value)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return int(parsed.timestamp() * 1000)
+        except ValueError:
+            pass
+    return int(time.time() * 1000)
+
+def iso_timestamp(ms: int) -> str:
+    """ISO-8601 form of an epoch-millisecond timestamp, for JSON clients"""
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def decode_message(payload: bytes) -> Optional[List]:
+    """[room_id, client_message_id, timestamp_ms, text] or None if malformed"""
+    try:
+        message = msgpack.unpackb(payload)
+    except Exception:
+        return None
+    if (not isinstance(message, list) or len(message) != 4
+            or not isinstance(message[0], int) or not isinstance(message[3], str) or not message[3]):
+        return None
+    return message
+
+def encode_frame(records: List[List]) -> bytes:
+    return msgpack.packb(records)
+
+def decode_frame(frame: bytes) -> List[List]:
+    return msgpack.unpackb(frame)
+
+class FrameBatcher:
+    """Collects compact records per room and emits them as one frame per tick"""
+
+    def __init__(self, emit: Callable[[str, bytes], Awaitable], tick: float = WS_FRAME_TICK):
+        self.emit = emit
+        self.tick = tick
+        self.pending: Dict[str, List[List]] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    def add(self, room: str, record: List):
+        records = self.pending.get(room)
+        if records is not None:
+            records.append(record)
+            return
+        self.pending[room] = [record]
+        task = asyncio.get_running_loop().create_task(self.flush_later(room))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush_later(self, room: str):
+        await asyncio.sleep(self.tick)
+        await self.flush(room)
+
+    async def flush(self, room: str):
+        records = self.pending.pop(room, None)
+        if not records:
+            return
+        frame = encode_frame(records)
+        WS_COMPACT_FRAMES.inc()
+        WS_COMPACT_BYTES.inc(len(frame))
+        await self.emit(room, frame)
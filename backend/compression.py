@@ -0,0 +1,81 @@
+"""
+Response compression for Halloween Poe Chat
+Compresses large responses (chat history, user lists, exports) with
+Brotli when the client accepts it and the optional `brotli` package is
+installed, and with gzip otherwise. Small responses are sent as-is.
+Built on Starlette's GZipMiddleware, so streaming responses are
+compressed chunk by chunk.
+
+Environment:
+    RESPONSE_COMPRESSION            turn the middleware on (default False)
+    RESPONSE_COMPRESSION_MIN_BYTES  smallest body worth compressing (default 4096)
+    RESPONSE_GZIP_LEVEL             gzip level (default 6)
+    RESPONSE_BROTLI_QUALITY         Brotli quality (default 4)
+"""
+import os
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder, IdentityResponder
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "false").lower() == "true"
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "4096"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "4"))
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """Codings the client accepts (q=0 means refused)"""
+    accepted = set()
+    for entry in accept_encoding.lower().split(","):
+        coding, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding)
+    return accepted
+
+class BrotliResponder(IdentityResponder):
+    content_encoding = "br"
+
+    def __init__(self, app, minimum_size: int, quality: int = RESPONSE_BROTLI_QUALITY):
+        super().__init__(app, minimum_size)
+        self.quality = quality
+        self.compressor = None
+
+    async def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        if self.compressor is None:
+            self.compressor = brotli.Compressor(quality=self.quality)
+        if more_body:
+            return self.compressor.process(body) + self.compressor.flush()
+        return self.compressor.process(body) + self.compressor.finish()
+
+class CompressionMiddleware(GZipMiddleware):
+    """GZipMiddleware that prefers Brotli when it is available and accepted"""
+
+    def __init__(self, app, minimum_size: int = RESPONSE_COMPRESSION_MIN_BYTES,
+                 compresslevel: int = RESPONSE_GZIP_LEVEL, brotli_quality: int = RESPONSE_BROTLI_QUALITY):
+        super().__init__(app, minimum_size=minimum_size, compresslevel=compresslevel)
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            responder = BrotliResponder(self.app, self.minimum_size, self.brotli_quality)
+        elif "gzip" in accepted:
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
@@ -0,0 +1,147 @@
+"""
+Cooldown scheduler for Halloween Poe Chat
+Too many wrong answers put a (user, target) pair on a cooldown, stored in
+connection_attempts.cooldown_until. This module keeps the active cooldowns
+in a heap, loaded from the table on startup, and calls the expiry hooks
+(main_advanced registers a Socket.IO "cooldown_expired" push) when one
+ends, so clients no longer have to poll /attempt-connection to find out.
+
+Attempt rows are kept only while they matter: once the last attempt is
+older than ATTEMPT_RETENTION_HOURS and no cooldown is running, the row is
+deleted (in batches) and the pair starts again with a clean count.
+
+With several workers each process schedules the cooldowns it sets, plus
+the ones it loaded at startup, so a restart can repeat an expiry event.
+
+Environment:
+    ATTEMPT_RETENTION_HOURS       idle time before an attempt row is deleted (default 24, 0 = keep forever)
+    ATTEMPT_GC_INTERVAL_MINUTES   how often stale rows are deleted in the API process (default 10, 0 = disabled)
+    ATTEMPT_GC_BATCH_SIZE         rows deleted per statement (default 1000)
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from sqlalchemy import delete
+from sqlalchemy.orm import Session, aliased
+from database import ConnectionAttempt, User
+
+ATTEMPT_RETENTION_HOURS = float(os.getenv("ATTEMPT_RETENTION_HOURS", "24"))
+ATTEMPT_GC_INTERVAL_MINUTES = float(os.getenv("ATTEMPT_GC_INTERVAL_MINUTES", "10"))
+ATTEMPT_GC_BATCH_SIZE = int(os.getenv("ATTEMPT_GC_BATCH_SIZE", "1000"))
+
+logger = logging.getLogger("cooldowns")
+
+# (user id, target user id)
+PairKey = Tuple[int, int]
+
+class CooldownScheduler:
+    """Active cooldowns ordered by expiry
+
+    Rescheduling a pair leaves its old heap entry in place; entries whose
+    deadline no longer matches `deadlines` are skipped when they come up.
+    Hooks are called with (username, target_username) when a cooldown ends.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, int, str, str]] = []  # (deadline, user id, target id, username, target username)
+        self.deadlines: Dict[PairKey, float] = {}
+        self.hooks: List[Callable[[str, str], Awaitable]] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def schedule(self, user_id: int, target_user_id: int, username: str, target_username: str, until: datetime):
+        """Track a cooldown ending at `until` (naive local time, like cooldown_until)"""
+        deadline = until.timestamp()
+        self.deadlines[(user_id, target_user_id)] = deadline
+        heapq.heappush(self.heap, (deadline, user_id, target_user_id, username, target_username))
+        # Only a new earliest deadline changes how long the run loop sleeps
+        if self.wakeup is not None and self.heap[0][0] == deadline:
+            self.wakeup.set()
+
+    def load(self, db: Session, now: Optional[datetime] = None) -> int:
+        """Schedule every cooldown still running in the table"""
+        now = now or datetime.now()
+        target = aliased(User)
+        rows = db.query(ConnectionAttempt.user_id, ConnectionAttempt.target_user_id, User.username,
+                        target.username, ConnectionAttempt.cooldown_until).join(
+            User, User.id == ConnectionAttempt.user_id
+        ).join(
+            target, target.id == ConnectionAttempt.target_user_id
+        ).filter(ConnectionAttempt.cooldown_until > now).all()
+        for user_id, target_user_id, username, target_username, until in rows:
+            self.schedule(user_id, target_user_id, username, target_username, until)
+        return len(rows)
+
+    def pop_expired(self, now: Optional[float] = None) -> List[Tuple[str, str]]:
+        """(username, target username) of every cooldown that has ended, in expiry order"""
+        now = time.time() if now is None else now
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, user_id, target_user_id, username, target_username = heapq.heappop(self.heap)
+            if self.deadlines.get((user_id, target_user_id)) != deadline:
+                continue  # rescheduled since
+            del self.deadlines[(user_id, target_user_id)]
+            expired.append((username, target_username))
+        return expired
+
+    def next_delay(self) -> Optional[float]:
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.time())
+
+    async def notify(self, username: str, target_username: str):
+        for hook in self.hooks:
+            try:
+                await hook(username, target_username)
+            except Exception:
+                logger.exception("Cooldown expiry hook failed", extra={"username": username})
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            for username, target_username in self.pop_expired():
+                await self.notify(username, target_username)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.next_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.wakeup = None
+
+def purge_stale_attempts(db: Session, now: Optional[datetime] = None,
+                         batch_size: int = ATTEMPT_GC_BATCH_SIZE) -> int:
+    """Delete attempt rows idle for ATTEMPT_RETENTION_HOURS with no running cooldown"""
+    if ATTEMPT_RETENTION_HOURS <= 0:
+        return 0
+    now = now or datetime.now()
+    cutoff = now - timedelta(hours=ATTEMPT_RETENTION_HOURS)
+    deleted = 0
+    while True:
+        # Short transactions, so attempts in flight are never blocked for long
+        ids = [row.id for row in db.query(ConnectionAttempt.id).filter(
+            ConnectionAttempt.last_attempt < cutoff,
+            (ConnectionAttempt.cooldown_until == None) | (ConnectionAttempt.cooldown_until <= now)
+        ).limit(batch_size)]
+        if not ids:
+            return deleted
+        db.execute(delete(ConnectionAttempt).where(ConnectionAttempt.id.in_(ids)))
+        db.commit()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            return deleted
@@ -1,12 +1,34 @@
 """
 Database configuration and models for Halloween Poe Chat
+
+Read replicas: endpoints that only read can take their session from
+`router` (get_read_db / get_user_read_db), which hands out replica
+sessions in turn. A user who just wrote (sent a message, made or ended a
+connection) reads from the primary for READ_YOUR_WRITES_SECONDS, so they
+see their own changes despite replication lag. The marks are kept per
+process, and ReadYourWritesMiddleware also hands the deadline to the client
+in a cookie, so its next read is routed to the primary by whichever worker
+serves it (hosts' clocks are assumed to agree to well within the window).
+Everything else, and every write, uses the primary (SessionLocal).
+
+Environment:
+    DATABASE_REPLICA_URLS       comma-separated replica URLs (default none: reads use the primary)
+    READ_YOUR_WRITES_SECONDS    primary-only reads after a user's write (default 5, 0 = off)
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, Text, DateTime, ForeignKey, Boolean, LargeBinary, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
 from datetime import datetime
+from typing import Dict, List, Optional
+from contextvars import ContextVar
 import os
+import json
+import math
+import time
+import itertools
+import threading
 from dotenv import load_dotenv
+from fastapi import Cookie, Depends
 
 load_dotenv()
 
@@ -16,11 +38,147 @@ DATABASE_URL = os.getenv(
     f"postgresql://{os.getenv('DB_USER', 'postgres')}:{os.getenv('DB_PASSWORD', 'password')}@{os.getenv('DB_HOST', 'localhost')}:{os.getenv('DB_PORT', '5432')}/{os.getenv('DB_NAME', 'poe_chat')}"
 )
 
-# Create engine
-engine = create_engine(DATABASE_URL, echo=True)
+# The engine is created on first use so importing the models (CLI tools,
+# workers before fork, tests) never opens a pool or loads a DB driver.
+# `from database import engine` still works through the module __getattr__.
+_engine = None
+_engine_lock = threading.Lock()
+
+class LazySessionmaker(sessionmaker):
+    """sessionmaker that binds itself to the engine the first time it is called"""
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None and "bind" not in local_kw:
+            get_engine()
+        return super().__call__(**local_kw)
 
 # Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = LazySessionmaker(autocommit=False, autoflush=False)
+
+def get_engine(**options):
+    """Return the engine, creating it on first use.
+
+    Passing options (e.g. poolclass=NullPool) replaces the current engine.
+    SQL logging goes through the "sqlalchemy.engine" logger, see LOG_LEVELS.
+    """
+    global _engine
+    if _engine is not None and not options:
+        return _engine
+    with _engine_lock:
+        if options and _engine is not None:
+            _engine.dispose()
+            _engine = None
+        if _engine is None:
+            _engine = create_engine(DATABASE_URL, **options)
+            SessionLocal.configure(bind=_engine)
+    return _engine
+
+def dispose_engine():
+    """Close pooled connections, if the engine was ever created"""
+    if _engine is not None:
+        _engine.dispose()
+    router.dispose()
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Expired read-your-writes marks are swept once there are this many
+STICKY_SWEEP_SIZE = 10000
+
+# Carries the read-your-writes deadline (epoch seconds) between workers, through the client
+READ_YOUR_WRITES_COOKIE = "primary_until"
+
+# Deadlines set by mark_write during the current HTTP request (ReadYourWritesMiddleware)
+request_writes: ContextVar[Optional[List[float]]] = ContextVar("request_writes", default=None)
+
+class SessionRouter:
+    """Sessions for read-only work: replicas in turn, or the primary for users who just wrote"""
+
+    def __init__(self, replica_urls: List[str], sticky_seconds: float = READ_YOUR_WRITES_SECONDS):
+        self.replica_urls = list(replica_urls)
+        self.sticky_seconds = sticky_seconds
+        self.engines = []
+        self.replicas: List[sessionmaker] = []
+        self.recent_writes: Dict[int, float] = {}  # user id -> reads go to the primary until (monotonic)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def replica_sessionmakers(self) -> List[sessionmaker]:
+        """Replica session factories, creating the engines on first use"""
+        if self.replica_urls and not self.replicas:
+            with self._lock:
+                if not self.replicas:
+                    self.engines = [create_engine(url) for url in self.replica_urls]
+                    self.replicas = [sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in self.engines]
+        return self.replicas
+
+    def mark_write(self, *user_ids: int):
+        """Send these users' reads to the primary for the next sticky_seconds"""
+        if not self.replica_urls or self.sticky_seconds <= 0:
+            return
+        now = time.monotonic()
+        if len(self.recent_writes) >= STICKY_SWEEP_SIZE:
+            for user_id in [user_id for user_id, until in self.recent_writes.items() if until <= now]:
+                del self.recent_writes[user_id]
+        for user_id in user_ids:
+            self.recent_writes[user_id] = now + self.sticky_seconds
+        writes = request_writes.get()
+        if writes is not None:
+            writes.append(time.time() + self.sticky_seconds)
+
+    def is_sticky(self, user_id: Optional[int]) -> bool:
+        until = self.recent_writes.get(user_id)
+        return until is not None and until > time.monotonic()
+
+    def read_session(self, user_id: Optional[int] = None, primary_until: Optional[float] = None) -> Session:
+        """A replica session, or the primary while user_id is marked or before primary_until (from the cookie)"""
+        replicas = self.replica_sessionmakers()
+        if not replicas or self.is_sticky(user_id) or (primary_until is not None and primary_until > time.time()):
+            return SessionLocal()
+        return replicas[next(self._turn) % len(replicas)]()
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+router = SessionRouter(DATABASE_REPLICA_URLS)
+
+class ReadYourWritesMiddleware:
+    """ASGI middleware setting the read-your-writes cookie on responses to requests that wrote"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        writes: List[float] = []
+        token = request_writes.set(writes)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and writes:
+                until = max(writes)
+                cookie = (f"{READ_YOUR_WRITES_COOKIE}={until:.3f}; Max-Age={math.ceil(until - time.time())}; "
+                          "Path=/; HttpOnly; SameSite=Lax")
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            request_writes.reset(token)
+
+def primary_until_cookie(primary_until: Optional[str] = Cookie(None, alias=READ_YOUR_WRITES_COOKIE)) -> Optional[float]:
+    """The read-your-writes deadline the client brought back, if any"""
+    try:
+        return float(primary_until) if primary_until else None
+    except ValueError:
+        return None
+
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Create base class for models
 Base = declarative_base()
@@ -32,7 +190,8 @@ class User(Base):
     username = Column(String(50), unique=True, index=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
     questions = Column(Text, nullable=False)  # JSON string
-    answers = Column(Text, nullable=False)    # JSON string
+    answers = Column(Text, nullable=False)    # JSON string; "[]" once hashed (plaintext from older versions)
+    answer_hashes = Column(Text)              # keyed hashes of the normalized answers, see answers.py
     poem = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -50,7 +209,7 @@ class ConnectionAttempt(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     target_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     attempts = Column(Integer, default=0)
-    last_attempt = Column(DateTime)
+    last_attempt = Column(DateTime, index=True)
     cooldown_until = Column(DateTime)
     
     # Relationships - specify foreign_keys explicitly
@@ -65,6 +224,7 @@ class Connection(Base):
     user2_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
+    last_seq = Column(Integer, default=0)  # highest Message.seq handed out for this connection
     
     # Relationships - specify foreign_keys explicitly
     user1 = relationship("User", foreign_keys=[user1_id], back_populates="connections1")
@@ -80,24 +240,64 @@ class Message(Base):
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
     is_read = Column(Boolean, default=False)
+    seq = Column(Integer)  # 1, 2, 3... per connection, see message_log.py
+    client_id = Column(String(64))  # idempotency key sent by the client (its message id)
     
     # Relationships - specify foreign_keys explicitly
     connection = relationship("Connection", foreign_keys=[connection_id], back_populates="messages")
+    
+    # Partitioned PostgreSQL tables get these with timestamp added instead (retention.py)
+    __table_args__ = (
+        Index("uq_messages_connection_seq", "connection_id", "seq", unique=True),
+        Index("uq_messages_client_id", "connection_id", "sender_id", "client_id", unique=True),
+    )
     sender = relationship("User", foreign_keys=[sender_id], back_populates="messages")
 
 class ChatRoom(Base):
+    """A group chat; its members are in chat_room_members"""
     __tablename__ = "chat_rooms"
     
     id = Column(Integer, primary_key=True, index=True)
-    room_id = Column(String(100), unique=True, index=True, nullable=False)
-    user1_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    user2_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    room_id = Column(String(100), unique=True, index=True, nullable=False)  # public id used by clients
+    name = Column(String(100))
+    user1_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # creator
+    user2_id = Column(Integer, ForeignKey("users.id"))  # only set by the old 1:1 rooms
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     
     # Relationships - specify foreign_keys explicitly
     user1 = relationship("User", foreign_keys=[user1_id])
     user2 = relationship("User", foreign_keys=[user2_id])
+    members = relationship("ChatRoomMember", back_populates="chat_room")
+
+class ChatRoomMember(Base):
+    __tablename__ = "chat_room_members"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    chat_room_id = Column(Integer, ForeignKey("chat_rooms.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    joined_at = Column(DateTime, default=datetime.utcnow)
+    
+    chat_room = relationship("ChatRoom", foreign_keys=[chat_room_id], back_populates="members")
+    user = relationship("User", foreign_keys=[user_id])
+    
+    __table_args__ = (
+        Index("uq_chat_room_members_room_user", "chat_room_id", "user_id", unique=True),
+    )
+
+class MessageArchive(Base):
+    __tablename__ = "message_archives"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    connection_id = Column(Integer, ForeignKey("connections.id"), nullable=False, index=True)
+    period = Column(String(7), nullable=False)  # YYYY-MM of the archived messages
+    first_message_id = Column(Integer)
+    last_message_id = Column(Integer)
+    message_count = Column(Integer, default=0)
+    payload = Column(LargeBinary, nullable=False)  # gzip-compressed JSONL
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    
+    connection = relationship("Connection", foreign_keys=[connection_id])
 
 # Dependency to get database session
 def get_db():
@@ -107,10 +307,121 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db(primary_until: Optional[float] = Depends(primary_until_cookie)):
+    """Session for a read-only endpoint (a replica when configured)"""
+    db = router.read_session(primary_until=primary_until)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_user_read_db(user_id: int, primary_until: Optional[float] = Depends(primary_until_cookie)):
+    """get_read_db for endpoints with a user_id path parameter: that user's recent writes are visible"""
+    db = router.read_session(user_id, primary_until)
+    try:
+        yield db
+    finally:
+        db.close()
+
 # Create all tables
 def create_tables():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
+    upgrade_schema()
+
+def upgrade_schema(engine=None):
+    """Bring tables created by an older version up to date.
+
+    Adds missing (nullable) columns and indexes and backfills the ones that
+    need values. Safe to run repeatedly; create_tables() calls it.
+    """
+    engine = engine or get_engine()
+    inspector = inspect(engine)
+    tables = [table for table in Base.metadata.sorted_tables if inspector.has_table(table.name)]
+    added = set()
+    with engine.begin() as connection:
+        for table in tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    added.add((table.name, column.name))
+
+        if ("messages", "seq") in added or (inspector.has_table("messages") and connection.execute(
+                text("SELECT 1 FROM messages WHERE seq IS NULL LIMIT 1")).first()):
+            backfill_message_seq(connection)
+        if inspector.has_table("chat_rooms"):
+            user2 = next(column for column in inspector.get_columns("chat_rooms") if column["name"] == "user2_id")
+            if not user2["nullable"]:
+                relax_chat_room_user2(connection)
+        if inspector.has_table("users"):
+            backfill_answer_hashes(connection)
+
+        partitioned = False
+        if engine.dialect.name == "postgresql":
+            from retention import messages_is_partitioned
+            partitioned = messages_is_partitioned(connection)
+        for table in tables:
+            if table.name == "messages" and partitioned:
+                continue
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+def backfill_message_seq(connection):
+    """Number messages without a seq in id order after their connection's last seq, and record the new last seq
+
+    Rows written without one (by an older version, or a bulk load) continue
+    the connection's sequence, so seqs already handed to clients never move.
+    """
+    connection.execute(text(
+        "UPDATE messages SET seq = numbered.seq FROM ("
+        "SELECT messages.id, top.seq + ROW_NUMBER() OVER (PARTITION BY messages.connection_id ORDER BY messages.id) AS seq "
+        "FROM messages JOIN ("
+        "SELECT connections.id AS connection_id, CASE WHEN COALESCE(connections.last_seq, 0) > COALESCE(MAX(messages.seq), 0) "
+        "THEN COALESCE(connections.last_seq, 0) ELSE COALESCE(MAX(messages.seq), 0) END AS seq "
+        "FROM connections LEFT JOIN messages ON messages.connection_id = connections.id "
+        "GROUP BY connections.id, connections.last_seq"
+        ") AS top ON top.connection_id = messages.connection_id WHERE messages.seq IS NULL"
+        ") AS numbered WHERE messages.id = numbered.id"
+    ))
+    connection.execute(text(
+        "UPDATE connections SET last_seq = highest.seq FROM ("
+        "SELECT connection_id, MAX(seq) AS seq FROM messages GROUP BY connection_id"
+        ") AS highest WHERE highest.connection_id = connections.id "
+        "AND (connections.last_seq IS NULL OR connections.last_seq < highest.seq)"
+    ))
+    connection.execute(text("UPDATE connections SET last_seq = 0 WHERE last_seq IS NULL"))
+
+def relax_chat_room_user2(connection):
+    """Group rooms have no second user; older schemas made chat_rooms.user2_id NOT NULL"""
+    if connection.dialect.name == "sqlite":
+        # SQLite cannot drop NOT NULL; the table was never written before group rooms, so rebuild it
+        if connection.execute(text("SELECT COUNT(*) FROM chat_rooms")).scalar() == 0:
+            ChatRoom.__table__.drop(bind=connection)
+            ChatRoom.__table__.create(bind=connection)
+    else:
+        connection.execute(text("ALTER TABLE chat_rooms ALTER COLUMN user2_id DROP NOT NULL"))
+
+def backfill_answer_hashes(connection, batch_size: int = 1000):
+    """Hash the plaintext answers of users stored before answer_hashes existed, then drop the plaintext"""
+    # Imported here so tools that only need the models run without ANSWER_HASH_KEY
+    from answers import hash_answers
+
+    while True:
+        rows = connection.execute(text(
+            "SELECT id, answers FROM users WHERE answer_hashes IS NULL LIMIT :limit"
+        ), {"limit": batch_size}).all()
+        if not rows:
+            return
+        updates = []
+        for user_id, answers in rows:
+            try:
+                plaintext = json.loads(answers or "[]")
+            except ValueError:
+                plaintext = []
+            updates.append({"id": user_id, "hashes": hash_answers([str(answer) for answer in plaintext])})
+        connection.execute(text("UPDATE users SET answer_hashes = :hashes, answers = '[]' WHERE id = :id"), updates)
 
 # Drop all tables (for testing)
 def drop_tables():
-    Base.metadata.drop_all(bind=engine)
+    Base.metadata.drop_all(bind=get_engine())
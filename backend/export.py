@@ -0,0 +1,76 @@
+"""
+Conversation export for Halloween Poe Chat
+Streams every message of a connection as NDJSON (one JSON object per
+line, oldest first), optionally gzip-compressed. Archived messages
+(retention.py) come first, one archive at a time, then the hot table is
+read through a server-side cursor (yield_per), so memory stays flat however
+long the conversation is. Lines are written in batches of
+EXPORT_BATCH_SIZE.
+
+Environment:
+    EXPORT_BATCH_SIZE    rows fetched and written per chunk (default 1000)
+    EXPORT_GZIP_LEVEL    gzip level for format=gzip (default 6)
+"""
+import os
+import zlib
+from typing import Dict, Iterable, Iterator
+import orjson
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database import Message
+from retention import iter_archived_messages
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+
+# format -> (media type, file extension)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "gzip": ("application/gzip", "jsonl.gz"),
+}
+
+def export_lines(db: Session, connection_id: int, usernames: Dict[int, str],
+                 batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """NDJSON chunks for a connection's messages, in the /messages row shape"""
+    for archived in iter_archived_messages(db, connection_id):
+        archived.sort(key=lambda row: row["id"])
+        for start in range(0, len(archived), batch_size):
+            yield b"".join(
+                orjson.dumps({
+                    "id": row["id"],
+                    "seq": row.get("seq"),
+                    "content": row["content"],
+                    "sender": usernames.get(row["sender_id"]),
+                    "timestamp": row["timestamp"]
+                }) + b"\n"
+                for row in archived[start:start + batch_size]
+            )
+
+    # Core rows on the session's connection (no ORM loading), batch_size at a time from a server-side cursor
+    result = db.connection().execute(
+        select(Message.id, Message.seq, Message.content, Message.sender_id, Message.timestamp)
+        .where(Message.connection_id == connection_id)
+        # NULLS LAST: a row without a seq sorts the same on SQLite and PostgreSQL
+        .order_by(Message.seq.asc().nulls_last(), Message.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for rows in result.partitions():
+        yield b"".join(
+            orjson.dumps({
+                "id": message_id,
+                "seq": seq,
+                "content": content,
+                "sender": usernames.get(sender_id),
+                "timestamp": timestamp
+            }) + b"\n"
+            for message_id, seq, content, sender_id, timestamp in rows
+        )
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = EXPORT_GZIP_LEVEL) -> Iterator[bytes]:
+    """Compress a stream of chunks into one gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Synthetic data generator for Halloween Poe Chat
+Bulk-loads users, connections and messages with realistic distributions
+for capacity testing. Uses COPY on PostgreSQL and executemany batches
+elsewhere instead of ORM adds.
+
+Example:
+    python generate_data.py --users 10000 --connections 50000 --messages 2000000
+"""
+import io
+import sys
+import csv
+import json
+import time
+import random
+import hashlib
+import argparse
+import itertools
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Tuple
+from sqlalchemy import text
+from database import get_engine, create_tables, User, Connection, Message
+from answers import hash_answers
+
+QUESTIONS = [
+    "What is your favorite gothic novel?",
+    "What color represents your soul?",
+    "What is your spirit animal?",
+    "Where would you haunt?",
+    "What sound wakes you at midnight?",
+    "What is your favorite Poe story?",
+]
+
+ANSWERS = [
+    "Dracula", "Frankenstein", "Deep purple", "Crimson", "Raven", "Black cat", "Owl",
+    "Lighthouse", "Old manor", "Tolling bells", "Tapping", "The Tell-Tale Heart", "Annabel Lee",
+]
+
+WORDS = [
+    "the", "a", "and", "of", "to", "in", "is", "you", "that", "it", "was", "for", "on", "are",
+    "with", "we", "at", "be", "this", "have", "from", "or", "my", "your", "not", "what", "all",
+    "shadow", "darkness", "midnight", "grave", "tomb", "ghost", "specter", "phantom", "raven",
+    "eternal", "mystery", "secret", "whisper", "dreary", "melancholy", "sepulchral", "ominous",
+    "haunting", "eerie", "chamber", "door", "nevermore", "bells", "heart", "moon", "night",
+    "hello", "yes", "no", "maybe", "tonight", "tomorrow", "really", "haha", "ok", "thanks",
+]
+
+POEM = """In shadows deep where memories dwell,
+Three secrets hidden, none can tell.
+{0} echoes through the night,
+{1} fades into pale moonlight.
+
+{2} speaks in hollow tones,
+Through haunted halls and ancient stones."""
+
+def batched(rows: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def zipf_cum_weights(count: int, alpha: float) -> List[float]:
+    """Cumulative Zipf weights so a few items get most of the activity"""
+    return list(itertools.accumulate(1.0 / (rank ** alpha) for rank in range(1, count + 1)))
+
+# Row generators
+
+def generate_users(count: int, prefix: str, days: int, rng: random.Random) -> Iterator[Dict]:
+    password_hash = hashlib.sha256("password123".encode()).hexdigest()
+    now = datetime.utcnow()
+    for i in range(count):
+        answers = rng.sample(ANSWERS, 3)
+        yield {
+            "username": f"{prefix}{i:07d}",
+            "password_hash": password_hash,
+            "questions": json.dumps(rng.sample(QUESTIONS, 3)),
+            "answers": "[]",
+            "answer_hashes": hash_answers(answers),
+            "poem": POEM.format(*answers),
+            "created_at": now - timedelta(seconds=rng.uniform(0, days * 86400)),
+        }
+
+def generate_pairs(user_ids: List[int], count: int, rng: random.Random) -> List[Tuple[int, int]]:
+    """Unique user pairs with a heavy-tailed degree distribution"""
+    max_pairs = len(user_ids) * (len(user_ids) - 1) // 2
+    count = min(count, max_pairs)
+    shuffled = user_ids[:]
+    rng.shuffle(shuffled)
+    cum_weights = zipf_cum_weights(len(shuffled), 0.8)
+
+    pairs = set()
+    attempts = 0
+    while len(pairs) < count and attempts < count * 20:
+        attempts += 1
+        a, b = rng.choices(shuffled, cum_weights=cum_weights, k=2)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+
+    # Top up uniformly if the skewed sampling saturated
+    while len(pairs) < count:
+        a, b = rng.sample(user_ids, 2)
+        pairs.add((min(a, b), max(a, b)))
+
+    return list(pairs)
+
+def generate_connections(pairs: List[Tuple[int, int]], days: int, rng: random.Random) -> Iterator[Dict]:
+    now = datetime.utcnow()
+    for user1_id, user2_id in pairs:
+        yield {
+            "user1_id": user1_id,
+            "user2_id": user2_id,
+            "created_at": now - timedelta(seconds=rng.uniform(days * 86400 * 0.9, days * 86400)),
+            "is_active": True,
+        }
+
+def generate_messages(connections: List[Tuple[int, int, int]], count: int, days: int,
+                      rng: random.Random) -> Iterator[Dict]:
+    """Messages in timestamp order, heavy-tailed across connections, bursty back-and-forth
+
+    Each connection's messages are numbered 1, 2, 3... like message_log.store_message does.
+    """
+    if not connections or count <= 0:
+        return
+
+    order = connections[:]
+    rng.shuffle(order)
+    cum_weights = zipf_cum_weights(len(order), 1.1)
+    last_sender: Dict[int, int] = {}
+    last_seq: Dict[int, int] = {}
+
+    start = datetime.utcnow() - timedelta(days=days)
+    mean_gap = days * 86400.0 / count
+    offset = 0.0
+
+    for _ in range(count):
+        offset += rng.expovariate(1.0 / mean_gap)
+        connection_id, user1_id, user2_id = rng.choices(order, cum_weights=cum_weights, k=1)[0]
+
+        # Replies usually alternate, sometimes the same person sends a burst
+        previous = last_sender.get(connection_id)
+        if previous is None:
+            sender_id = rng.choice((user1_id, user2_id))
+        elif rng.random() < 0.65:
+            sender_id = user2_id if previous == user1_id else user1_id
+        else:
+            sender_id = previous
+        last_sender[connection_id] = sender_id
+        last_seq[connection_id] = last_seq.get(connection_id, 0) + 1
+
+        length = max(1, min(80, int(rng.lognormvariate(2.0, 0.7))))
+        yield {
+            "connection_id": connection_id,
+            "sender_id": sender_id,
+            "seq": last_seq[connection_id],
+            "content": " ".join(rng.choices(WORDS, k=length)),
+            "timestamp": start + timedelta(seconds=offset),
+            "is_read": rng.random() < 0.9,
+        }
+
+# Loaders
+
+def copy_rows(table: str, columns: List[str], rows: List[Dict]):
+    """Stream rows through PostgreSQL COPY"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+
+    raw = get_engine().raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        raw.commit()
+    finally:
+        raw.close()
+
+def bulk_insert(table, rows: Iterable[Dict], batch_size: int) -> int:
+    """Insert rows in batches, COPY on PostgreSQL and executemany elsewhere"""
+    engine = get_engine()
+    use_copy = engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2"
+    total = 0
+    for batch in batched(rows, batch_size):
+        if use_copy:
+            copy_rows(table.name, list(batch[0].keys()), batch)
+        else:
+            with engine.begin() as connection:
+                connection.execute(table.insert(), batch)
+        total += len(batch)
+    return total
+
+def report(label: str, count: int, started: float):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"SUCCESS: {count} {label} in {elapsed:.1f}s ({count / elapsed:,.0f}/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Halloween Poe Chat - synthetic data generator")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=180, help="history span in days")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--prefix", default="load_user_", help="username prefix for generated users")
+    parser.add_argument("--seed", type=int, default=1849)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print("Halloween Poe Chat - Synthetic Data Generator")
+    print("=" * 50)
+
+    try:
+        create_tables()
+        engine = get_engine()
+        # "_" and "%" are LIKE wildcards; the default prefix contains "_"
+        prefix = {"prefix": args.prefix.replace("\\", "\\\\").replace("_", "\\_").replace("%", "\\%") + "%"}
+
+        with engine.connect() as connection:
+            existing = connection.execute(
+                text("SELECT count(*) FROM users WHERE username LIKE :prefix ESCAPE '\\'"), prefix
+            ).scalar()
+        if existing:
+            print(f"ERROR: {existing} users with prefix '{args.prefix}' already exist, use another --prefix")
+            return False
+
+        started = time.perf_counter()
+        count = bulk_insert(User.__table__, generate_users(args.users, args.prefix, args.days, rng), args.batch_size)
+        report("users", count, started)
+
+        with engine.connect() as connection:
+            user_ids = [row[0] for row in connection.execute(
+                text("SELECT id FROM users WHERE username LIKE :prefix ESCAPE '\\'"), prefix
+            )]
+            first_connection_id = connection.execute(text("SELECT coalesce(max(id), 0) FROM connections")).scalar()
+
+        started = time.perf_counter()
+        pairs = generate_pairs(user_ids, args.connections, rng)
+        count = bulk_insert(Connection.__table__, generate_connections(pairs, args.days, rng), args.batch_size)
+        report("connections", count, started)
+
+        with engine.connect() as connection:
+            connections = [tuple(row) for row in connection.execute(
+                text("SELECT id, user1_id, user2_id FROM connections WHERE id > :first"), {"first": first_connection_id}
+            )]
+
+        started = time.perf_counter()
+        count = bulk_insert(Message.__table__, generate_messages(connections, args.messages, args.days, rng), args.batch_size)
+        report("messages", count, started)
+
+        with engine.begin() as connection:
+            # The next message stored through the app continues each connection's sequence
+            connection.execute(text(
+                "UPDATE connections SET last_seq = "
+                "(SELECT COALESCE(MAX(seq), 0) FROM messages WHERE messages.connection_id = connections.id) "
+                "WHERE id > :first"
+            ), {"first": first_connection_id})
+
+        if engine.dialect.name == "postgresql":
+            with engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT").execute(text("ANALYZE"))
+
+        print("\nSynthetic data loaded successfully!")
+        return True
+
+    except Exception as e:
+        print(f"ERROR: Error generating data: {e}")
+        return False
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,101 @@
+"""
+Group chat rooms for Halloween Poe Chat
+A group is a ChatRoom row (user2_id left empty) whose members are listed in
+chat_room_members. Members are added in batches: usernames are resolved a
+chunk at a time, existing members are found with one query, and the new
+rows go in with a single bulk insert, so adding thousands of people costs
+a handful of statements rather than a few per person. The websocket server
+loads a room's whole member list with one join (load_members) and serves
+joins from that.
+
+Environment:
+    GROUP_ROOM_MAX_MEMBERS   largest group allowed (default 5000)
+"""
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+from database import ChatRoom, ChatRoomMember, User
+
+GROUP_ROOM_MAX_MEMBERS = int(os.getenv("GROUP_ROOM_MAX_MEMBERS", "5000"))
+
+# Usernames per IN (...) lookup
+MEMBER_CHUNK_SIZE = 500
+
+class GroupFullError(Exception):
+    """Adding the members would take the room past GROUP_ROOM_MAX_MEMBERS"""
+
+def new_room_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+def find_group(db: Session, room_id: str) -> Optional[ChatRoom]:
+    return db.query(ChatRoom).filter(
+        ChatRoom.room_id == room_id,
+        ChatRoom.user2_id.is_(None),
+        ChatRoom.is_active.isnot(False)
+    ).first()
+
+def create_group(db: Session, creator_id: int, name: str) -> ChatRoom:
+    """New group with the creator as its first member; commits"""
+    room = ChatRoom(room_id=new_room_id(), name=name, user1_id=creator_id)
+    db.add(room)
+    db.flush()
+    db.add(ChatRoomMember(chat_room_id=room.id, user_id=creator_id))
+    db.commit()
+    db.refresh(room)
+    return room
+
+def member_ids(db: Session, chat_room_id: int) -> set:
+    return {user_id for (user_id,) in db.query(ChatRoomMember.user_id).filter(ChatRoomMember.chat_room_id == chat_room_id)}
+
+def add_members(db: Session, chat_room_id: int, usernames: List[str],
+                max_members: int = GROUP_ROOM_MAX_MEMBERS) -> Tuple[List[str], List[str]]:
+    """Add users to a group by username; returns (added, unknown usernames) and commits.
+
+    Usernames already in the group are skipped. Raises GroupFullError (adding
+    nobody) when the group would grow past max_members.
+    """
+    wanted = list(dict.fromkeys(usernames))
+    users: Dict[str, int] = {}
+    for start in range(0, len(wanted), MEMBER_CHUNK_SIZE):
+        chunk = wanted[start:start + MEMBER_CHUNK_SIZE]
+        users.update(db.query(User.username, User.id).filter(User.username.in_(chunk)).all())
+
+    existing = member_ids(db, chat_room_id)
+    added = [username for username in wanted if username in users and users[username] not in existing]
+    if len(existing) + len(added) > max_members:
+        raise GroupFullError(f"Group is limited to {max_members} members")
+    if added:
+        db.execute(insert(ChatRoomMember), [{"chat_room_id": chat_room_id, "user_id": users[username]} for username in added])
+        db.commit()
+    return added, [username for username in wanted if username not in users]
+
+def load_members(db: Session, chat_room_id: int) -> Dict[str, int]:
+    """{username: user id} for everyone in the group, in one query"""
+    return dict(
+        db.query(User.username, User.id)
+        .join(ChatRoomMember, ChatRoomMember.user_id == User.id)
+        .filter(ChatRoomMember.chat_room_id == chat_room_id)
+        .all()
+    )
+
+def groups_for_user(db: Session, user_id: int) -> List[Dict]:
+    """The user's groups with their member counts, newest first"""
+    # Count members of the user's rooms only, not of every group
+    mine = db.query(ChatRoomMember.chat_room_id).filter(ChatRoomMember.user_id == user_id)
+    counts = (
+        db.query(ChatRoomMember.chat_room_id, func.count().label("members"))
+        .filter(ChatRoomMember.chat_room_id.in_(mine))
+        .group_by(ChatRoomMember.chat_room_id)
+        .subquery()
+    )
+    rows = (
+        db.query(ChatRoom.room_id, ChatRoom.name, counts.c.members)
+        .join(ChatRoomMember, ChatRoomMember.chat_room_id == ChatRoom.id)
+        .join(counts, counts.c.chat_room_id == ChatRoom.id)
+        .filter(ChatRoomMember.user_id == user_id, ChatRoom.is_active.isnot(False))
+        .order_by(ChatRoom.id.desc())
+        .all()
+    )
+    return [{"room_id": room_id, "name": name, "members": members} for room_id, name, members in rows]
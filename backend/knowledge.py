@@ -0,0 +1,41 @@
+"""
+Poe knowledge base for Halloween Poe Chat
+Loads knowledge_base/poe_poems.json (poem excerpts, gothic vocabulary and
+style notes) on first use and keeps it for the life of the process.
+
+Environment:
+    KNOWLEDGE_BASE_PATH  path to the JSON file (default ../knowledge_base/poe_poems.json)
+"""
+import os
+import json
+import threading
+from typing import Dict, List
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "knowledge_base", "poe_poems.json")
+KNOWLEDGE_BASE_PATH = os.getenv("KNOWLEDGE_BASE_PATH", DEFAULT_PATH)
+
+_knowledge_base = None
+_lock = threading.Lock()
+
+def get_knowledge_base() -> Dict:
+    """Return the parsed knowledge base, reading it on first call (empty if missing)"""
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _lock:
+            if _knowledge_base is None:
+                try:
+                    with open(KNOWLEDGE_BASE_PATH, encoding="utf-8") as f:
+                        _knowledge_base = json.load(f)
+                except (OSError, ValueError):
+                    _knowledge_base = {}
+    return _knowledge_base
+
+def is_loaded() -> bool:
+    return _knowledge_base is not None
+
+def vocabulary(kind: str) -> List[str]:
+    """Words from one vocabulary list, e.g. "gothic_words" """
+    return get_knowledge_base().get("vocabulary", {}).get(kind, [])
+
+def poems() -> List[Dict]:
+    return get_knowledge_base().get("poems", [])
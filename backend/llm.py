@@ -0,0 +1,170 @@
+"""
+Async LLM gateway for Halloween Poe Chat
+All model calls go through one LLMGateway per process, which caps the
+number of in-flight requests with a semaphore and coalesces identical
+concurrent prompts into a single request. The backend behind it is either
+Bedrock (the blocking boto3 client run on a dedicated thread pool) or
+FakeLLMClient for deterministic tests and load runs.
+
+Environment:
+    LLM_MAX_IN_FLIGHT  max concurrent model calls per process (default 8)
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from metrics import BEDROCK_REQUEST_DURATION, BEDROCK_ERRORS, LLM_IN_FLIGHT, LLM_COALESCED
+from profiling import record_span
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+
+class LLMError(Exception):
+    pass
+
+class LLMClient(ABC):
+    """Interface for model backends"""
+
+    async def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def invoke(self, model_id: str, body: str) -> Dict:
+        """Send a request body to a model and return the parsed response body"""
+
+class BedrockLLM(LLMClient):
+    """boto3 bedrock-runtime client run on its own thread pool
+
+    client_factory returns the (lazily created) boto3 client, or None when
+    Bedrock is not configured.
+    """
+
+    def __init__(self, client_factory: Callable, max_workers: int = LLM_MAX_IN_FLIGHT):
+        self.client_factory = client_factory
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bedrock")
+        self.warmed = False
+
+    async def available(self) -> bool:
+        if not self.warmed:
+            # The first call imports boto3 and builds the client, keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.client_factory)
+            self.warmed = True
+        return self.client_factory() is not None
+
+    async def invoke(self, model_id: str, body: str) -> Dict:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.invoke_sync, model_id, body)
+
+    def invoke_sync(self, model_id: str, body: str) -> Dict:
+        client = self.client_factory()
+        if client is None:
+            raise LLMError("Bedrock is not configured")
+        response = client.invoke_model(modelId=model_id, body=body, contentType='application/json')
+        return json.loads(response['body'].read())
+
+class FakeLLMClient(LLMClient):
+    """Deterministic stand-in for Bedrock
+
+    Replies are derived from a hash of the request body (or taken from
+    `responses`, keyed by model id) and shaped like Claude 3 or Claude 2
+    responses depending on the model id. Every call is recorded in `calls`.
+    """
+
+    def __init__(self, latency: float = 0.0, responses: Optional[Dict[str, str]] = None,
+                 fail_models: Tuple[str, ...] = ()):
+        self.latency = latency
+        self.responses = responses or {}
+        self.fail_models = set(fail_models)
+        self.calls: List[Tuple[str, str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def reply(self, model_id: str, body: str) -> str:
+        if model_id in self.responses:
+            return self.responses[model_id]
+        digest = hashlib.sha256(body.encode()).hexdigest()[:12]
+        return (f"Once upon a midnight {digest}, the raven spoke of things long past,\n"
+                f"and every shadow on the chamber floor was written there to last.")
+
+    async def invoke(self, model_id: str, body: str) -> Dict:
+        self.calls.append((model_id, body))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if model_id in self.fail_models:
+                raise LLMError(f"{model_id} unavailable")
+            text = self.reply(model_id, body)
+        finally:
+            self.in_flight -= 1
+        if 'claude-3' in model_id:
+            return {"content": [{"type": "text", "text": text}]}
+        return {"completion": text}
+
+class LLMGateway:
+    """Concurrency limit, request coalescing and metrics in front of an LLMClient"""
+
+    def __init__(self, client: LLMClient, max_in_flight: int = LLM_MAX_IN_FLIGHT):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        # asyncio primitives belong to one event loop; keep one semaphore and one
+        # table of in-flight requests per loop (only requests on the same loop coalesce)
+        self.semaphores = weakref.WeakKeyDictionary()
+        self.in_flight_by_loop = weakref.WeakKeyDictionary()
+
+    def semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    def in_flight(self) -> Dict[Tuple[str, str], asyncio.Future]:
+        """Requests in flight on the running loop, by (model id, body)"""
+        loop = asyncio.get_running_loop()
+        in_flight = self.in_flight_by_loop.get(loop)
+        if in_flight is None:
+            in_flight = self.in_flight_by_loop[loop] = {}
+        return in_flight
+
+    async def available(self) -> bool:
+        return await self.client.available()
+
+    async def invoke(self, model_id: str, body: str, kind: str) -> Dict:
+        """Invoke a model, sharing the result with identical requests already in flight"""
+        key = (model_id, body)
+        in_flight = self.in_flight()
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.call(model_id, body, kind))
+            in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self.finished(in_flight, key, done))
+        else:
+            LLM_COALESCED.inc(kind=kind)
+        # Shielded so a caller that gives up does not cancel the request for the others
+        return await asyncio.shield(task)
+
+    def finished(self, in_flight: Dict[Tuple[str, str], asyncio.Future], key: Tuple[str, str], task: asyncio.Future):
+        if in_flight.get(key) is task:
+            del in_flight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller was cancelled
+
+    async def call(self, model_id: str, body: str, kind: str) -> Dict:
+        async with self.semaphore():
+            LLM_IN_FLIGHT.inc()
+            start = time.perf_counter()
+            try:
+                return await self.client.invoke(model_id, body)
+            except Exception:
+                BEDROCK_ERRORS.inc(model=model_id, kind=kind)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                LLM_IN_FLIGHT.dec()
+                BEDROCK_REQUEST_DURATION.observe(elapsed, model=model_id, kind=kind)
+                record_span("llm", elapsed)
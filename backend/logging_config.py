@@ -0,0 +1,144 @@
+"""
+Logging configuration for Halloween Poe Chat
+Structured (key=value or JSON) records written by a background thread via
+a QueueHandler/QueueListener pair, so request handlers never block on
+stdout. Supports per-module levels and sampled, rate-limited debug logs.
+
+Environment:
+    LOG_LEVEL              root level (default INFO)
+    LOG_LEVELS             per-module overrides, e.g. "main=DEBUG,sqlalchemy.engine=INFO"
+    LOG_FORMAT             "text" (default) or "json"
+    LOG_DEBUG_SAMPLE_RATE  fraction of DEBUG records kept (default 1.0)
+    LOG_DEBUG_RATE_LIMIT   max DEBUG records per second per call site (default 20, 0 = unlimited)
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Third-party loggers that are chatty at INFO
+DEFAULT_LEVELS = {
+    "sqlalchemy.engine": "WARNING",
+    "socketio": "WARNING",
+    "engineio": "WARNING",
+    "uvicorn.access": "WARNING",
+    "httpx": "WARNING",
+}
+
+# Attributes every LogRecord has; anything else came from `extra=`
+RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_lock = threading.Lock()
+
+def record_fields(record: logging.LogRecord) -> Dict:
+    return {key: value for key, value in vars(record).items() if key not in RESERVED_ATTRS}
+
+class TextFormatter(logging.Formatter):
+    """`time level logger message key=value ...`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        line = f"{timestamp} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        fields = record_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        payload.update(record_fields(record))
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+class SampledDebugFilter(logging.Filter):
+    """Keep a sample of DEBUG records and cap each call site to N per second"""
+
+    def __init__(self, sample_rate: float = 1.0, per_second: int = 0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.per_second = per_second
+        self.windows: Dict[tuple, list] = {}  # call site -> [window start, count]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.per_second <= 0:
+            return True
+
+        site = (record.name, record.lineno)
+        now = time.monotonic()
+        window = self.windows.get(site)
+        if window is None or now - window[0] >= 1.0:
+            self.windows[site] = [now, 1]
+            return True
+        window[1] += 1
+        return window[1] <= self.per_second
+
+def parse_levels(value: str) -> Dict[str, str]:
+    levels = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging():
+    """Route all logging through a background queue listener (idempotent)"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+
+        formatter = JsonFormatter() if os.getenv("LOG_FORMAT", "text").lower() == "json" else TextFormatter()
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(SampledDebugFilter(
+            float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0")),
+            int(os.getenv("LOG_DEBUG_RATE_LIMIT", "20"))
+        ))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+        levels = dict(DEFAULT_LEVELS)
+        levels.update(parse_levels(os.getenv("LOG_LEVELS", "")))
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
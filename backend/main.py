@@ -2,23 +2,56 @@
 Halloween Poe Chat - Main Backend Server
 A spooky chat application inspired by Edgar Allan Poe
 """
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import Awaitable, Callable, List, Optional, Dict, Tuple, Union
+from sqlalchemy import insert, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-import boto3
 import json
+import hmac
 import hashlib
 import time
 from datetime import datetime, timedelta
 import os
+import asyncio
+import logging
+import threading
 from dotenv import load_dotenv
-from database import get_db, User, ConnectionAttempt, Connection, Message, ChatRoom, create_tables
+from fastapi.concurrency import run_in_threadpool
+from database import get_engine, dispose_engine, get_db, get_read_db, get_user_read_db, primary_until_cookie, router, ReadYourWritesMiddleware, SessionLocal, User, ConnectionAttempt, Connection, Message, ChatRoom, ChatRoomMember, create_tables
+from group_rooms import GROUP_ROOM_MAX_MEMBERS, GroupFullError, find_group, create_group, add_members, load_members, groups_for_user
+from retention import MESSAGE_HISTORY_LIMIT, RETENTION_INTERVAL_MINUTES, run_retention
+from export import EXPORT_FORMATS, export_lines, gzip_chunks
+from search import search_messages, setup_search_index
+from logging_config import setup_logging
+from knowledge import get_knowledge_base
+from llm import LLMError, LLMGateway, BedrockLLM
+from answers import hash_answers, count_matching_answers
+from message_log import store_message, messages_after, normalize_client_id
+from message_spool import MessageSpool, DB_UNAVAILABLE, MESSAGE_SPOOL_REPLAY_SECONDS, new_provisional_id
+from cooldowns import CooldownScheduler, ATTEMPT_GC_INTERVAL_MINUTES, purge_stale_attempts
+from auth import AuthError, TokenClaims, AUTH_REQUIRED, AUTH_TOKEN_TTL, issue_token, verify_token, bearer_token
+from poem_pool import SkeletonPool, POEM_POOL_ENABLED, SKELETON_ANSWERS, SKELETON_INSTRUCTION, fill_skeleton
+from profiling import ProfilingMiddleware, ProfiledJSONResponse, PROFILING_ENABLED, ADMIN_TOKEN, profiles, get_profile
+from metrics import MetricsMiddleware, CONTENT_TYPE, METRICS_DIR, METRICS_FLUSH_SECONDS, render_metrics, metrics_allowed, write_snapshot
+from compression import CompressionMiddleware, RESPONSE_COMPRESSION
 
 load_dotenv()
+setup_logging()
+logger = logging.getLogger("main")
 
-app = FastAPI(title="Halloween Poe Chat API", version="2.0.0")
+# Dump every connection when a chat lookup misses (scans the whole table)
+DEBUG_CONNECTION_SCAN = os.getenv("DEBUG_CONNECTION_SCAN", "false").lower() == "true"
+# Batch endpoints: max items per request and concurrent poem/message generations per batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_GENERATION_CONCURRENCY = int(os.getenv("BATCH_GENERATION_CONCURRENCY", "16"))
+# Keeps IN (...) lists under SQLite's bound-parameter limit
+QUERY_CHUNK_SIZE = 500
+
+app = FastAPI(title="Halloween Poe Chat API", version="2.0.0", default_response_class=ProfiledJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -29,12 +62,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# AWS Bedrock client (optional)
+# Per-route latency and DB usage metrics
+app.add_middleware(MetricsMiddleware)
+
+# Read-your-writes cookie, so a client's reads after a write reach the primary on any worker
+app.add_middleware(ReadYourWritesMiddleware)
+
+# Opt-in per-request profiling (X-Profile header or PROFILE_SAMPLE_RATE)
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+# Opt-in Brotli/gzip compression of large responses
+if RESPONSE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware)
+
+# AWS Bedrock client (optional). boto3 is slow to import, so the client is
+# created on the first LLM call (or by /ready) rather than at startup.
 bedrock_client = None
 bedrock_available = False
+bedrock_initialized = False
+_bedrock_lock = threading.Lock()
 
 def initialize_bedrock():
-    global bedrock_client, bedrock_available
+    global bedrock_client, bedrock_available, bedrock_initialized
+    bedrock_initialized = True
     try:
         # Check if AWS credentials are available
         aws_access_key = os.getenv('AWS_ACCESS_KEY_ID')
@@ -42,9 +93,10 @@ def initialize_bedrock():
         aws_region = os.getenv('AWS_REGION', 'us-east-1')
         
         if not aws_access_key or not aws_secret_key:
-            print("AWS Bedrock: No credentials found in environment variables")
+            logger.info("AWS Bedrock: No credentials found in environment variables")
             return False
             
+        import boto3
         bedrock_client = boto3.client(
             'bedrock-runtime',
             region_name=aws_region,
@@ -56,20 +108,25 @@ def initialize_bedrock():
         try:
             # Try to invoke a simple test (this will fail if no access, but that's ok)
             bedrock_available = True
-            print("AWS Bedrock: Client initialized successfully")
+            logger.info("AWS Bedrock: Client initialized successfully", extra={"region": aws_region})
             return True
         except Exception as test_error:
-            print(f"AWS Bedrock: Connection test failed: {test_error}")
+            logger.warning("AWS Bedrock: Connection test failed", extra={"error": str(test_error)})
             bedrock_available = False
             return False
             
     except Exception as e:
-        print(f"AWS Bedrock: Initialization failed: {e}")
+        logger.warning("AWS Bedrock: Initialization failed", extra={"error": str(e)})
         bedrock_available = False
         return False
 
-# Initialize Bedrock
-initialize_bedrock()
+def get_bedrock_client():
+    """Return the Bedrock client, initializing it on first use (None if unavailable)"""
+    if not bedrock_initialized and bedrock_client is None:
+        with _bedrock_lock:
+            if not bedrock_initialized:
+                initialize_bedrock()
+    return bedrock_client if bedrock_available else None
 
 # Pydantic models
 class UserRegistration(BaseModel):
@@ -80,20 +137,131 @@ class UserRegistration(BaseModel):
 
 class ConnectionAttemptRequest(BaseModel):
     target_username: str
-    current_username: str  # Add current user identification
+    current_username: Optional[str] = None  # Not needed with a bearer token
     answers: List[str]
 
 class MessageData(BaseModel):
     content: str
     target_username: str
-    current_username: str  # Add current user identification
+    current_username: Optional[str] = None  # Not needed with a bearer token
+    client_id: Optional[Union[str, int]] = None  # Idempotency key: a retry with the same id returns the stored message
+
+class LoginRequest(BaseModel):
+    username: str
+    password: str
+
+class BatchRegistration(BaseModel):
+    users: List[UserRegistration]
+
+class BatchConnectionAttempts(BaseModel):
+    attempts: List[ConnectionAttemptRequest]
+
+class GroupCreation(BaseModel):
+    name: str
+    members: List[str] = []
+    current_username: Optional[str] = None  # Not needed with a bearer token
+
+class GroupMembers(BaseModel):
+    usernames: List[str]
+    current_username: Optional[str] = None  # Not needed with a bearer token
+
+# Response models: FastAPI validates and encodes these with pydantic instead of
+# walking plain dicts through jsonable_encoder
+class UserSummary(BaseModel):
+    id: int
+    username: str
+    poem: Optional[str] = None
+
+class ConnectedUser(BaseModel):
+    username: str
+
+class ChatMessage(BaseModel):
+    id: int
+    seq: Optional[int] = None
+    content: str
+    sender: str
+    timestamp: datetime
+
+class GroupSummary(BaseModel):
+    room_id: str
+    name: Optional[str] = None
+    members: int
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
-def generate_poe_poem(answers: List[str]) -> str:
-    """Generate a Poe-style poem from user answers"""
-    if bedrock_available and bedrock_client:
+def get_caller(authorization: Optional[str] = Header(None)) -> Optional[TokenClaims]:
+    """Identity from the bearer token; None when no token was sent (unless AUTH_REQUIRED)"""
+    try:
+        token = bearer_token(authorization)
+        if token is None:
+            if AUTH_REQUIRED:
+                raise HTTPException(status_code=401, detail="Authentication required")
+            return None
+        return verify_token(token)
+    except AuthError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+def caller_username(caller: Optional[TokenClaims], username: Optional[str]) -> str:
+    """Username the request acts as: the token holder's, else the one it names"""
+    if caller is not None:
+        if username and username != caller.username:
+            raise HTTPException(status_code=403, detail="Token does not belong to this user")
+        return caller.username
+    if not username:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return username
+
+def resolve_caller(db: Session, caller: Optional[TokenClaims], username: Optional[str]) -> Optional[Tuple[int, str]]:
+    """(user id, username) of the caller: from the token when there is one, else looked up by username"""
+    username = caller_username(caller, username)
+    if caller is not None:
+        return caller.user_id, caller.username
+    user = db.query(User.id, User.username).filter(User.username == username).first()
+    return (user.id, user.username) if user else None
+
+# Every model call goes through one gateway per process, which limits
+# in-flight requests and coalesces identical prompts
+llm_client = LLMGateway(BedrockLLM(get_bedrock_client))
+
+async def invoke_bedrock(model_id: str, body: str, kind: str) -> dict:
+    """Invoke a model through the shared gateway"""
+    return await llm_client.invoke(model_id, body, kind)
+
+def chunks(items: List, size: int = QUERY_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+async def gather_bounded(coroutines, limit: int) -> List:
+    """Await coroutines concurrently, at most `limit` at a time, keeping their order"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+def check_batch_size(items: List):
+    if not items:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {BATCH_MAX_ITEMS} items)")
+
+def count_correct_answers(answer_hashes: Optional[str], answers: List[str]) -> int:
+    """Count answers matching the user's stored answer hashes, ignoring case and whitespace"""
+    return count_matching_answers(answer_hashes or "", answers)
+
+async def generate_poe_poem(answers: List[str]) -> str:
+    """Fill a precomputed skeleton with the user's answers, or compose a poem on a pool miss"""
+    skeleton = poem_pool.take()
+    if skeleton:
+        return fill_skeleton(skeleton, answers)
+    return await compose_poe_poem(answers)
+
+async def compose_poe_poem(answers: List[str], templates: bool = True) -> str:
+    """Generate a Poe-style poem from user answers; with templates=False a model failure raises LLMError instead"""
+    if await llm_client.available():
         try:
             # Get the answers with fallbacks
             answer1 = answers[0] if len(answers) > 0 and answers[0].strip() else 'mystery'
@@ -109,6 +277,8 @@ The poem should be in Poe's style - dark, gothic, with themes of mystery, death,
 Make it cryptic so that someone familiar with these details could recognize them, but others would find it mysterious.
 Use 4-6 stanzas with 4 lines each. Include gothic imagery and Poe's characteristic rhythm.
 Do not include any explanations or meta-commentary, just the poem itself."""
+            if answers == SKELETON_ANSWERS:
+                prompt += SKELETON_INSTRUCTION
 
             # Try different Claude models
             models_to_try = [
@@ -142,13 +312,7 @@ Do not include any explanations or meta-commentary, just the poem itself."""
                             "top_p": 0.9
                         })
                     
-                    response = bedrock_client.invoke_model(
-                        modelId=model_id,
-                        body=body,
-                        contentType='application/json'
-                    )
-                    
-                    response_body = json.loads(response['body'].read())
+                    response_body = await invoke_bedrock(model_id, body, "poem")
                     
                     if 'claude-3' in model_id:
                         # Claude 3 response format
@@ -158,17 +322,19 @@ Do not include any explanations or meta-commentary, just the poem itself."""
                         poem = response_body.get('completion', '')
                     
                     if poem and len(poem.strip()) > 50:  # Ensure we got a substantial response
-                        print(f"AWS Bedrock: Successfully generated poem using {model_id}")
+                        logger.debug("AWS Bedrock: Generated poem", extra={"model": model_id})
                         return poem.strip()
                     
                 except Exception as model_error:
-                    print(f"AWS Bedrock: Model {model_id} failed: {model_error}")
+                    logger.warning("AWS Bedrock: Model failed", extra={"model": model_id, "error": str(model_error)})
                     continue
             
-            print("AWS Bedrock: All models failed, falling back to templates")
+            logger.warning("AWS Bedrock: All models failed, falling back to templates")
             
-        except Exception as e:
-            print(f"AWS Bedrock error: {e}")
+        except Exception:
+            logger.exception("AWS Bedrock error")
+    if not templates:
+        raise LLMError("No model text")
     
     # Enhanced fallback poem templates with better integration
     import random
@@ -292,9 +458,16 @@ Do not include any explanations or meta-commentary, just the poem itself."""
     
     return random.choice(poem_templates).strip()
 
-def generate_cryptic_message(answers: List[str]) -> str:
-    """Generate a cryptic message from answers"""
-    if bedrock_available and bedrock_client:
+async def generate_cryptic_message(answers: List[str]) -> str:
+    """Fill a precomputed skeleton with the answers, or compose a message on a pool miss"""
+    skeleton = cryptic_pool.take()
+    if skeleton:
+        return fill_skeleton(skeleton, answers)
+    return await compose_cryptic_message(answers)
+
+async def compose_cryptic_message(answers: List[str], templates: bool = True) -> str:
+    """Generate a cryptic message from answers; with templates=False a model failure raises LLMError instead"""
+    if await llm_client.available():
         try:
             # Get the answers with fallbacks
             answer1 = answers[0] if len(answers) > 0 and answers[0].strip() else 'mystery'
@@ -308,6 +481,8 @@ Make it sound like a mysterious riddle or warning from beyond the grave.
 Use gothic language and Poe's characteristic dark imagery.
 Keep it under 100 words but make it haunting and memorable.
 Do not include any explanations or meta-commentary, just the cryptic message itself."""
+            if answers == SKELETON_ANSWERS:
+                prompt += SKELETON_INSTRUCTION
 
             # Try different Claude models
             models_to_try = [
@@ -341,13 +516,7 @@ Do not include any explanations or meta-commentary, just the cryptic message its
                             "top_p": 0.9
                         })
                     
-                    response = bedrock_client.invoke_model(
-                        modelId=model_id,
-                        body=body,
-                        contentType='application/json'
-                    )
-                    
-                    response_body = json.loads(response['body'].read())
+                    response_body = await invoke_bedrock(model_id, body, "cryptic")
                     
                     if 'claude-3' in model_id:
                         # Claude 3 response format
@@ -357,17 +526,19 @@ Do not include any explanations or meta-commentary, just the cryptic message its
                         message = response_body.get('completion', '')
                     
                     if message and len(message.strip()) > 20:  # Ensure we got a substantial response
-                        print(f"AWS Bedrock: Successfully generated cryptic message using {model_id}")
+                        logger.debug("AWS Bedrock: Generated cryptic message", extra={"model": model_id})
                         return message.strip()
                     
                 except Exception as model_error:
-                    print(f"AWS Bedrock: Model {model_id} failed: {model_error}")
+                    logger.warning("AWS Bedrock: Model failed", extra={"model": model_id, "error": str(model_error)})
                     continue
             
-            print("AWS Bedrock: All models failed, falling back to templates")
+            logger.warning("AWS Bedrock: All models failed, falling back to templates")
             
-        except Exception as e:
-            print(f"AWS Bedrock error: {e}")
+        except Exception:
+            logger.exception("AWS Bedrock error")
+    if not templates:
+        raise LLMError("No model text")
     
     # Enhanced fallback cryptic messages
     import random
@@ -401,7 +572,189 @@ Do not include any explanations or meta-commentary, just the cryptic message its
     
     return random.choice(cryptic_templates)
 
+# Precomputed skeletons, refilled in the background (see poem_pool.py)
+poem_pool = SkeletonPool("poem", compose_poe_poem, lambda: llm_client.available())
+cryptic_pool = SkeletonPool("cryptic", compose_cryptic_message, lambda: llm_client.available())
+
+async def retention_loop():
+    """Periodically move expired messages into cold storage"""
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL_MINUTES * 60)
+        try:
+            summary = await run_in_threadpool(run_retention)
+            if summary:
+                logger.info("Retention: archived messages", extra={"messages": sum(summary.values()), "connections": len(summary)})
+        except Exception:
+            logger.exception("Retention error")
+
+# Active connection-attempt cooldowns; main_advanced adds the websocket push to its hooks
+cooldowns = CooldownScheduler()
+
+def load_cooldowns() -> int:
+    db = SessionLocal()
+    try:
+        return cooldowns.load(db)
+    finally:
+        db.close()
+
+def collect_stale_attempts() -> int:
+    db = SessionLocal()
+    try:
+        return purge_stale_attempts(db)
+    finally:
+        db.close()
+
+async def attempt_gc_loop():
+    """Periodically delete attempt rows that no longer hold a count or a cooldown"""
+    while True:
+        await asyncio.sleep(ATTEMPT_GC_INTERVAL_MINUTES * 60)
+        try:
+            deleted = await run_in_threadpool(collect_stale_attempts)
+            if deleted:
+                logger.info("Deleted stale connection attempts", extra={"rows": deleted})
+        except Exception:
+            logger.exception("Attempt cleanup error")
+
+@app.on_event("startup")
+async def start_cooldowns():
+    try:
+        loaded = await run_in_threadpool(load_cooldowns)
+        logger.info("Cooldowns loaded", extra={"count": loaded})
+    except Exception as e:
+        logger.warning("Could not load cooldowns", extra={"error": str(e)})
+    cooldowns.start()
+    if ATTEMPT_GC_INTERVAL_MINUTES > 0:
+        asyncio.create_task(attempt_gc_loop())
+
+@app.on_event("shutdown")
+async def stop_cooldowns():
+    cooldowns.stop()
+
+# Messages accepted while the database was unavailable, replayed in order once it is back
+message_spool = MessageSpool()
+
+async def spool_replay_loop():
+    """Retry the spooled messages until the database takes them"""
+    while True:
+        await asyncio.sleep(MESSAGE_SPOOL_REPLAY_SECONDS)
+        if not message_spool.pending():
+            continue
+        try:
+            stored = await run_in_threadpool(message_spool.replay)
+            if stored:
+                logger.info("Replayed spooled messages", extra={"messages": stored})
+        except Exception:
+            logger.exception("Spool replay error")
+
+@app.on_event("startup")
+async def start_message_spool():
+    if not message_spool.enabled:
+        return
+    claimed = await run_in_threadpool(message_spool.claim_orphans)
+    if claimed:
+        logger.warning("Spooled messages from a previous run will be replayed", extra={"files": claimed})
+    asyncio.create_task(spool_replay_loop())
+
+@app.on_event("shutdown")
+async def close_message_spool():
+    message_spool.close()
+
+@app.on_event("startup")
+async def start_retention():
+    if RETENTION_INTERVAL_MINUTES > 0:
+        asyncio.create_task(retention_loop())
+
+@app.on_event("startup")
+async def start_poem_pools():
+    if POEM_POOL_ENABLED:
+        poem_pool.start()
+        cryptic_pool.start()
+
+@app.on_event("shutdown")
+async def stop_poem_pools():
+    poem_pool.stop()
+    cryptic_pool.stop()
+
+async def metrics_flush_loop():
+    """Keep this worker's snapshot fresh for scrapes served by the other workers"""
+    while True:
+        try:
+            await run_in_threadpool(write_snapshot)
+        except Exception as e:
+            logger.warning("Could not write metrics snapshot", extra={"error": str(e)})
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+
+@app.on_event("startup")
+async def start_metrics_flush():
+    if METRICS_DIR:
+        asyncio.create_task(metrics_flush_loop())
+
+@app.on_event("shutdown")
+async def flush_metrics():
+    # Counters outlive the worker; its gauges describe connections that are gone
+    if METRICS_DIR:
+        write_snapshot(gauges=False)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.on_event("shutdown")
+async def close_database():
+    # Return pooled connections cleanly when a worker stops
+    dispose_engine()
+
 # API Endpoints
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request, authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint (METRICS_TOKEN as bearer token, or loopback only without one)"""
+    if not metrics_allowed(authorization, request.client.host if request.client else None):
+        raise HTTPException(status_code=403, detail="Metrics token required")
+    return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
+
+def check_database():
+    with get_engine().connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: warms the lazily created components and reports their state.
+
+    Only the database is required; Bedrock falls back to templates when unavailable.
+    """
+    components = {}
+    try:
+        await run_in_threadpool(check_database)
+        components["database"] = "ok"
+    except Exception as e:
+        logger.warning("Readiness: database unavailable", extra={"error": str(e)})
+        components["database"] = "unavailable"
+
+    knowledge_base = await run_in_threadpool(get_knowledge_base)
+    components["knowledge_base"] = "ok" if knowledge_base else "missing"
+    components["bedrock"] = "ok" if await llm_client.available() else "templates"
+
+    is_ready = components["database"] == "ok"
+    return JSONResponse(
+        {"status": "ready" if is_ready else "unavailable", "components": components},
+        status_code=200 if is_ready else 503
+    )
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    """Recent request profiles, newest first"""
+    return [profile.summary() for profile in reversed(profiles)]
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def read_profile(profile_id: str, format: str = "json"):
+    """A single profile; format=collapsed returns flame graph input"""
+    profile = get_profile(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return Response(profile.collapsed(), media_type="text/plain")
+    return profile.summary()
+
 @app.post("/register")
 async def register_user(user_data: UserRegistration, db: Session = Depends(get_db)):
     """Register a new user with their questions and answers"""
@@ -412,7 +765,7 @@ async def register_user(user_data: UserRegistration, db: Session = Depends(get_d
             raise HTTPException(status_code=400, detail="Username already exists")
         
         # Generate poem from answers
-        poem = generate_poe_poem(user_data.answers)
+        poem = await generate_poe_poem(user_data.answers)
         
         # Hash password
         password_hash = hash_password(user_data.password)
@@ -422,7 +775,8 @@ async def register_user(user_data: UserRegistration, db: Session = Depends(get_d
             username=user_data.username,
             password_hash=password_hash,
             questions=json.dumps(user_data.questions),
-            answers=json.dumps(user_data.answers),
+            answers="[]",
+            answer_hashes=hash_answers(user_data.answers),
             poem=poem
         )
         
@@ -433,21 +787,125 @@ async def register_user(user_data: UserRegistration, db: Session = Depends(get_d
         return {
             "message": "User registered successfully",
             "user_id": user.id,
-            "poem": poem
+            "poem": poem,
+            "access_token": issue_token(user.id, user.username)
         }
         
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/users")
-async def get_users(db: Session = Depends(get_db)):
+@app.post("/login")
+async def login(credentials: LoginRequest, db: Session = Depends(get_db)):
+    """Exchange a username and password for a signed session token"""
+    user = db.query(User.id, User.username, User.password_hash).filter(User.username == credentials.username).first()
+    if not user or not hmac.compare_digest(user.password_hash, hash_password(credentials.password)):
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    return {
+        "access_token": issue_token(user.id, user.username),
+        "token_type": "bearer",
+        "expires_in": AUTH_TOKEN_TTL,
+        "user_id": user.id,
+        "username": user.username
+    }
+
+def validate_registration(user_data: UserRegistration) -> Optional[str]:
+    if not user_data.username.strip():
+        return "Username is required"
+    if not user_data.password:
+        return "Password is required"
+    if not user_data.questions or len(user_data.answers) != len(user_data.questions):
+        return "Each question needs an answer"
+    return None
+
+@app.post("/register/batch", dependencies=[Depends(get_caller)])
+async def register_users_batch(batch: BatchRegistration, db: Session = Depends(get_db)):
+    """Register many users at once; every item gets its own result"""
+    check_batch_size(batch.users)
+    try:
+        # Validate the whole batch up front with one username lookup per chunk
+        usernames = list({user_data.username for user_data in batch.users})
+        existing = set()
+        for chunk in chunks(usernames):
+            existing.update(username for (username,) in db.query(User.username).filter(User.username.in_(chunk)))
+
+        results = [None] * len(batch.users)
+        valid, seen = [], set()
+        for index, user_data in enumerate(batch.users):
+            error = validate_registration(user_data)
+            if not error and user_data.username in existing:
+                error = "Username already exists"
+            elif not error and user_data.username in seen:
+                error = "Duplicate username in batch"
+            if error:
+                results[index] = {"index": index, "username": user_data.username, "status": 400, "success": False, "error": error}
+            else:
+                seen.add(user_data.username)
+                valid.append(index)
+
+        poems = await gather_bounded(
+            (generate_poe_poem(batch.users[index].answers) for index in valid), BATCH_GENERATION_CONCURRENCY
+        )
+
+        rows = [
+            {
+                "username": batch.users[index].username,
+                "password_hash": hash_password(batch.users[index].password),
+                "questions": json.dumps(batch.users[index].questions),
+                "answers": "[]",
+                "answer_hashes": hash_answers(batch.users[index].answers),
+                "poem": poem
+            }
+            for index, poem in zip(valid, poems)
+        ]
+        user_ids = []
+        if rows:
+            try:
+                user_ids = db.scalars(insert(User).returning(User.id, sort_by_parameter_order=True), rows).all()
+                db.commit()
+            except IntegrityError:
+                # A concurrent request took one of the usernames since the lookup: insert one at a time
+                db.rollback()
+                user_ids = []
+                for row in rows:
+                    try:
+                        user_ids.append(db.scalar(insert(User).returning(User.id), row))
+                        db.commit()
+                    except IntegrityError:
+                        db.rollback()
+                        user_ids.append(None)
+
+        for index, poem, user_id in zip(valid, poems, user_ids):
+            if user_id is None:
+                results[index] = {"index": index, "username": batch.users[index].username, "status": 409,
+                                  "success": False, "error": "Username already exists"}
+                continue
+            results[index] = {
+                "index": index,
+                "username": batch.users[index].username,
+                "status": 200,
+                "success": True,
+                "user_id": user_id,
+                "poem": poem
+            }
+
+        created = sum(1 for result in results if result["success"])
+        logger.info("Batch registration", extra={"registered": created, "rejected": len(results) - created})
+        return {"created": created, "failed": len(results) - created, "results": results}
+
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/users", response_model=List[UserSummary])
+async def get_users(db: Session = Depends(get_read_db)):
     """Get list of all users (for connection attempts)"""
     users = db.query(User).all()
     return [{"id": user.id, "username": user.username, "poem": user.poem} for user in users]
 
 @app.post("/attempt-connection")
-async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = Depends(get_db)):
+async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = Depends(get_db),
+                             caller: Optional[TokenClaims] = Depends(get_caller)):
     """Attempt to connect to another user by answering their questions"""
     try:
         # Get target user
@@ -455,14 +913,15 @@ async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = De
         if not target_user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get the current user by username
-        current_user = db.query(User).filter(User.username == attempt.current_username).first()
+        # Identify the current user (token, or lookup by username)
+        current_user = resolve_caller(db, caller, attempt.current_username)
         if not current_user:
             raise HTTPException(status_code=404, detail="Current user not found")
+        current_user_id = current_user[0]
         
         # Check cooldown
         attempt_record = db.query(ConnectionAttempt).filter(
-            ConnectionAttempt.user_id == current_user.id,
+            ConnectionAttempt.user_id == current_user_id,
             ConnectionAttempt.target_user_id == target_user.id
         ).first()
         
@@ -479,14 +938,12 @@ async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = De
                 attempt_record.cooldown_until = datetime.now() + timedelta(minutes=2)
                 attempt_record.attempts = 0
                 db.commit()
+                cooldowns.schedule(current_user_id, target_user.id, current_user[1], target_user.username,
+                                   attempt_record.cooldown_until)
                 raise HTTPException(status_code=429, detail="Too many attempts. 2-minute cooldown activated.")
         
         # Check answers
-        target_answers = json.loads(target_user.answers)
-        correct_answers = 0
-        for i, answer in enumerate(attempt.answers):
-            if i < len(target_answers) and answer.lower().strip() == target_answers[i].lower().strip():
-                correct_answers += 1
+        correct_answers = count_correct_answers(target_user.answer_hashes, attempt.answers)
         
         # Update attempt record
         if attempt_record:
@@ -494,7 +951,7 @@ async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = De
             attempt_record.last_attempt = datetime.now()
         else:
             attempt_record = ConnectionAttempt(
-                user_id=current_user.id,
+                user_id=current_user_id,
                 target_user_id=target_user.id,
                 attempts=1,
                 last_attempt=datetime.now()
@@ -504,23 +961,29 @@ async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = De
         db.commit()
         
         # Generate cryptic message
-        cryptic_message = generate_cryptic_message(attempt.answers)
+        cryptic_message = await generate_cryptic_message(attempt.answers)
         
         if correct_answers == 3:
             # All answers correct - create connection
             # Check if connection already exists
             existing_connection = db.query(Connection).filter(
-                ((Connection.user1_id == current_user.id) & (Connection.user2_id == target_user.id)) |
-                ((Connection.user1_id == target_user.id) & (Connection.user2_id == current_user.id))
+                ((Connection.user1_id == current_user_id) & (Connection.user2_id == target_user.id)) |
+                ((Connection.user1_id == target_user.id) & (Connection.user2_id == current_user_id))
             ).first()
             
             if not existing_connection:
-                connection = Connection(user1_id=current_user.id, user2_id=target_user.id)
+                connection = Connection(user1_id=current_user_id, user2_id=target_user.id)
                 db.add(connection)
                 db.commit()
-                print(f"✅ Connection created between {current_user.username} (ID: {current_user.id}) and {target_user.username} (ID: {target_user.id})")
+                router.mark_write(current_user_id, target_user.id)
+                logger.info("Connection created", extra={"user_id": current_user_id, "target_user_id": target_user.id})
+            elif existing_connection.is_active is False:
+                existing_connection.is_active = True
+                db.commit()
+                router.mark_write(current_user_id, target_user.id)
+                logger.info("Connection reactivated", extra={"user_id": current_user_id, "target_user_id": target_user.id})
             else:
-                print(f"✅ Connection already exists between {current_user.username} and {target_user.username}")
+                logger.debug("Connection already exists", extra={"user_id": current_user_id, "target_user_id": target_user.id})
             
             return {
                 "success": True,
@@ -543,11 +1006,128 @@ async def attempt_connection(attempt: ConnectionAttemptRequest, db: Session = De
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/connections/{user_id}")
-async def get_connections(user_id: int, db: Session = Depends(get_db)):
+@app.post("/attempt-connection/batch")
+async def attempt_connections_batch(batch: BatchConnectionAttempts, db: Session = Depends(get_db),
+                                   caller: Optional[TokenClaims] = Depends(get_caller)):
+    """Process many connection attempts in order; same rules as /attempt-connection, one result per item"""
+    check_batch_size(batch.attempts)
+    try:
+        # Who makes each attempt: the token holder, or (without a token) the username in the item
+        acting = []
+        for attempt in batch.attempts:
+            try:
+                acting.append(caller_username(caller, attempt.current_username))
+            except HTTPException as e:
+                acting.append(e)
+
+        # Load every user, attempt record and connection the batch touches up front
+        usernames = list({attempt.target_username for attempt in batch.attempts} |
+                         {name for name in acting if isinstance(name, str)})
+        users = {}
+        for chunk in chunks(usernames):
+            users.update((user.username, user) for user in db.query(User).filter(User.username.in_(chunk)))
+
+        user_ids = [user.id for user in users.values()]
+        records = {}
+        connected = {}  # frozenset of user ids -> Connection
+        for chunk in chunks(user_ids):
+            for record in db.query(ConnectionAttempt).filter(ConnectionAttempt.user_id.in_(chunk)):
+                records[(record.user_id, record.target_user_id)] = record
+            for connection in db.query(Connection).filter(
+                Connection.user1_id.in_(chunk) | Connection.user2_id.in_(chunk)
+            ):
+                connected[frozenset((connection.user1_id, connection.user2_id))] = connection
+
+        results = []
+        answered = []  # (result, answers) that still need a cryptic message
+        started = []  # (user, target user, until) for cooldowns this batch begins
+        connected_now = set()  # pairs this batch connects or reconnects
+        now = datetime.now()
+        for index, (attempt, username) in enumerate(zip(batch.attempts, acting)):
+            if isinstance(username, HTTPException):
+                results.append({"index": index, "status": username.status_code, "success": False, "error": username.detail})
+                continue
+            target_user = users.get(attempt.target_username)
+            current_user = users.get(username)
+            if current_user and caller is not None and current_user.id != caller.user_id:
+                current_user = None
+            if not target_user or not current_user:
+                detail = "User not found" if not target_user else "Current user not found"
+                results.append({"index": index, "status": 404, "success": False, "error": detail})
+                continue
+
+            key = (current_user.id, target_user.id)
+            attempt_record = records.get(key)
+            if attempt_record:
+                if attempt_record.cooldown_until and attempt_record.cooldown_until > now:
+                    remaining_time = attempt_record.cooldown_until - now
+                    results.append({"index": index, "status": 429, "success": False,
+                                    "error": f"Cooldown active. Try again in {remaining_time.seconds} seconds"})
+                    continue
+                if attempt_record.attempts >= 5:
+                    attempt_record.cooldown_until = now + timedelta(minutes=2)
+                    attempt_record.attempts = 0
+                    started.append((current_user, target_user, attempt_record.cooldown_until))
+                    results.append({"index": index, "status": 429, "success": False,
+                                    "error": "Too many attempts. 2-minute cooldown activated."})
+                    continue
+
+            correct_answers = count_correct_answers(target_user.answer_hashes, attempt.answers)
+
+            if attempt_record:
+                attempt_record.attempts += 1
+                attempt_record.last_attempt = now
+            else:
+                attempt_record = ConnectionAttempt(
+                    user_id=current_user.id,
+                    target_user_id=target_user.id,
+                    attempts=1,
+                    last_attempt=now
+                )
+                db.add(attempt_record)
+                records[key] = attempt_record
+
+            result = {"index": index, "status": 200, "success": correct_answers == 3, "correct_answers": correct_answers}
+            if correct_answers == 3:
+                pair = frozenset(key)
+                if pair not in connected:
+                    connected[pair] = Connection(user1_id=current_user.id, user2_id=target_user.id)
+                    db.add(connected[pair])
+                    connected_now.add(pair)
+                elif connected[pair].is_active is False:
+                    connected[pair].is_active = True
+                    connected_now.add(pair)
+                result["message"] = "Connection successful! You can now chat."
+            else:
+                result["message"] = f"Only {correct_answers}/3 answers correct. Try again."
+                result["pitch_level"] = "high" if correct_answers >= 2 else "low"
+            results.append(result)
+            answered.append((result, attempt.answers))
+
+        db.commit()
+        for pair in connected_now:
+            router.mark_write(*pair)
+        for current_user, target_user, until in started:
+            cooldowns.schedule(current_user.id, target_user.id, current_user.username, target_user.username, until)
+
+        messages = await gather_bounded(
+            (generate_cryptic_message(answers) for _, answers in answered), BATCH_GENERATION_CONCURRENCY
+        )
+        for (result, _), cryptic_message in zip(answered, messages):
+            result["cryptic_message"] = cryptic_message
+
+        return {"results": results}
+
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/connections/{user_id}", response_model=List[ConnectedUser])
+async def get_connections(user_id: int, db: Session = Depends(get_user_read_db)):
     """Get user's connections"""
     connections = db.query(Connection).filter(
-        (Connection.user1_id == user_id) | (Connection.user2_id == user_id)
+        (Connection.user1_id == user_id) | (Connection.user2_id == user_id),
+        Connection.is_active.isnot(False)
     ).all()
     
     connected_users = []
@@ -559,47 +1139,107 @@ async def get_connections(user_id: int, db: Session = Depends(get_db)):
     
     return connected_users
 
-@app.get("/messages/{user_id}/{target_username}")
-async def get_messages(user_id: int, target_username: str, db: Session = Depends(get_db)):
-    """Get messages between two users"""
-    print(f"🔍 Getting messages for user {user_id} with {target_username}")
-    
+@app.get("/messages/{user_id}/{target_username}", response_model=List[ChatMessage])
+async def get_messages(user_id: int, target_username: str, limit: Optional[int] = Query(None, ge=1), before_id: Optional[int] = None,
+                       after_seq: Optional[int] = None, db: Session = Depends(get_user_read_db),
+                       caller: Optional[TokenClaims] = Depends(get_caller)):
+    """Get the most recent messages between two users (use before_id to page further back).
+
+    after_seq resumes a sync instead: the oldest `limit` messages after that seq, so a
+    reconnecting client fetches only the gap (repeat with the last seq until the page is short).
+    """
+    if caller is not None and caller.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
     target_user = db.query(User).filter(User.username == target_username).first()
     if not target_user:
-        print(f"❌ Target user {target_username} not found")
+        logger.debug("Target user not found", extra={"user_id": user_id, "target_username": target_username})
         raise HTTPException(status_code=404, detail="User not found")
     
-    print(f"✅ Target user found: {target_user.username} (ID: {target_user.id})")
-    
     connection = db.query(Connection).filter(
         ((Connection.user1_id == user_id) & (Connection.user2_id == target_user.id)) |
         ((Connection.user1_id == target_user.id) & (Connection.user2_id == user_id))
     ).first()
     
     if not connection:
-        print(f"❌ No connection found between user {user_id} and {target_user.id}")
-        # Let's check what connections exist
-        all_connections = db.query(Connection).all()
-        print(f"📊 All connections in database:")
-        for conn in all_connections:
-            print(f"   - Connection {conn.id}: User {conn.user1_id} <-> User {conn.user2_id}")
+        logger.debug("No connection found", extra={"user_id": user_id, "target_user_id": target_user.id})
+        if DEBUG_CONNECTION_SCAN:
+            connections = [(conn.id, conn.user1_id, conn.user2_id) for conn in db.query(Connection).all()]
+            logger.debug("Existing connections", extra={"connections": connections})
         raise HTTPException(status_code=404, detail="No connection found")
     
-    print(f"✅ Connection found: ID {connection.id}")
-    
-    messages = db.query(Message).filter(Message.connection_id == connection.id).order_by(Message.timestamp).all()
-    print(f"📬 Found {len(messages)} messages")
+    limit = min(limit or MESSAGE_HISTORY_LIMIT, MESSAGE_HISTORY_LIMIT)
+    if after_seq is not None:
+        messages = messages_after(db, connection.id, after_seq, limit)
+    else:
+        query = db.query(Message).filter(Message.connection_id == connection.id)
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        # Newest page first, then flip back into chronological order
+        messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+        messages.reverse()
+    logger.debug("Messages loaded", extra={"connection_id": connection.id, "count": len(messages)})
     
     return [
         {
             "id": msg.id,
+            "seq": msg.seq,
             "content": msg.content,
             "sender": msg.sender.username,
-            "timestamp": msg.timestamp.isoformat()
+            "timestamp": msg.timestamp
         }
         for msg in messages
     ]
 
+def stream_export(user_id: int, connection_id: int, usernames: Dict[int, str], primary_until: Optional[float] = None):
+    """export_lines with a session of its own, held for as long as the response streams"""
+    db = router.read_session(user_id, primary_until)
+    try:
+        yield from export_lines(db, connection_id, usernames)
+    finally:
+        db.close()
+
+@app.get("/messages/{user_id}/{target_username}/export")
+async def export_messages(user_id: int, target_username: str, format: str = "ndjson", db: Session = Depends(get_user_read_db),
+                          caller: Optional[TokenClaims] = Depends(get_caller),
+                          primary_until: Optional[float] = Depends(primary_until_cookie)):
+    """Download the whole conversation, archived messages included, as NDJSON (format=gzip compresses it)"""
+    if caller is not None and caller.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format (use {', '.join(EXPORT_FORMATS)})")
+    user = db.query(User).filter(User.id == user_id).first()
+    target_user = db.query(User).filter(User.username == target_username).first()
+    if not user or not target_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    connection = db.query(Connection).filter(
+        ((Connection.user1_id == user_id) & (Connection.user2_id == target_user.id)) |
+        ((Connection.user1_id == target_user.id) & (Connection.user2_id == user_id))
+    ).first()
+    if not connection:
+        raise HTTPException(status_code=404, detail="No connection found")
+    
+    # The rows are read while the response is sent, from a generator Starlette runs in a worker thread
+    chunks = stream_export(user_id, connection.id, {user.id: user.username, target_user.id: target_user.username}, primary_until)
+    media_type, extension = EXPORT_FORMATS[format]
+    if format == "gzip":
+        chunks = gzip_chunks(chunks)
+    logger.info("Conversation export started", extra={"connection_id": connection.id, "user_id": user_id, "format": format})
+    return StreamingResponse(chunks, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="conversation-{connection.id}.{extension}"'
+    })
+
+@app.get("/search/{user_id}")
+async def search(user_id: int, q: str, page: int = 1, page_size: int = 20, db: Session = Depends(get_db),
+                 caller: Optional[TokenClaims] = Depends(get_caller)):
+    """Full-text search over messages in the user's connections"""
+    if caller is not None and caller.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
+    try:
+        return search_messages(db, user_id, q, page, page_size)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/create-connection")
 async def create_connection(user1_username: str, user2_username: str, db: Session = Depends(get_db)):
     """Manually create a connection between two users (for testing)"""
@@ -630,8 +1270,9 @@ async def create_connection(user1_username: str, user2_username: str, db: Sessio
         db.add(connection)
         db.commit()
         db.refresh(connection)
+        router.mark_write(user1.id, user2.id)
         
-        print(f"✅ Manual connection created: {user1_username} (ID: {user1.id}) <-> {user2_username} (ID: {user2.id})")
+        logger.info("Manual connection created", extra={"user_id": user1.id, "target_user_id": user2.id})
         
         return {
             "message": f"Connection created between {user1_username} and {user2_username}",
@@ -646,52 +1287,177 @@ async def create_connection(user1_username: str, user2_username: str, db: Sessio
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+# Called with the connection id after a connection is deactivated (main_advanced
+# registers the websocket server's room revocation here)
+connection_deactivated_hooks: List[Callable[[int], Awaitable]] = []
+
+@app.post("/connections/{connection_id}/deactivate")
+async def deactivate_connection(connection_id: int, current_username: Optional[str] = None, db: Session = Depends(get_db),
+                                caller: Optional[TokenClaims] = Depends(get_caller)):
+    """End a connection: its chat room closes and the two users can no longer message"""
+    user = resolve_caller(db, caller, current_username)
+    connection = db.query(Connection).filter(Connection.id == connection_id).first()
+    if not connection:
+        raise HTTPException(status_code=404, detail="No connection found")
+    if not user or user[0] not in (connection.user1_id, connection.user2_id):
+        raise HTTPException(status_code=403, detail="Not part of this connection")
+    
+    connection.is_active = False
+    db.commit()
+    router.mark_write(connection.user1_id, connection.user2_id)
+    logger.info("Connection deactivated", extra={"connection_id": connection_id, "user_id": user[0]})
+    for hook in connection_deactivated_hooks:
+        await hook(connection_id)
+    return {"message": "Connection deactivated", "connection_id": connection_id}
+
 @app.post("/send-message")
-async def send_message(message_data: MessageData, db: Session = Depends(get_db)):
+async def send_message(message_data: MessageData, db: Session = Depends(get_db),
+                       caller: Optional[TokenClaims] = Depends(get_caller)):
     """Send a message between connected users"""
+    # Spooled messages go first, so nothing overtakes them while they are replayed
+    if message_spool.enabled and message_spool.pending():
+        return await spool_message(message_data, caller)
     try:
-        # Get users
-        sender_user = db.query(User).filter(User.username == message_data.current_username).first()
+        # Get users (the sender comes from the token when there is one)
+        sender = resolve_caller(db, caller, message_data.current_username)
         target_user = db.query(User).filter(User.username == message_data.target_username).first()
         
-        if not sender_user or not target_user:
+        if not sender or not target_user:
             raise HTTPException(status_code=404, detail="User not found")
+        sender_id, sender_username = sender
         
         # Find connection
         connection = db.query(Connection).filter(
-            ((Connection.user1_id == sender_user.id) & (Connection.user2_id == target_user.id)) |
-            ((Connection.user1_id == target_user.id) & (Connection.user2_id == sender_user.id))
+            ((Connection.user1_id == sender_id) & (Connection.user2_id == target_user.id)) |
+            ((Connection.user1_id == target_user.id) & (Connection.user2_id == sender_id)),
+            Connection.is_active.isnot(False)
         ).first()
         
         if not connection:
             raise HTTPException(status_code=404, detail="No connection found")
         
-        # Create message
-        message = Message(
-            connection_id=connection.id,
-            sender_id=sender_user.id,
-            content=message_data.content
-        )
-        
-        db.add(message)
-        db.commit()
-        db.refresh(message)
+        # Create message (or return the one a previous attempt with this client_id stored)
+        message, created = store_message(db, connection.id, sender_id, message_data.content,
+                                         normalize_client_id(message_data.client_id))
+        router.mark_write(sender_id)
         
         return {
             "id": message.id,
+            "seq": message.seq,
+            "client_id": message.client_id,
             "content": message.content,
-            "sender": sender_user.username,
-            "timestamp": message.timestamp.isoformat()
+            "sender": sender_username,
+            "timestamp": message.timestamp.isoformat(),
+            "duplicate": not created
         }
         
     except HTTPException:
         raise
+    except DB_UNAVAILABLE as e:
+        db.rollback()
+        if not message_spool.enabled:
+            raise HTTPException(status_code=500, detail=str(e))
+        logger.warning("Database unavailable, spooling message", extra={"error": str(e)})
+        return await spool_message(message_data, caller)
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+async def spool_message(message_data: MessageData, caller: Optional[TokenClaims]) -> JSONResponse:
+    """Accept a message into the spool; 202 with a provisional id once it is on disk.
+
+    The users and their connection are checked when it is replayed.
+    """
+    if caller is not None and message_data.current_username and message_data.current_username != caller.username:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
+    sender = caller.username if caller is not None else message_data.current_username
+    if not sender:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    provisional_id = new_provisional_id()
+    client_id = normalize_client_id(message_data.client_id) or provisional_id
+    timestamp = datetime.utcnow()
+    await message_spool.append({
+        "provisional_id": provisional_id,
+        "sender_id": caller.user_id if caller is not None else None,
+        "sender": sender,
+        "target": message_data.target_username,
+        "content": message_data.content,
+        "client_id": client_id,
+        "timestamp": timestamp.isoformat()
+    })
+    return JSONResponse(status_code=202, content={
+        "id": None,
+        "seq": None,
+        "provisional_id": provisional_id,
+        "client_id": client_id,
+        "content": message_data.content,
+        "sender": sender,
+        "timestamp": timestamp.isoformat(),
+        "spooled": True
+    })
+
+def group_for_member(db: Session, room_id: str, user_id: int) -> ChatRoom:
+    """The group, if the user is one of its members (404/403 otherwise)"""
+    room = find_group(db, room_id)
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if not db.query(ChatRoomMember.id).filter(ChatRoomMember.chat_room_id == room.id, ChatRoomMember.user_id == user_id).first():
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    return room
+
+@app.post("/rooms")
+async def create_room(group: GroupCreation, db: Session = Depends(get_db),
+                      caller: Optional[TokenClaims] = Depends(get_caller)):
+    """Create a group chat with the caller and the listed members"""
+    creator = resolve_caller(db, caller, group.current_username)
+    if not creator:
+        raise HTTPException(status_code=404, detail="User not found")
+    if not group.name.strip():
+        raise HTTPException(status_code=400, detail="Room name is required")
+    if len(group.members) >= GROUP_ROOM_MAX_MEMBERS:
+        raise HTTPException(status_code=413, detail=f"Group is limited to {GROUP_ROOM_MAX_MEMBERS} members")
+    
+    room = create_group(db, creator[0], group.name.strip()[:100])
+    added, missing = add_members(db, room.id, group.members)
+    logger.info("Group room created", extra={"user_id": creator[0], "room_id": room.room_id, "members": len(added) + 1})
+    return {"room_id": room.room_id, "name": room.name, "added": added, "missing": missing}
+
+@app.post("/rooms/{room_id}/members")
+async def add_room_members(room_id: str, members: GroupMembers, db: Session = Depends(get_db),
+                           caller: Optional[TokenClaims] = Depends(get_caller)):
+    """Add users to a group (any member can invite)"""
+    user = resolve_caller(db, caller, members.current_username)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    room = group_for_member(db, room_id, user[0])
+    try:
+        added, missing = add_members(db, room.id, members.usernames)
+    except GroupFullError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {"room_id": room_id, "added": added, "missing": missing}
+
+@app.get("/rooms", response_model=List[GroupSummary])
+async def get_rooms(current_username: Optional[str] = None, db: Session = Depends(get_db),
+                    caller: Optional[TokenClaims] = Depends(get_caller)):
+    """The caller's group rooms"""
+    user = resolve_caller(db, caller, current_username)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return groups_for_user(db, user[0])
+
+@app.get("/rooms/{room_id}/members", response_model=List[ConnectedUser])
+async def get_room_members(room_id: str, current_username: Optional[str] = None, db: Session = Depends(get_db),
+                           caller: Optional[TokenClaims] = Depends(get_caller)):
+    """Usernames in a group (members only)"""
+    user = resolve_caller(db, caller, current_username)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    room = group_for_member(db, room_id, user[0])
+    return [{"username": username} for username in sorted(load_members(db, room.id))]
+
 if __name__ == "__main__":
     import uvicorn
     # Create tables if they don't exist
     create_tables()
+    setup_search_index()
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,18 @@
+"""
+Halloween Poe Chat - Combined ASGI Application
+Serves the REST API and Socket.IO from one process, so both share the
+database pool, caches and metrics. Socket.IO handles /socket.io/ and
+everything else goes to FastAPI (lifespan events included).
+
+Run with: python serve.py (add --workers N with SOCKETIO_REDIS_URL set)
+"""
+import socketio
+from main import app, connection_deactivated_hooks, cooldowns
+from websocket_server import sio, revoke_connection, notify_cooldown_expired
+
+# Deactivating a connection closes its chat room in this process right away
+connection_deactivated_hooks.append(revoke_connection)
+# Clients watching a user's cooldowns hear when each one ends
+cooldowns.hooks.append(notify_cooldown_expired)
+
+socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
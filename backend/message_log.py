@@ -0,0 +1,74 @@
+"""
+Ordered, idempotent message writes for Halloween Poe Chat
+Every message gets a per-connection sequence number (1, 2, 3...) taken
+from connections.last_seq, so clients can ask for "everything after seq N"
+when they reconnect instead of re-downloading the history. Senders can
+attach an idempotency key (the client's message id): retrying a send with
+the same key returns the stored message rather than writing it twice.
+"""
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import Connection, Message
+
+# Longest idempotency key stored (Message.client_id)
+CLIENT_ID_MAX_LENGTH = 64
+
+def normalize_client_id(value) -> Optional[str]:
+    """Client message ids arrive as numbers (Date.now()) or strings"""
+    if value is None or value == "" or isinstance(value, bool):
+        return None
+    return str(value)[:CLIENT_ID_MAX_LENGTH]
+
+def find_by_client_id(db: Session, connection_id: int, sender_id: int, client_id: str) -> Optional[Message]:
+    return db.query(Message).filter(
+        Message.connection_id == connection_id,
+        Message.sender_id == sender_id,
+        Message.client_id == client_id
+    ).first()
+
+def store_message(db: Session, connection_id: int, sender_id: int, content: str,
+                  client_id: Optional[str] = None, timestamp: Optional[datetime] = None) -> Tuple[Message, bool]:
+    """Write a message with the next seq, or return the one already stored under client_id.
+
+    timestamp defaults to now (replayed messages keep the time they were sent).
+    Returns (message, created) and commits.
+    """
+    # Taking the next seq locks the connection row until commit, so concurrent
+    # retries of the same key are serialized before the duplicate check below
+    seq = db.execute(
+        update(Connection)
+        .where(Connection.id == connection_id)
+        .values(last_seq=func.coalesce(Connection.last_seq, 0) + 1)
+        .returning(Connection.last_seq)
+    ).scalar_one()
+
+    if client_id is not None:
+        existing = find_by_client_id(db, connection_id, sender_id, client_id)
+        if existing is not None:
+            db.rollback()
+            return existing, False
+
+    message = Message(connection_id=connection_id, sender_id=sender_id, content=content, seq=seq, client_id=client_id)
+    if timestamp is not None:
+        message.timestamp = timestamp
+    db.add(message)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = find_by_client_id(db, connection_id, sender_id, client_id) if client_id is not None else None
+        if existing is None:
+            raise
+        return existing, False
+    db.refresh(message)
+    return message, True
+
+def messages_after(db: Session, connection_id: int, after_seq: int, limit: int) -> List[Message]:
+    """Up to `limit` messages with seq > after_seq, oldest first"""
+    return db.query(Message).filter(
+        Message.connection_id == connection_id,
+        Message.seq > after_seq
+    ).order_by(Message.seq).limit(limit).all()
@@ -0,0 +1,276 @@
+"""
+Message spool for Halloween Poe Chat
+When the database cannot take a write (it is down, or the pool times out),
+/send-message appends the message to a local log instead of failing, and
+acknowledges it with a provisional id once the log is fsynced. Appends
+that arrive together share one fsync. A background loop replays the log
+into the messages table in order when the database is back; while anything
+is still spooled, new sends queue behind it so a conversation keeps its
+order.
+
+Replays are idempotent: each record is stored with its client id (the
+provisional id when the client sent none) as the idempotency key, see
+message_log.store_message. A crash part-way through a replay just repeats
+it without duplicating anything. A torn last line, left by a crash while
+appending, was never acknowledged and is ignored. A record the database
+rejects for any reason other than being unavailable is moved to
+dead-letter.jsonl in the spool directory so it cannot hold up the rest.
+
+Each process appends to its own file (messages-<random>.log, held with
+flock). The next process to start claims and replays files whose owner
+died.
+
+Environment:
+    MESSAGE_SPOOL_DIR              where spool files live (default message_spool next to this module, "" = disabled)
+    MESSAGE_SPOOL_FSYNC_MS         how long an append waits to share its fsync with others (default 2)
+    MESSAGE_SPOOL_REPLAY_SECONDS   how often a pending spool is retried (default 2)
+"""
+import os
+import json
+import uuid
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError
+from sqlalchemy.orm import Session
+from database import SessionLocal, User, Connection
+from message_log import store_message
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so spool directories must not be shared between processes
+    fcntl = None
+
+MESSAGE_SPOOL_DIR = os.getenv("MESSAGE_SPOOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "message_spool"))
+MESSAGE_SPOOL_FSYNC_MS = float(os.getenv("MESSAGE_SPOOL_FSYNC_MS", "2"))
+MESSAGE_SPOOL_REPLAY_SECONDS = float(os.getenv("MESSAGE_SPOOL_REPLAY_SECONDS", "2"))
+
+# Errors that mean the database is unreachable rather than the request being wrong
+DB_UNAVAILABLE = (OperationalError, InterfaceError, TimeoutError)
+
+DEAD_LETTER_FILE = "dead-letter.jsonl"
+
+logger = logging.getLogger("message_spool")
+
+def new_provisional_id() -> str:
+    return f"spool-{uuid.uuid4().hex}"
+
+def try_lock(file) -> bool:
+    """Take the file's exclusive flock without waiting"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+class Segment:
+    """One spool file: bytes of complete records in it, and how far it has been replayed"""
+
+    def __init__(self, path: str, file, size: int = 0, owned: bool = False):
+        self.path = path
+        self.file = file
+        self.size = size
+        self.offset = 0
+        self.owned = owned  # this process appends to it
+
+    def pending(self) -> bool:
+        return self.offset < self.size
+
+    def read(self) -> List[Tuple[int, Dict]]:
+        """(end offset, record) for every complete record not yet replayed"""
+        self.file.seek(self.offset)
+        data = self.file.read(self.size - self.offset)
+        records = []
+        end = self.offset
+        for line in data.split(b"\n")[:-1]:
+            end += len(line) + 1
+            try:
+                records.append((end, json.loads(line)))
+            except ValueError:
+                logger.warning("Unreadable spool record skipped", extra={"path": self.path, "offset": end})
+        return records
+
+def complete_size(file) -> int:
+    """Bytes up to the end of the last complete line (a crash can leave half a record)"""
+    end = file.seek(0, os.SEEK_END)
+    while end > 0:
+        start = max(0, end - 4096)
+        file.seek(start)
+        newline = file.read(end - start).rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+def replay_record(db: Session, record: Dict) -> bool:
+    """Store one spooled message; False when it was already stored or can no longer be delivered"""
+    sender_id = record.get("sender_id")
+    if sender_id is None:
+        sender_id = db.query(User.id).filter(User.username == record["sender"]).scalar()
+    target_id = db.query(User.id).filter(User.username == record["target"]).scalar()
+    connection = None
+    if sender_id is not None and target_id is not None:
+        connection = db.query(Connection).filter(
+            ((Connection.user1_id == sender_id) & (Connection.user2_id == target_id)) |
+            ((Connection.user1_id == target_id) & (Connection.user2_id == sender_id)),
+            Connection.is_active.isnot(False)
+        ).first()
+    if connection is None:
+        logger.warning("Spooled message dropped: no connection", extra={
+            "provisional_id": record["provisional_id"], "sender": record["sender"], "target": record["target"]})
+        return False
+    _, created = store_message(db, connection.id, sender_id, record["content"], record["client_id"],
+                               timestamp=datetime.fromisoformat(record["timestamp"]))
+    return created
+
+class MessageSpool:
+    """Append-only, fsync-batched log of messages waiting for the database"""
+
+    def __init__(self, directory: str = MESSAGE_SPOOL_DIR, fsync_ms: float = MESSAGE_SPOOL_FSYNC_MS):
+        self.directory = directory
+        self.fsync_delay = fsync_ms / 1000
+        self.segments: List[Segment] = []  # replay order: claimed files first, then our own
+        self.active: Optional[Segment] = None
+        self.lock = threading.Lock()  # file positions and sizes
+        self.replay_lock = threading.Lock()  # one replay at a time
+        self.written = 0  # records appended by this process
+        self.synced = 0  # of those, records known to be on disk
+        self.sync_task: Optional[asyncio.Future] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def pending(self) -> bool:
+        return any(segment.pending() for segment in self.segments)
+
+    def open(self):
+        """Start this process's spool file"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"messages-{uuid.uuid4().hex[:12]}.log")
+        file = open(path, "a+b")
+        try_lock(file)
+        self.active = Segment(path, file, owned=True)
+        self.segments.append(self.active)
+
+    def claim_orphans(self) -> int:
+        """Take over spool files left by processes that died; returns how many have records"""
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        ours = {segment.path for segment in self.segments}
+        claimed = 0
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".log")]
+        for path in sorted(paths, key=os.path.getmtime):
+            if path in ours:
+                continue
+            file = open(path, "r+b")
+            if not try_lock(file):
+                file.close()  # a live process still owns it
+                continue
+            segment = Segment(path, file, complete_size(file))
+            with self.lock:
+                if not segment.pending():
+                    self.remove(segment)
+                    continue
+                self.segments.insert(len(self.segments) - (self.active is not None), segment)
+            claimed += 1
+        return claimed
+
+    def write(self, record: Dict) -> int:
+        line = json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self.lock:
+            if self.active is None:
+                self.open()
+            self.active.file.write(line)
+            self.active.file.flush()
+            self.active.size += len(line)
+            self.written += 1
+            return self.written
+
+    async def append(self, record: Dict):
+        """Write a record and return once it is on disk"""
+        target = self.write(record)
+        while self.synced < target:
+            if self.sync_task is None:
+                self.sync_task = asyncio.ensure_future(self.sync())
+            await asyncio.shield(self.sync_task)
+
+    async def sync(self):
+        try:
+            # Let appends arriving meanwhile share this fsync
+            await asyncio.sleep(self.fsync_delay)
+            written = self.written
+            await run_in_threadpool(os.fsync, self.active.file.fileno())
+            self.synced = max(self.synced, written)
+        finally:
+            self.sync_task = None
+
+    def replay(self, session_factory: Callable[[], Session] = SessionLocal) -> int:
+        """Store spooled messages in order until none are left or the database fails again.
+
+        Returns how many messages were stored.
+        """
+        stored = 0
+        with self.replay_lock:
+            while True:
+                with self.lock:
+                    batches = [(segment, segment.read()) for segment in self.segments if segment.pending()]
+                if not batches:
+                    return stored
+                for segment, records in batches:
+                    for end, record in records:
+                        db = session_factory()
+                        try:
+                            if replay_record(db, record):
+                                stored += 1
+                        except DB_UNAVAILABLE as e:
+                            logger.warning("Spool replay paused: database unavailable", extra={"error": str(e)})
+                            return stored
+                        except Exception as e:
+                            logger.exception("Spooled message rejected, moved to dead letters", extra={
+                                "provisional_id": record.get("provisional_id"), "path": segment.path})
+                            self.dead_letter(record, e)
+                        finally:
+                            db.close()
+                        segment.offset = end
+                    with self.lock:
+                        self.release(segment)
+
+    def dead_letter(self, record: Dict, error: Exception):
+        """Keep a record that can never be stored, with the reason, out of the replay path"""
+        line = json.dumps({**record, "error": repr(error)}, separators=(",", ":")).encode("utf-8") + b"\n"
+        with open(os.path.join(self.directory, DEAD_LETTER_FILE), "ab") as file:
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def release(self, segment: Segment):
+        """Drop a fully replayed segment (our own file is emptied and kept)"""
+        if segment.pending():
+            return
+        if segment.owned:
+            segment.file.truncate(0)
+            segment.size = segment.offset = 0
+        else:
+            self.remove(segment)
+
+    def remove(self, segment: Segment):
+        if segment in self.segments:
+            self.segments.remove(segment)
+        segment.file.close()
+        os.remove(segment.path)
+
+    def close(self):
+        with self.lock:
+            for segment in list(self.segments):
+                if segment.owned and not segment.size:
+                    self.remove(segment)
+                else:
+                    segment.file.close()
+            self.segments = []
+            self.active = None
@@ -0,0 +1,352 @@
+"""
+Prometheus-style metrics for Halloween Poe Chat
+A small in-process registry (counters, gauges, histograms) rendered in the
+Prometheus text exposition format, plus the instrumentation hooks:
+an ASGI middleware for per-route latency, SQLAlchemy events for per-request
+query counts and durations, and helpers for Bedrock and websocket metrics.
+
+Several workers (serve.py --workers N) each keep their own registry. With
+METRICS_DIR set, every worker writes a snapshot of it there every
+METRICS_FLUSH_SECONDS, and /metrics adds up all workers' snapshots, so one
+scrape covers the whole server. A worker that stops keeps its counters and
+histograms in the total but drops its gauges.
+
+/metrics is served to requests carrying METRICS_TOKEN as a bearer token,
+or, when no token is configured, to loopback clients only.
+
+Environment:
+    METRICS_TOKEN            bearer token required to scrape (default none: loopback only)
+    METRICS_DIR              directory shared by the workers' snapshots (serve.py sets one)
+    METRICS_FLUSH_SECONDS    how often a worker writes its snapshot (default 5)
+"""
+import os
+import hmac
+import json
+import time
+import bisect
+import threading
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from profiling import record_span
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+LOOPBACK_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self.key(labels), 0.0)
+
+    def snapshot(self) -> List:
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def render(self, others: Iterable[List] = ()) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+        for snapshot in others:
+            for key, value in snapshot:
+                values[tuple(key)] = values.get(tuple(key), 0.0) + value
+        items = sorted(values.items())
+        return self.header() + [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in items
+        ]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[Tuple[str, ...], List] = {}  # key -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self.series.get(self.key(labels))
+        return series[2] if series else 0
+
+    def snapshot(self) -> List:
+        with self.lock:
+            return [[list(key), [*series[0]], series[1], series[2]] for key, series in self.series.items()]
+
+    def render(self, others: Iterable[List] = ()) -> List[str]:
+        lines = self.header()
+        with self.lock:
+            merged = {key: [[*series[0]], series[1], series[2]] for key, series in self.series.items()}
+        for snapshot in others:
+            for key, counts, total, count in snapshot:
+                series = merged.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0, 0])
+                if len(counts) == len(series[0]):
+                    series[0] = [a + b for a, b in zip(series[0], counts)]
+                    series[1] += total
+                    series[2] += count
+        items = sorted(merged.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def snapshot(self, gauges: bool = True) -> Dict[str, List]:
+        return {metric.name: metric.snapshot() for metric in self.metrics if gauges or metric.kind != "gauge"}
+
+    def render(self, others: Sequence[Dict[str, List]] = ()) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render([other.get(metric.name, []) for other in others]))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# HTTP
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["method", "route", "status"])
+
+# Database
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Duration of individual SQL statements by route", ["route"])
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "SQL statements executed per HTTP request", ["route"], COUNT_BUCKETS)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds", "Total SQL time per HTTP request", ["route"])
+
+# Bedrock
+BEDROCK_REQUEST_DURATION = Histogram(
+    "bedrock_request_duration_seconds", "Bedrock invoke_model latency", ["model", "kind"])
+BEDROCK_ERRORS = Counter(
+    "bedrock_errors_total", "Failed Bedrock invocations", ["model", "kind"])
+LLM_IN_FLIGHT = Gauge("llm_requests_in_flight", "Model calls currently running")
+LLM_COALESCED = Counter(
+    "llm_coalesced_requests_total", "Requests served by an identical call already in flight", ["kind"])
+
+# Poem pool
+POEM_POOL_SIZE = Gauge("poem_pool_size", "Precomputed skeletons waiting in the pool", ["kind"])
+POEM_POOL_HITS = Counter("poem_pool_hits_total", "Requests served from the poem pool", ["kind"])
+POEM_POOL_MISSES = Counter("poem_pool_misses_total", "Requests that found the poem pool empty", ["kind"])
+POEM_POOL_REFILLS = Counter("poem_pool_refills_total", "Skeletons added to the pool", ["kind", "source"])
+
+# Websocket
+WS_CONNECTIONS = Gauge("websocket_connections", "Connected Socket.IO clients")
+WS_ROOMS = Gauge("websocket_rooms", "Active chat rooms")
+WS_MESSAGES = Counter("websocket_messages_total", "Chat messages relayed over Socket.IO")
+WS_COMPACT_FRAMES = Counter("websocket_compact_frames_total", "Batched msgpack frames sent to compact clients")
+WS_COMPACT_BYTES = Counter("websocket_compact_bytes_total", "Bytes of msgpack frames sent to compact clients")
+WS_OUTBOUND_QUEUED = Gauge("websocket_outbound_queued", "Packets waiting in per-connection outbound queues")
+WS_OUTBOUND_QUEUE_DEPTH = Histogram(
+    "websocket_outbound_queue_depth", "Per-connection outbound queue depth when a packet is queued", buckets=COUNT_BUCKETS)
+WS_DROPPED = Counter(
+    "websocket_dropped_total", "Websocket packets and messages dropped by backpressure", ["reason"])
+WS_ROOM_AUTH = Counter(
+    "websocket_room_authorizations_total", "join_chat authorization checks by result (cached, checked, denied)", ["result"])
+
+def snapshot_path(pid: Optional[int] = None) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid or os.getpid()}.json")
+
+def write_snapshot(gauges: bool = True):
+    """Publish this worker's metrics for the others' scrapes"""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = snapshot_path()
+    partial = f"{path}.tmp"
+    with open(partial, "w") as f:
+        json.dump(REGISTRY.snapshot(gauges), f, separators=(",", ":"))
+    os.replace(partial, path)
+
+def read_other_snapshots() -> List[Dict[str, List]]:
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return []
+    own = os.path.basename(snapshot_path())
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if name == own or not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # a worker replacing its file right now
+    return snapshots
+
+def render_metrics() -> str:
+    """Every worker's metrics when METRICS_DIR is shared, else this process's"""
+    return REGISTRY.render(read_other_snapshots())
+
+def metrics_allowed(authorization: Optional[str], client_host: Optional[str]) -> bool:
+    """The scrape carries METRICS_TOKEN, or comes from this machine when there is no token"""
+    if METRICS_TOKEN:
+        scheme, _, token = (authorization or "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip(), METRICS_TOKEN)
+    return client_host in LOOPBACK_HOSTS
+
+def route_template(scope) -> Optional[str]:
+    route = scope.get("route")
+    return getattr(route, "path", None)
+
+# Per-request DB accounting
+
+class RequestStats:
+    __slots__ = ("scope", "queries", "db_seconds")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    @property
+    def route(self) -> str:
+        # The router stores the matched route in the scope before calling the endpoint
+        return route_template(self.scope) or "unmatched"
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("query_start_time")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    record_span("db", elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        DB_QUERY_DURATION.observe(elapsed, route=stats.route)
+    else:
+        DB_QUERY_DURATION.observe(elapsed, route="background")
+
+# HTTP middleware
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and DB usage per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = {"code": 500}
+        method = scope.get("method", "GET")
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = stats.route
+            HTTP_REQUEST_DURATION.observe(elapsed, method=method, route=route, status=status["code"])
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route=route)
+            DB_TIME_PER_REQUEST.observe(stats.db_seconds, route=route)
+            current_request.reset(token)
+
+async def metrics_app(scope, receive, send):
+    """Bare ASGI app serving /metrics, for processes without FastAPI"""
+    if scope["type"] == "http" and scope["path"] == "/metrics":
+        headers = dict(scope.get("headers") or [])
+        authorization = headers.get(b"authorization", b"").decode("latin-1") or None
+        if not metrics_allowed(authorization, (scope.get("client") or (None,))[0]):
+            await send({"type": "http.response.start", "status": 403, "headers": [(b"content-type", b"text/plain")]})
+            await send({"type": "http.response.body", "body": b"Forbidden"})
+            return
+        body = render_metrics().encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", CONTENT_TYPE.encode())]})
+        await send({"type": "http.response.body", "body": body})
+        return
+    if scope["type"] == "http":
+        await send({"type": "http.response.start", "status": 404, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"Not Found"})
@@ -0,0 +1,193 @@
+"""
+Precomputed poem pool for Halloween Poe Chat
+Keeps a pool of "skeleton" poems and cryptic messages per kind, written
+with {answer1}/{answer2}/{answer3} placeholders. A background task refills
+each pool from Bedrock when it is available (and idle), or from templates
+built on the Poe knowledge base, so a request only has to fill in the
+user's answers.
+
+Environment:
+    POEM_POOL_ENABLED         run the refill tasks (default True)
+    POEM_POOL_LOW_WATERMARK   refill starts when a pool drops below this (default 5)
+    POEM_POOL_HIGH_WATERMARK  refill stops at this size (default 20)
+    POEM_POOL_REFILL_RATE     skeletons generated per second per pool (default 2)
+"""
+import os
+import re
+import random
+import asyncio
+import logging
+from collections import deque
+from string import Template
+from typing import Awaitable, Callable, List, Optional
+from knowledge import poems, vocabulary
+from metrics import LLM_IN_FLIGHT, POEM_POOL_SIZE, POEM_POOL_HITS, POEM_POOL_MISSES, POEM_POOL_REFILLS
+
+POEM_POOL_ENABLED = os.getenv("POEM_POOL_ENABLED", "true").lower() == "true"
+POEM_POOL_LOW_WATERMARK = int(os.getenv("POEM_POOL_LOW_WATERMARK", "5"))
+POEM_POOL_HIGH_WATERMARK = int(os.getenv("POEM_POOL_HIGH_WATERMARK", "20"))
+POEM_POOL_REFILL_RATE = float(os.getenv("POEM_POOL_REFILL_RATE", "2"))
+
+logger = logging.getLogger("poem_pool")
+
+SKELETON_ANSWERS = ["{answer1}", "{answer2}", "{answer3}"]
+DEFAULT_ANSWERS = ["mystery", "shadow", "whisper"]
+PLACEHOLDER = re.compile(r"\{answer([123])\}")
+
+# Appended to the model prompt when generating a skeleton instead of a personal poem
+SKELETON_INSTRUCTION = """
+
+The details above are placeholders. Write {answer1}, {answer2} and {answer3} literally,
+exactly once or more each, where the details belong; they will be filled in later."""
+
+def is_skeleton(text: str) -> bool:
+    return all(placeholder in text for placeholder in SKELETON_ANSWERS)
+
+def fill_skeleton(skeleton: str, answers: List[str]) -> str:
+    """Replace the placeholders with the user's answers (blank answers get the usual defaults)"""
+    values = [
+        answers[i] if len(answers) > i and answers[i].strip() else default
+        for i, default in enumerate(DEFAULT_ANSWERS)
+    ]
+    return PLACEHOLDER.sub(lambda match: values[int(match.group(1)) - 1], skeleton)
+
+# Knowledge-base templates. $gothic and $atmosphere are drawn from the
+# vocabulary; the answer placeholders are left for fill_skeleton.
+
+POEM_STANZAS = [
+    [
+        "Upon a $atmosphere midnight, when the $gothic stirred,\nI found the name of {answer1} in a long-forgotten word.\nIt lingered on the lintel, it trembled on the floor,\nA whisper from the chamber where I had been before.",
+        "Deep within the vault where {answer1} lies entombed,\nThe $gothic keeps its vigil where the candles were consumed.\nNo mortal hand has stirred it, no living eye has seen\nThe $atmosphere remembrance of all that once had been.",
+    ],
+    [
+        "And {answer2}, like a $gothic, crept along the wall,\nA $atmosphere procession through the silent hall.\nThe raven on the bust above my chamber door\nRepeated it in darkness, and then said nothing more.",
+        "Through veils of {answer2} the $atmosphere shadows creep,\nWhere every $gothic gathers and the ancient secrets sleep.\nThe clock strikes thirteen slowly in the tower overhead,\nAnd {answer2} answers softly in the language of the dead.",
+    ],
+    [
+        "Then {answer3} came tapping, tapping at the pane,\nA $gothic in the tempest, a $atmosphere refrain.\nAnd all the three together, in the lamplight's ghostly glow,\nAre the secrets of the chosen, that only they may know.",
+        "Beware the $atmosphere {answer3} that guards the sunken stair,\nThe $gothic of its keeping, the silence of its prayer.\nFor {answer1}, {answer2} and {answer3} combined\nUnlock the haunted chambers of a solitary mind.",
+    ],
+]
+
+CRYPTIC_OPENINGS = [
+    "Beware, mortal soul! The $gothic of {answer1} walks the $atmosphere halls tonight...",
+    "Deep in the crypt where {answer1} dwells, a $atmosphere bell begins to toll...",
+    "The wind carries a $gothic's whisper of {answer1} through the $atmosphere dark...",
+]
+
+CRYPTIC_MIDDLES = [
+    "Through corridors of {answer2} and stone, the $gothic carves {answer3} in bone.",
+    "The raven knows of {answer2}, and the $atmosphere grave remembers {answer3}.",
+    "Where {answer2} meets the $gothic, {answer3} waits beneath the floor.",
+]
+
+def excerpt_line(rng: random.Random) -> str:
+    """A fragment of a Poe excerpt from the knowledge base, or an empty string"""
+    entries = [entry for entry in poems() if entry.get("excerpt")]
+    if not entries:
+        return ""
+    entry = rng.choice(entries)
+    fragment = re.split(r"[,;—]", entry["excerpt"])[0].strip()
+    return f"{fragment}... ({entry.get('title', 'Poe')})"
+
+def knowledge_skeleton(kind: str, rng: random.Random) -> str:
+    """Build a skeleton from the templates and knowledge base vocabulary"""
+    gothic = vocabulary("gothic_words") or DEFAULT_ANSWERS
+    atmosphere = vocabulary("atmospheric_words") or ["dreary"]
+
+    def render(template: str) -> str:
+        return Template(template).safe_substitute(gothic=rng.choice(gothic), atmosphere=rng.choice(atmosphere))
+
+    if kind == "poem":
+        text = "\n\n".join(render(rng.choice(stanzas)) for stanzas in POEM_STANZAS)
+    else:
+        text = render(rng.choice(CRYPTIC_OPENINGS)) + " " + render(rng.choice(CRYPTIC_MIDDLES))
+    closing = excerpt_line(rng)
+    return f"{text}\n\n{closing}" if closing else text
+
+class SkeletonPool:
+    """Bounded pool of skeletons for one kind ("poem" or "cryptic")
+
+    compose(answers, templates=False) generates a finished text with the
+    model, raising when the model fails; it is only used while
+    llm_available() is true. Refills are counted by where the skeleton came
+    from: source="bedrock" for model text, "template" for everything else.
+    """
+
+    def __init__(self, kind: str, compose: Callable[[List[str]], Awaitable[str]],
+                 llm_available: Callable[[], Awaitable[bool]],
+                 low_watermark: int = POEM_POOL_LOW_WATERMARK,
+                 high_watermark: int = POEM_POOL_HIGH_WATERMARK,
+                 refill_rate: float = POEM_POOL_REFILL_RATE,
+                 rng: Optional[random.Random] = None):
+        self.kind = kind
+        self.compose = compose
+        self.llm_available = llm_available
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.refill_interval = 1.0 / refill_rate if refill_rate > 0 else 0.0
+        self.rng = rng or random.Random()
+        self.skeletons: deque = deque()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.skeletons)
+
+    def take(self) -> Optional[str]:
+        """Pop a skeleton, or None on a miss; wakes the refill task below the low watermark"""
+        if self.skeletons:
+            skeleton = self.skeletons.popleft()
+            POEM_POOL_HITS.inc(kind=self.kind)
+        else:
+            skeleton = None
+            POEM_POOL_MISSES.inc(kind=self.kind)
+        POEM_POOL_SIZE.set(len(self.skeletons), kind=self.kind)
+        if len(self.skeletons) < self.low_watermark and self.wakeup is not None:
+            self.wakeup.set()
+        return skeleton
+
+    async def produce(self) -> str:
+        if await self.llm_available():
+            try:
+                text = await self.compose(SKELETON_ANSWERS, templates=False)
+                if is_skeleton(text):
+                    POEM_POOL_REFILLS.inc(kind=self.kind, source="bedrock")
+                    return text
+            except Exception as e:
+                logger.warning("Poem pool: model skeleton failed", extra={"kind": self.kind, "error": str(e)})
+        POEM_POOL_REFILLS.inc(kind=self.kind, source="template")
+        return knowledge_skeleton(self.kind, self.rng)
+
+    async def fill(self):
+        """Top the pool up to the high watermark at the configured rate"""
+        while len(self.skeletons) < self.high_watermark:
+            # User-facing model calls go first; only wait while there is something to serve
+            if self.skeletons and LLM_IN_FLIGHT.value() > 0:
+                await asyncio.sleep(self.refill_interval or 0.1)
+                continue
+            self.skeletons.append(await self.produce())
+            POEM_POOL_SIZE.set(len(self.skeletons), kind=self.kind)
+            await asyncio.sleep(self.refill_interval)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await self.fill()
+            except Exception:
+                logger.exception("Poem pool refill error", extra={"kind": self.kind})
+                await asyncio.sleep(1.0)
+                continue
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.wakeup = None
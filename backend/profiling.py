@@ -0,0 +1,242 @@
+"""
+Request-level profiling for Halloween Poe Chat
+Opt-in ASGI middleware that profiles individual requests, chosen by the
+X-Profile header or a sample rate. Each profile keeps span timings (db,
+llm, serialization) and a collapsed-stack profile that can be fed straight
+into flamegraph.pl or speedscope.
+
+Only one request per process is profiled at a time; others that ask while
+a profile is running are served unprofiled, with X-Profile-Skipped: busy.
+Both collectors watch the whole event loop thread, so a profile also
+includes whatever other requests ran on the loop while it was open, and
+cProfile cannot be enabled twice at once (on Python 3.12+ it raises when
+another profiler is active, in which case the request is skipped the same
+way).
+
+Environment:
+    PROFILING_ENABLED     turn the middleware on (default False)
+    PROFILE_SAMPLE_RATE   fraction of requests profiled without the header (default 0)
+    PROFILE_MODE          "sampling" (stack sampler, default) or "cprofile"
+    PROFILE_INTERVAL_MS   sampling interval (default 5)
+    PROFILE_HISTORY       number of profiles kept in memory (default 50)
+    ADMIN_TOKEN           required in X-Admin-Token to read profiles
+"""
+import os
+import sys
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+import orjson
+from starlette.responses import JSONResponse
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_HISTORY = int(os.getenv("PROFILE_HISTORY", "50"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+PROFILE_HEADER = b"x-profile"
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, mode: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.route = path
+        self.mode = mode
+        self.status = 500
+        self.started_at = datetime.utcnow()
+        self.duration = 0.0
+        self.spans: Dict[str, List] = {}  # name -> [count, seconds]
+        self.stacks: Counter = Counter()
+
+    def add_span(self, name: str, seconds: float):
+        span = self.spans.setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += seconds
+
+    def summary(self) -> Dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "mode": self.mode,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 3),
+            "spans": {
+                name: {"count": count, "ms": round(seconds * 1000, 3)}
+                for name, (count, seconds) in self.spans.items()
+            },
+        }
+
+    def collapsed(self) -> str:
+        """Collapsed stacks, one `frame;frame;frame count` line each"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+profiles: deque = deque(maxlen=PROFILE_HISTORY)
+# Held while a request is being profiled
+profiling_lock = threading.Lock()
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_profile", default=None)
+
+def record_span(name: str, seconds: float):
+    """Add time to a span of the request being profiled, if any"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add_span(name, seconds)
+
+@contextmanager
+def span(name: str):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, time.perf_counter() - start)
+
+class ProfiledJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson, reporting its encoding time as the serialization span"""
+
+    def render(self, content) -> bytes:
+        with span("serialization"):
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def get_profile(profile_id: str) -> Optional[RequestProfile]:
+    return next((profile for profile in profiles if profile.id == profile_id), None)
+
+# Collectors
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse_frame(frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+class StackSampler:
+    """Samples the event loop thread's stack while a request is in flight"""
+
+    def __init__(self, thread_id: int, interval: float, stacks: Counter):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = stacks
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_frame(frame)] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def pstats_to_collapsed(profiler: cProfile.Profile, stacks: Counter):
+    """Turn cProfile's caller/callee graph into two-level collapsed stacks (microseconds)"""
+    stats = pstats.Stats(profiler).stats
+    for (filename, lineno, name), (_, _, tottime, _, callers) in stats.items():
+        callee = f"{name} ({os.path.basename(filename)}:{lineno})"
+        if not callers:
+            stacks[callee] += int(tottime * 1e6)
+            continue
+        total_calls = sum(caller_stats[0] for caller_stats in callers.values()) or 1
+        for (caller_file, caller_line, caller_name), caller_stats in callers.items():
+            caller = f"{caller_name} ({os.path.basename(caller_file)}:{caller_line})"
+            share = tottime * caller_stats[0] / total_calls
+            stacks[f"{caller};{callee}"] += int(share * 1e6)
+
+# Middleware
+
+def should_profile(scope) -> bool:
+    for name, value in scope.get("headers", []):
+        if name == PROFILE_HEADER:
+            return value not in (b"0", b"false", b"")
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+class ProfilingMiddleware:
+    """Profiles requests carrying X-Profile (or a random sample) and stores the result"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        if not profiling_lock.acquire(blocking=False):
+            await self.app(scope, receive, skipped(send))
+            return
+        try:
+            await self.profile(scope, receive, send)
+        finally:
+            profiling_lock.release()
+
+    async def profile(self, scope, receive, send):
+        profile = RequestProfile(scope.get("method", "GET"), scope.get("path", ""), PROFILE_MODE)
+
+        if PROFILE_MODE == "cprofile":
+            collector = cProfile.Profile()
+            try:
+                collector.enable()
+            except ValueError:
+                # Another profiler (a debugger, coverage) already owns this thread
+                await self.app(scope, receive, skipped(send))
+                return
+        else:
+            collector = StackSampler(threading.get_ident(), PROFILE_INTERVAL, profile.stacks)
+            collector.start()
+
+        token = current_profile.set(profile)
+        profiles.append(profile)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.duration = time.perf_counter() - start
+            if PROFILE_MODE == "cprofile":
+                collector.disable()
+                pstats_to_collapsed(collector, profile.stacks)
+            else:
+                collector.stop()
+            route = scope.get("route")
+            profile.route = getattr(route, "path", profile.path)
+            current_profile.reset(token)
+
+def skipped(send):
+    """send that marks the response as not profiled because a profile was already running"""
+    async def send_wrapper(message):
+        if message["type"] == "http.response.start":
+            message = {**message, "headers": [*message.get("headers", []), (b"x-profile-skipped", b"busy")]}
+        await send(message)
+    return send_wrapper
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Message retention and archiving for Halloween Poe Chat
+Caps the hot history kept per connection and moves older messages into
+gzip-compressed cold storage (the message_archives table or JSONL.gz files).
+On PostgreSQL the messages table can also be partitioned by month.
+
+Archiving is safe to run from several processes at once (every API worker's
+retention loop, the CLI): rows are claimed with DELETE ... RETURNING in the
+same transaction that stores them, so each row is archived by exactly one
+process, and on PostgreSQL a per-connection advisory lock makes the others
+skip a connection that is already being archived. JSONL archives are named
+after the first message they hold and written with a rename, so a batch
+retried after a failed commit replaces its file instead of appending a
+second copy.
+"""
+import os
+import sys
+import gzip
+import json
+import argparse
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Dict, Optional
+from sqlalchemy import delete, text
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+from database import SessionLocal, get_engine, Message, MessageArchive
+
+load_dotenv()
+
+# Number of messages returned by a single get_messages call
+MESSAGE_HISTORY_LIMIT = int(os.getenv("MESSAGE_HISTORY_LIMIT", "200"))
+# Number of messages kept in the hot table per connection (0 = unlimited)
+MESSAGE_HOT_LIMIT = int(os.getenv("MESSAGE_HOT_LIMIT", "5000"))
+# Messages older than this are archived (0 = never archive by age)
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "90"))
+# "table" stores archives in message_archives, "jsonl" writes JSONL.gz files
+ARCHIVE_BACKEND = os.getenv("ARCHIVE_BACKEND", "table")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+# Run the archiver in the API process every N minutes (0 = disabled)
+RETENTION_INTERVAL_MINUTES = int(os.getenv("RETENTION_INTERVAL_MINUTES", "0"))
+# First key of the PostgreSQL advisory lock taken per connection while archiving
+ARCHIVE_LOCK_NAMESPACE = 0x706F65  # "poe"
+
+# Called with (connection_id, archived rows) once archived messages have left the hot table
+archive_hooks: List[Callable[[int, List[Dict]], None]] = []
+
+def serialize_message(msg: Message) -> Dict:
+    """Convert a message row into its archived form"""
+    return {
+        "id": msg.id,
+        "connection_id": msg.connection_id,
+        "sender_id": msg.sender_id,
+        "content": msg.content,
+        "timestamp": msg.timestamp.isoformat() if msg.timestamp else None,
+        "is_read": bool(msg.is_read),
+        "seq": msg.seq
+    }
+
+def compress_messages(rows: List[Dict]) -> bytes:
+    """Encode messages as gzip-compressed JSONL"""
+    lines = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+    return gzip.compress(lines.encode("utf-8"))
+
+def decompress_messages(payload: bytes) -> List[Dict]:
+    """Decode a gzip-compressed JSONL payload"""
+    return [json.loads(line) for line in gzip.decompress(payload).decode("utf-8").splitlines() if line]
+
+def archive_path(connection_id: int, period: str, first_message_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"connection_{connection_id}", f"{period}-{first_message_id:012d}.jsonl.gz")
+
+def write_archive(db: Session, connection_id: int, period: str, rows: List[Dict]) -> Optional[str]:
+    """Write one month of messages for a connection to cold storage; returns the file written, if any"""
+    payload = compress_messages(rows)
+
+    if ARCHIVE_BACKEND == "jsonl":
+        # One file per batch, named after its first message: a retry of the same batch overwrites it
+        path = archive_path(connection_id, period, rows[0]["id"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + ".tmp"
+        with open(partial, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, path)
+        return path
+
+    db.add(MessageArchive(
+        connection_id=connection_id,
+        period=period,
+        first_message_id=rows[0]["id"],
+        last_message_id=rows[-1]["id"],
+        message_count=len(rows),
+        payload=payload
+    ))
+    return None
+
+def expired_message_query(db: Session, connection_id: int, now: Optional[datetime] = None):
+    """Query for messages of a connection that should leave the hot table"""
+    now = now or datetime.utcnow()
+    conditions = []
+
+    if MESSAGE_RETENTION_DAYS > 0:
+        conditions.append(Message.timestamp < now - timedelta(days=MESSAGE_RETENTION_DAYS))
+
+    if MESSAGE_HOT_LIMIT > 0:
+        # Everything older than the newest MESSAGE_HOT_LIMIT rows
+        boundary = db.query(Message.id).filter(
+            Message.connection_id == connection_id
+        ).order_by(Message.id.desc()).offset(MESSAGE_HOT_LIMIT - 1).limit(1).scalar()
+        if boundary is not None:
+            conditions.append(Message.id < boundary)
+
+    if not conditions:
+        return None
+
+    condition = conditions[0]
+    for extra in conditions[1:]:
+        condition = condition | extra
+
+    return db.query(Message).filter(Message.connection_id == connection_id, condition)
+
+def lock_connection(db: Session, connection_id: int) -> bool:
+    """Take the connection's archiving lock for this transaction; False when another process holds it"""
+    if db.get_bind().dialect.name != "postgresql":
+        # SQLite has one writer at a time, and DELETE ... RETURNING below claims the rows
+        return True
+    return bool(db.execute(
+        text("SELECT pg_try_advisory_xact_lock(:namespace, :connection_id)"),
+        {"namespace": ARCHIVE_LOCK_NAMESPACE, "connection_id": connection_id}
+    ).scalar())
+
+def archive_connection(db: Session, connection_id: int, now: Optional[datetime] = None) -> int:
+    """Move expired messages of one connection into cold storage"""
+    archived = 0
+
+    while True:
+        if not lock_connection(db, connection_id):
+            db.rollback()
+            return archived
+
+        query = expired_message_query(db, connection_id, now)
+        if query is None:
+            db.rollback()
+            return archived
+
+        ids = [row[0] for row in query.with_entities(Message.id).order_by(Message.id).limit(ARCHIVE_BATCH_SIZE).all()]
+        if not ids:
+            db.rollback()
+            return archived
+
+        # The rows this transaction deletes are the ones it archives: a concurrent run gets none of them
+        batch = sorted(db.execute(
+            delete(Message).where(Message.id.in_(ids)).returning(
+                Message.id, Message.connection_id, Message.sender_id, Message.content,
+                Message.timestamp, Message.is_read, Message.seq
+            ).execution_options(synchronize_session=False)
+        ).all(), key=lambda msg: msg.id)
+
+        # Group the batch by month so each archive covers a single period
+        periods: Dict[str, List[Dict]] = {}
+        for msg in batch:
+            period = (msg.timestamp or now or datetime.utcnow()).strftime("%Y-%m")
+            periods.setdefault(period, []).append(serialize_message(msg))
+
+        written = []
+        try:
+            for period, rows in periods.items():
+                path = write_archive(db, connection_id, period, rows)
+                if path:
+                    written.append(path)
+            db.commit()
+        except Exception:
+            # The rows stay in the hot table, so drop the files that now duplicate them
+            db.rollback()
+            for path in written:
+                os.remove(path)
+            raise
+
+        for hook in archive_hooks:
+            for rows in periods.values():
+                hook(connection_id, rows)
+        archived += len(batch)
+
+        if len(ids) < ARCHIVE_BATCH_SIZE:
+            return archived
+
+def iter_archived_messages(db: Session, connection_id: int) -> Iterator[List[Dict]]:
+    """Archived messages of a connection one archive at a time, oldest archive first"""
+    if ARCHIVE_BACKEND == "jsonl":
+        directory = os.path.join(ARCHIVE_DIR, f"connection_{connection_id}")
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith(".jsonl.gz"):
+                    continue  # a batch still being written
+                with open(os.path.join(directory, name), "rb") as f:
+                    yield decompress_messages(f.read())
+    else:
+        # Payloads are fetched as they are used rather than all up front
+        archives = db.query(MessageArchive.payload).filter(
+            MessageArchive.connection_id == connection_id
+        ).order_by(MessageArchive.first_message_id).yield_per(1)
+        for (payload,) in archives:
+            yield decompress_messages(payload)
+
+def load_archived_messages(db: Session, connection_id: int) -> List[Dict]:
+    """Read back every archived message of a connection, oldest first"""
+    rows: List[Dict] = []
+    for archived in iter_archived_messages(db, connection_id):
+        rows.extend(archived)
+    rows.sort(key=lambda row: row["id"])
+    return rows
+
+def run_retention(now: Optional[datetime] = None) -> Dict[int, int]:
+    """Apply retention to every connection that has messages"""
+    db = SessionLocal()
+    summary = {}
+    try:
+        connection_ids = [row[0] for row in db.query(Message.connection_id).distinct().all()]
+        for connection_id in connection_ids:
+            count = archive_connection(db, connection_id, now)
+            if count:
+                summary[connection_id] = count
+        return summary
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# PostgreSQL monthly partitioning
+
+def is_postgres() -> bool:
+    return get_engine().dialect.name == "postgresql"
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+def next_month(value: datetime) -> datetime:
+    return datetime(value.year + (value.month // 12), value.month % 12 + 1, 1)
+
+def messages_is_partitioned(connection) -> bool:
+    result = connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'messages'"
+    ))
+    return result.first() is not None
+
+def ensure_message_partitions(connection, start: datetime, months_ahead: int = 3):
+    """Create monthly partitions from start up to months_ahead past the current month"""
+    current = month_start(start)
+    end = month_start(datetime.utcnow())
+    for _ in range(months_ahead + 1):
+        end = next_month(end)
+
+    while current < end:
+        upper = next_month(current)
+        name = f"messages_y{current.year}m{current.month:02d}"
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+            f"FOR VALUES FROM ('{current:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+        ))
+        current = upper
+
+def partition_messages_table(months_ahead: int = 3) -> bool:
+    """Convert messages into a table partitioned by month on timestamp"""
+    if not is_postgres():
+        print("Partitioning is only supported on PostgreSQL")
+        return False
+
+    from search import create_postgres_search_index
+
+    with get_engine().begin() as connection:
+        if messages_is_partitioned(connection):
+            print("SUCCESS: messages is already partitioned, adding upcoming partitions")
+            ensure_message_partitions(connection, datetime.utcnow(), months_ahead)
+            create_postgres_search_index(connection)
+            return True
+
+        oldest = connection.execute(text("SELECT min(timestamp) FROM messages")).scalar() or datetime.utcnow()
+
+        statements = [
+            "ALTER TABLE messages RENAME TO messages_unpartitioned",
+            "UPDATE messages_unpartitioned SET timestamp = now() WHERE timestamp IS NULL",
+            # A generated column would be copied as a plain one that stays NULL; the search index is recreated below
+            "ALTER TABLE messages_unpartitioned DROP COLUMN IF EXISTS search_vector",
+            "CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)",
+            "ALTER TABLE messages ALTER COLUMN timestamp SET NOT NULL",
+            "ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)",
+            "ALTER TABLE messages ADD FOREIGN KEY (connection_id) REFERENCES connections(id)",
+            "ALTER TABLE messages ADD FOREIGN KEY (sender_id) REFERENCES users(id)",
+        ]
+        for statement in statements:
+            connection.execute(text(statement))
+
+        ensure_message_partitions(connection, oldest, months_ahead)
+        connection.execute(text("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT"))
+
+        connection.execute(text("INSERT INTO messages SELECT * FROM messages_unpartitioned"))
+        connection.execute(text("ALTER SEQUENCE IF EXISTS messages_id_seq OWNED BY messages.id"))
+        connection.execute(text("DROP TABLE messages_unpartitioned"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_messages_connection_timestamp ON messages(connection_id, timestamp)"
+        ))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id)"))
+        # Unique indexes on a partitioned table must include the partition key. Sequence numbers
+        # stay unique because they come from connections.last_seq, and message_log checks the
+        # idempotency key while holding that connection row's lock.
+        connection.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_connection_seq ON messages(connection_id, seq, timestamp)"
+        ))
+        connection.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_client_id ON messages(connection_id, sender_id, client_id, timestamp)"
+        ))
+        create_postgres_search_index(connection)
+
+    print("SUCCESS: messages table partitioned by month")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Halloween Poe Chat - message retention")
+    parser.add_argument("command", choices=["archive", "partition", "ensure-partitions"])
+    parser.add_argument("--months-ahead", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "archive":
+        summary = run_retention()
+        total = sum(summary.values())
+        print(f"SUCCESS: Archived {total} messages from {len(summary)} connections ({ARCHIVE_BACKEND})")
+        return True
+
+    if args.command == "partition":
+        return partition_messages_table(args.months_ahead)
+
+    if not is_postgres():
+        print("Partitioning is only supported on PostgreSQL")
+        return False
+    with get_engine().begin() as connection:
+        if not messages_is_partitioned(connection):
+            print("ERROR: messages is not partitioned, run 'retention.py partition' first")
+            return False
+        ensure_message_partitions(connection, datetime.utcnow(), args.months_ahead)
+    print("SUCCESS: Upcoming message partitions created")
+    return True
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,295 @@
+"""
+Full-text message search for Halloween Poe Chat
+Uses a tsvector/GIN index on PostgreSQL, SQLite FTS5 locally, and a
+pure-Python incremental inverted index when neither is available.
+
+Snippets are HTML: message content is escaped and only the <mark> tags
+around matches are markup, so clients can render them as they are.
+"""
+import re
+import html
+import logging
+import threading
+from typing import Dict, List, Set, Optional
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
+from database import get_engine, User, Connection, Message
+from retention import archive_hooks
+
+logger = logging.getLogger("search")
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+SNIPPET_WORDS = 12
+MAX_PAGE_SIZE = 100
+# Placeholders the database puts around matches, turned into <mark> after escaping
+MARK_START, MARK_END = "\x02", "\x03"
+
+def tokenize(value: str) -> List[str]:
+    return [token.lower() for token in TOKEN_RE.findall(value or "")]
+
+class InvertedIndex:
+    """In-memory token -> message postings, updated as messages are written"""
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, int]] = {}  # token -> {message_id: connection_id}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def add(self, message_id: int, connection_id: int, content: str):
+        with self.lock:
+            for token in set(tokenize(content)):
+                self.postings.setdefault(token, {})[message_id] = connection_id
+
+    def remove(self, message_id: int, content: str):
+        self.discard(message_id, tokenize(content))
+
+    def discard(self, message_id: int, tokens: List[str]):
+        """Drop a message from the postings of the given tokens"""
+        with self.lock:
+            for token in set(tokens):
+                bucket = self.postings.get(token)
+                if bucket:
+                    bucket.pop(message_id, None)
+                    if not bucket:
+                        del self.postings[token]
+
+    def load(self, db: Session, batch_size: int = 5000):
+        """Build the index from the messages table"""
+        last_id = 0
+        while True:
+            rows = db.query(Message.id, Message.connection_id, Message.content).filter(
+                Message.id > last_id
+            ).order_by(Message.id).limit(batch_size).all()
+            if not rows:
+                break
+            for message_id, connection_id, content in rows:
+                self.add(message_id, connection_id, content)
+            last_id = rows[-1][0]
+        self.loaded = True
+
+    def search(self, query: str, connection_ids: Set[int]) -> List[int]:
+        """Ids of messages containing every query token, newest first"""
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+
+        with self.lock:
+            buckets = [self.postings.get(token, {}) for token in tokens]
+            buckets.sort(key=len)
+            matches = {
+                message_id for message_id, connection_id in buckets[0].items()
+                if connection_id in connection_ids
+            }
+            for bucket in buckets[1:]:
+                matches.intersection_update(bucket)
+
+        return sorted(matches, reverse=True)
+
+memory_index = InvertedIndex()
+
+@event.listens_for(Message, "after_insert")
+def index_new_message(mapper, connection, target):
+    # Only maintained once loaded; stale ids are dropped when rows are fetched
+    if memory_index.loaded:
+        memory_index.add(target.id, target.connection_id, target.content)
+
+def forget_archived(connection_id: int, rows: List[Dict]):
+    """Drop messages archived by this process (other processes' archives are pruned as searches find them)"""
+    if memory_index.loaded:
+        for row in rows:
+            memory_index.remove(row["id"], row["content"])
+
+archive_hooks.append(forget_archived)
+
+# Backend detection and index setup
+
+_backend: Optional[str] = None
+_backend_lock = threading.Lock()
+
+def fts5_available(connection) -> bool:
+    try:
+        connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_probe USING fts5(x)"))
+        connection.execute(text("DROP TABLE IF EXISTS temp.fts5_probe"))
+        return True
+    except Exception:
+        return False
+
+def create_postgres_search_index(connection):
+    """Generated tsvector column and GIN index (on a partitioned messages table they cover every partition)"""
+    plain_column = connection.execute(text(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = 'messages' "
+        "AND column_name = 'search_vector' AND is_generated = 'NEVER'"
+    )).first()
+    if plain_column:
+        # Copied by CREATE TABLE ... LIKE without its expression, so it is NULL for new rows
+        connection.execute(text("ALTER TABLE messages DROP COLUMN search_vector"))
+    connection.execute(text(
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector)"
+    ))
+
+def setup_search_index() -> str:
+    """Create the full-text index for the current database, returns the backend in use"""
+    global _backend
+    with _backend_lock:
+        if _backend:
+            return _backend
+
+        dialect = get_engine().dialect.name
+        if dialect == "postgresql":
+            with get_engine().begin() as connection:
+                create_postgres_search_index(connection)
+            _backend = "postgres"
+        elif dialect == "sqlite":
+            with get_engine().begin() as connection:
+                if fts5_available(connection):
+                    exists = connection.execute(text(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+                    )).first()
+                    connection.execute(text(
+                        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                        "USING fts5(content, content='messages', content_rowid='id')"
+                    ))
+                    triggers = [
+                        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+                        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+                        "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+                        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+                        "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+                        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+                        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+                    ]
+                    for trigger in triggers:
+                        connection.execute(text(trigger))
+                    if not exists:
+                        connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+                    _backend = "fts5"
+        if not _backend:
+            _backend = "memory"
+
+        logger.info("Search: using index", extra={"backend": _backend})
+        return _backend
+
+# Snippets
+
+def mark_snippet(snippet: str) -> str:
+    """Escape a snippet built by the database and turn its match placeholders into <mark>"""
+    return html.escape(snippet).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+def highlight(content: str, query: str) -> str:
+    """Build a short snippet around the first match with matches wrapped in <mark>"""
+    terms = set(tokenize(query))
+    words = content.split()
+    first = next((i for i, word in enumerate(words) if terms & set(tokenize(word))), 0)
+    start = max(0, first - SNIPPET_WORDS // 3)
+    window = words[start:start + SNIPPET_WORDS]
+
+    marked = []
+    for word in window:
+        marked.append(f"<mark>{html.escape(word)}</mark>" if terms & set(tokenize(word)) else html.escape(word))
+
+    snippet = " ".join(marked)
+    if start > 0:
+        snippet = "…" + snippet
+    if start + SNIPPET_WORDS < len(words):
+        snippet += "…"
+    return snippet
+
+def fts5_query(query: str) -> str:
+    # Quote every token so user input can't use FTS5 syntax
+    return " ".join(f'"{token}"' for token in tokenize(query))
+
+# Search
+
+def user_connection_ids(db: Session, user_id: int) -> Set[int]:
+    rows = db.query(Connection.id).filter(
+        (Connection.user1_id == user_id) | (Connection.user2_id == user_id)
+    ).all()
+    return {row[0] for row in rows}
+
+def search_messages(db: Session, user_id: int, query: str, page: int = 1, page_size: int = 20) -> Dict:
+    """Search messages in the user's connections, newest first"""
+    page = max(page, 1)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    offset = (page - 1) * page_size
+    result = {"query": query, "page": page, "page_size": page_size, "total": 0, "results": []}
+
+    connection_ids = user_connection_ids(db, user_id)
+    if not connection_ids or not tokenize(query):
+        return result
+
+    backend = setup_search_index()
+    snippets: Dict[int, str] = {}
+    ids_param = sorted(connection_ids)
+
+    if backend == "postgres":
+        params = {"q": query, "ids": ids_param, "limit": page_size, "offset": offset,
+                  "options": f'StartSel="{MARK_START}", StopSel="{MARK_END}", MaxWords=16, MinWords=6, MaxFragments=1'}
+        result["total"] = db.execute(text(
+            "SELECT count(*) FROM messages "
+            "WHERE search_vector @@ plainto_tsquery('english', :q) AND connection_id = ANY(:ids)"
+        ), params).scalar()
+        rows = db.execute(text(
+            "SELECT m.id, ts_headline('english', m.content, q, :options) "
+            "FROM messages m, plainto_tsquery('english', :q) q "
+            "WHERE m.search_vector @@ q AND m.connection_id = ANY(:ids) "
+            "ORDER BY m.timestamp DESC, m.id DESC LIMIT :limit OFFSET :offset"
+        ), params).all()
+        page_ids = [row[0] for row in rows]
+        snippets = {row[0]: mark_snippet(row[1]) for row in rows}
+    elif backend == "fts5":
+        placeholders = ", ".join(f":c{i}" for i in range(len(ids_param)))
+        params = {f"c{i}": value for i, value in enumerate(ids_param)}
+        params.update({"q": fts5_query(query), "limit": page_size, "offset": offset,
+                       "start": MARK_START, "stop": MARK_END})
+        where = f"messages_fts MATCH :q AND m.connection_id IN ({placeholders})"
+        result["total"] = db.execute(text(
+            f"SELECT count(*) FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE {where}"
+        ), params).scalar()
+        rows = db.execute(text(
+            f"SELECT m.id, snippet(messages_fts, 0, :start, :stop, '…', {SNIPPET_WORDS}) "
+            f"FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE {where} "
+            f"ORDER BY m.id DESC LIMIT :limit OFFSET :offset"
+        ), params).all()
+        page_ids = [row[0] for row in rows]
+        snippets = {row[0]: mark_snippet(row[1]) for row in rows}
+    else:
+        if not memory_index.loaded:
+            memory_index.load(db)
+        matches = memory_index.search(query, connection_ids)
+        result["total"] = len(matches)
+        page_ids = matches[offset:offset + page_size]
+
+    if not page_ids:
+        return result
+
+    rows = db.query(Message, User.username).join(User, User.id == Message.sender_id).filter(
+        Message.id.in_(page_ids)
+    ).all()
+    by_id = {msg.id: (msg, sender) for msg, sender in rows}
+
+    # Partner username per connection for display
+    connections = db.query(Connection).filter(Connection.id.in_({msg.connection_id for msg, _ in rows})).all()
+    partner_ids = {c.id: (c.user2_id if c.user1_id == user_id else c.user1_id) for c in connections}
+    partner_names = dict(db.query(User.id, User.username).filter(User.id.in_(set(partner_ids.values()))).all())
+
+    for message_id in page_ids:
+        if message_id not in by_id:
+            # Deleted or archived since it was indexed
+            if backend == "memory":
+                memory_index.discard(message_id, tokenize(query))
+            continue
+        msg, sender = by_id[message_id]
+        result["results"].append({
+            "id": msg.id,
+            "connection_id": msg.connection_id,
+            "with": partner_names.get(partner_ids.get(msg.connection_id)),
+            "sender": sender,
+            "timestamp": msg.timestamp.isoformat() if msg.timestamp else None,
+            "snippet": snippets.get(message_id) or highlight(msg.content, query)
+        })
+
+    return result
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Halloween Poe Chat - Production Launcher
+Runs the combined REST + Socket.IO app (main_advanced:socket_app) under
+N uvicorn worker processes with graceful shutdown.
+
+Chat rooms and cooldown pushes live in each worker, so more than one
+worker needs SOCKETIO_REDIS_URL to share them, and AUTH_SECRET_KEYS so
+every worker verifies the tokens the others sign (without it each
+process signs with its own random key). Unless both are set the launcher
+runs a single worker by default and refuses --workers above 1; with both
+the default is one worker per CPU. Keep
+clients on the websocket transport (or put a sticky-session load balancer
+in front) since long-polling requests must reach the worker that owns the
+session.
+"""
+import os
+import sys
+import argparse
+import tempfile
+import uvicorn
+from dotenv import load_dotenv
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+load_dotenv()
+
+def prepare_database():
+    """Create tables and indexes once, before workers start"""
+    sys.path.insert(0, BACKEND_DIR)
+    from database import create_tables, dispose_engine
+    from search import setup_search_index
+    create_tables()
+    setup_search_index()
+    # Workers must not inherit the parent's pooled connections
+    dispose_engine()
+
+def main():
+    parser = argparse.ArgumentParser(description="Halloween Poe Chat - production server")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    shared_rooms = bool(os.getenv("SOCKETIO_REDIS_URL"))
+    shared_keys = bool(os.getenv("AUTH_SECRET_KEYS"))
+    default_workers = (os.cpu_count() or 1) if shared_rooms and shared_keys else 1
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(default_workers))))
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="seconds to let in-flight requests finish on shutdown")
+    parser.add_argument("--log-level", default=os.getenv("UVICORN_LOG_LEVEL", "info"))
+    parser.add_argument("--skip-db-setup", action="store_true")
+    args = parser.parse_args()
+
+    if args.workers > 1 and not shared_rooms:
+        # Users on different workers would never see each other's messages
+        parser.error(f"{args.workers} workers need SOCKETIO_REDIS_URL so chat rooms are shared between them")
+    if args.workers > 1 and not shared_keys:
+        # A token signed by one worker would get a 401 from the others
+        parser.error(f"{args.workers} workers need AUTH_SECRET_KEYS so they all verify the same session tokens")
+
+    if not args.skip_db_setup:
+        prepare_database()
+
+    if args.workers > 1 and not os.getenv("METRICS_DIR"):
+        # Workers publish their metrics here so any one of them can serve the whole server's /metrics
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="poe_metrics_")
+
+    print(f"🎃 Halloween Poe Chat on http://{args.host}:{args.port} ({args.workers} workers)")
+    uvicorn.run(
+        "main_advanced:socket_app",
+        app_dir=BACKEND_DIR,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level,
+        proxy_headers=True,
+    )
+
+if __name__ == "__main__":
+    main()
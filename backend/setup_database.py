@@ -106,6 +106,7 @@ def insert_sample_data():
     try:
         print("Inserting sample data...")
         from database import SessionLocal, User
+        from answers import hash_answers
         import json
         import hashlib
         
@@ -127,7 +128,8 @@ def insert_sample_data():
                 "What color represents your soul?",
                 "What is your spirit animal?"
             ]),
-            answers=json.dumps([
+            answers="[]",
+            answer_hashes=hash_answers([
                 "Dracula",
                 "Deep purple",
                 "Raven"
@@ -197,6 +199,24 @@ def main():
     if not insert_sample_data():
         return False
     
+    # Step 6: Optional monthly partitioning of the messages table
+    if os.getenv('MESSAGE_PARTITIONING', '').lower() == 'monthly':
+        from retention import partition_messages_table
+        try:
+            if not partition_messages_table():
+                return False
+        except Exception as e:
+            print(f"ERROR: Error partitioning messages: {e}")
+            return False
+    
+    # Step 7: Full-text search index (after partitioning, so it covers the partitioned table)
+    try:
+        from search import setup_search_index
+        setup_search_index()
+    except Exception as e:
+        print(f"ERROR: Error creating search index: {e}")
+        return False
+    
     print("\nDatabase setup completed successfully!")
     print("\nYou can now start the application with:")
     print("python start_advanced.py")
@@ -1,27 +1,295 @@
 import socketio
 import asyncio
-from typing import Dict, Set
+import logging
+import os
+import time
+from typing import Dict, List, Set
 import json
 from datetime import datetime
+from typing import Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from metrics import WS_CONNECTIONS, WS_ROOMS, WS_MESSAGES, WS_DROPPED, WS_ROOM_AUTH, metrics_app
+from logging_config import setup_logging
+from database import SessionLocal, User, Connection, router
+from group_rooms import find_group, load_members
+from message_log import store_message, messages_after, normalize_client_id
+from retention import MESSAGE_HISTORY_LIMIT
+from backpressure import BackpressureServer, FanoutManager, RedisFanoutManager, RateLimiter, WS_MAX_MESSAGE_CHARS
+from compact_protocol import FrameBatcher, wants_compact, decode_message, epoch_ms, iso_timestamp
+from auth import AuthError, TokenClaims, AUTH_REQUIRED, verify_token
 
-# Create SocketIO server
-sio = socketio.AsyncServer(
+setup_logging()
+logger = logging.getLogger("websocket_server")
+
+# Seconds a verified user pair stays cached before join_chat checks the database again.
+# Deactivations are applied immediately in the worker that handles them; other workers
+# drop the room members right away (close_room goes through Redis) and re-check within this time.
+WS_AUTH_CACHE_TTL = float(os.getenv("WS_AUTH_CACHE_TTL", "60"))
+
+# Share rooms across worker processes through Redis when configured
+SOCKETIO_REDIS_URL = os.getenv("SOCKETIO_REDIS_URL")
+client_manager = RedisFanoutManager(SOCKETIO_REDIS_URL) if SOCKETIO_REDIS_URL else FanoutManager()
+
+# Create SocketIO server (bounded per-connection send queues, see backpressure.py)
+sio = BackpressureServer(
+    async_mode='asgi',
+    client_manager=client_manager,
     cors_allowed_origins=["http://localhost:3000"],
-    logger=True,
-    engineio_logger=True
+    # Verbosity is controlled per module through LOG_LEVELS (socketio/engineio)
+    logger=logging.getLogger("socketio"),
+    engineio_logger=logging.getLogger("engineio")
 )
 
 # Store active connections
-active_connections: Dict[str, Set[str]] = {}  # username -> set of room_ids
+active_connections: Dict[str, Set[str]] = {}  # username -> set of sids
 user_rooms: Dict[str, str] = {}  # username -> current_room
 
+# Room authorization: two users share a room only when an active Connection links them.
+# The database is checked once per join; message events only look at these dicts.
+chat_rooms: Dict[int, Dict[str, int]] = {}  # connection id -> {username: user id}
+pair_rooms: Dict[Tuple[str, str], Tuple[int, float]] = {}  # (username, username) sorted -> (connection id, verified at)
+bindings: Dict[str, Dict[int, str]] = {}  # sid -> {connection id: username} for the rooms it joined
+
+# Group rooms (group_rooms.py): members are loaded once per room and re-read when
+# someone not in the cached list joins, or after WS_AUTH_CACHE_TTL
+group_members: Dict[str, Tuple[Dict[str, int], float]] = {}  # group room id -> ({username: user id}, loaded at)
+group_bindings: Dict[str, Dict[str, str]] = {}  # sid -> {group room id: username} for the groups it joined
+
+# Compact (msgpack) clients, see compact_protocol.py
+compact_clients: Set[str] = set()
+
+# Identity from a verified session token (auth.py), by sid
+session_claims: Dict[str, TokenClaims] = {}
+
+# Inbound message limit per user id, so extra sockets or reconnects do not reset it
+rate_limiter = RateLimiter()
+
+def update_room_gauge():
+    WS_ROOMS.set(len(set(user_rooms.values())))
+
+def pair_key(username: str, target_username: str) -> Tuple[str, str]:
+    return (min(username, target_username), max(username, target_username))
+
+def room_name(connection_id: int) -> str:
+    return f"chat:{connection_id}"
+
+def compact_room(room_id: str) -> str:
+    return f"{room_id}:compact"
+
+def cooldown_room(username: str) -> str:
+    return f"cooldowns:{username}"
+
+def group_room(room_id: str) -> str:
+    return f"group:{room_id}"
+
+def in_room(sid: str, room_id: str) -> bool:
+    return sid in sio.manager.rooms.get('/', {}).get(room_id, ())
+
+def has_members(room_id: str) -> bool:
+    return bool(sio.manager.rooms.get('/', {}).get(room_id))
+
+async def emit_frame(room_id: str, frame: bytes):
+    await sio.emit('frames', frame, room=compact_room(room_id))
+
+frame_batcher = FrameBatcher(emit_frame)
+
+def lookup_room_ids(username: str, target_username: str) -> Optional[Tuple[int, Dict[str, int]]]:
+    """Connection id and user ids for a chat, or None if the two users have no active connection"""
+    db = SessionLocal()
+    try:
+        users = {user.username: user.id for user in db.query(User).filter(User.username.in_([username, target_username]))}
+        if len(users) < 2 and username != target_username:
+            return None
+        user_id, target_id = users.get(username), users.get(target_username)
+        connection = db.query(Connection).filter(
+            ((Connection.user1_id == user_id) & (Connection.user2_id == target_id)) |
+            ((Connection.user1_id == target_id) & (Connection.user2_id == user_id)),
+            Connection.is_active.isnot(False)
+        ).first()
+        return (connection.id, users) if connection else None
+    finally:
+        db.close()
+
+async def authorize_pair(username: str, target_username: str) -> Optional[int]:
+    """Connection id that lets the two users chat, from the cache or the database"""
+    key = pair_key(username, target_username)
+    cached = pair_rooms.get(key)
+    if cached is not None and time.monotonic() - cached[1] < WS_AUTH_CACHE_TTL:
+        WS_ROOM_AUTH.inc(result="cached")
+        return cached[0]
+    ids = await run_in_threadpool(lookup_room_ids, username, target_username)
+    if ids is None:
+        pair_rooms.pop(key, None)
+        WS_ROOM_AUTH.inc(result="denied")
+        return None
+    connection_id, users = ids
+    chat_rooms[connection_id] = users
+    pair_rooms[key] = (connection_id, time.monotonic())
+    WS_ROOM_AUTH.inc(result="checked")
+    return connection_id
+
+def lookup_group_members(room_id: str) -> Optional[Dict[str, int]]:
+    """{username: user id} for an active group, or None if there is no such group"""
+    db = SessionLocal()
+    try:
+        room = find_group(db, room_id)
+        return load_members(db, room.id) if room else None
+    finally:
+        db.close()
+
+async def authorize_group(room_id: str, username: str) -> bool:
+    """Whether the user is a member of the group, from the cache or the database"""
+    cached = group_members.get(room_id)
+    if cached is not None and username in cached[0] and time.monotonic() - cached[1] < WS_AUTH_CACHE_TTL:
+        WS_ROOM_AUTH.inc(result="cached")
+        return True
+    members = await run_in_threadpool(lookup_group_members, room_id)
+    if members is None:
+        group_members.pop(room_id, None)
+    else:
+        group_members[room_id] = (members, time.monotonic())
+    allowed = members is not None and username in members
+    WS_ROOM_AUTH.inc(result="checked" if allowed else "denied")
+    return allowed
+
+def bound_room(sid: str, username: str, connection_id: Optional[int]) -> Optional[str]:
+    """Room name if this sid joined the connection's room as username and is still in it (no DB access)"""
+    if connection_id is None or bindings.get(sid, {}).get(connection_id) != username:
+        return None
+    room_id = room_name(connection_id)
+    # close_room reaches every worker, so this also catches deactivations handled elsewhere
+    if in_room(sid, room_id) or in_room(sid, compact_room(room_id)):
+        return room_id
+    return None
+
+async def revoke_connection(connection_id: int):
+    """Forget a deactivated connection and remove everyone from its room"""
+    chat_rooms.pop(connection_id, None)
+    for key in [key for key, (cached_id, _) in pair_rooms.items() if cached_id == connection_id]:
+        del pair_rooms[key]
+    for rooms in bindings.values():
+        rooms.pop(connection_id, None)
+    room_id = room_name(connection_id)
+    for room in (room_id, compact_room(room_id)):
+        await sio.emit('chat_closed', {'room': connection_id}, room=room)
+        await sio.close_room(room)
+    logger.info("Chat room closed", extra={"connection_id": connection_id})
+
+async def notify_cooldown_expired(username: str, target_username: str):
+    """Tell the user's watching clients they can try the target again"""
+    await sio.emit('cooldown_expired', {
+        'target_username': target_username,
+        'timestamp': datetime.now().isoformat()
+    }, room=cooldown_room(username))
+
+def identify(sid: str, data: dict) -> Tuple[Optional[str], Optional[dict]]:
+    """(username, error ack) for an event: the token's user when there is one, else the claimed username"""
+    username = data.get('username')
+    # A token (sent on connect or with the event) identifies the user without a DB lookup
+    if data.get('token'):
+        try:
+            session_claims[sid] = verify_token(data['token'])
+        except AuthError as e:
+            return None, {'error': str(e)}
+    claims = session_claims.get(sid)
+    if claims is not None:
+        if username and username != claims.username:
+            return None, {'error': 'Token does not belong to this user'}
+        return claims.username, None
+    if AUTH_REQUIRED:
+        return None, {'error': 'Authentication required'}
+    return username, None
+
+async def reject_message(sid, message_id, reason: str):
+    WS_DROPPED.inc(reason=reason)
+    logger.debug("Message rejected", extra={"sid": sid, "reason": reason})
+    await sio.emit('message_rejected', {'id': message_id, 'reason': reason}, to=sid)
+
+async def accept_message(sid, message_id, message_text: str, user_id: Optional[int]) -> bool:
+    """Apply the size limit and the sending user's rate limit, telling the sender when a message is dropped"""
+    if len(message_text) > WS_MAX_MESSAGE_CHARS:
+        reason = "payload_too_large"
+    elif not rate_limiter.allow(user_id if user_id is not None else sid):
+        reason = "rate_limited"
+    else:
+        return True
+    await reject_message(sid, message_id, reason)
+    return False
+
+def deliver_compact(connection_id: int, sender: str, message_id, timestamp_ms: int, text: str, seq: int):
+    """Queue a message for the room's compact clients, if it has any"""
+    room_id = room_name(connection_id)
+    if not has_members(compact_room(room_id)):
+        return
+    user_ids = chat_rooms.get(connection_id, {})
+    frame_batcher.add(room_id, [connection_id, user_ids.get(sender), message_id, timestamp_ms, text, seq])
+
+def save_message(connection_id: int, sender: str, client_id, text: str) -> Optional[Tuple[int, bool]]:
+    """Store a chat message; (seq, created) or None if the sender is not in the room's users"""
+    sender_id = chat_rooms.get(connection_id, {}).get(sender)
+    if sender_id is None:
+        return None
+    db = SessionLocal()
+    try:
+        message, created = store_message(db, connection_id, sender_id, text, normalize_client_id(client_id))
+        router.mark_write(sender_id)
+        return message.seq, created
+    finally:
+        db.close()
+
+async def persist_message(sid, connection_id: int, sender: str, client_id, text: str) -> Optional[Tuple[int, bool]]:
+    """save_message off the event loop; tells the sender when the message could not be stored"""
+    try:
+        stored = await run_in_threadpool(save_message, connection_id, sender, client_id, text)
+    except Exception as e:
+        logger.warning("Message not stored", extra={"connection_id": connection_id, "error": str(e)})
+        stored = None
+    if stored is None:
+        await reject_message(sid, client_id, "not_stored")
+    return stored
+
+def load_gap(connection_id: int, after_seq: int) -> Tuple[List[Dict], bool]:
+    """Messages after a seq in the JSON event shape, and whether more remain"""
+    usernames = {user_id: username for username, user_id in chat_rooms.get(connection_id, {}).items()}
+    db = SessionLocal()
+    try:
+        rows = messages_after(db, connection_id, after_seq, MESSAGE_HISTORY_LIMIT + 1)
+    finally:
+        db.close()
+    messages = [
+        {
+            'id': row.client_id or row.id,
+            'seq': row.seq,
+            'text': row.content,
+            'sender': usernames.get(row.sender_id),
+            'timestamp': row.timestamp.isoformat()
+        }
+        for row in rows[:MESSAGE_HISTORY_LIMIT]
+    ]
+    return messages, len(rows) > MESSAGE_HISTORY_LIMIT
+
 @sio.event
-async def connect(sid, environ):
-    print(f"Client {sid} connected")
+async def connect(sid, environ, auth=None):
+    logger.debug("Client connected", extra={"sid": sid})
+    WS_CONNECTIONS.inc()
+    if wants_compact(environ, auth):
+        compact_clients.add(sid)
+    token = auth.get('token') if isinstance(auth, dict) else None
+    if token:
+        try:
+            session_claims[sid] = verify_token(token)
+        except AuthError as e:
+            raise socketio.exceptions.ConnectionRefusedError(str(e))
 
 @sio.event
 async def disconnect(sid):
-    print(f"Client {sid} disconnected")
+    logger.debug("Client disconnected", extra={"sid": sid})
+    WS_CONNECTIONS.dec()
+    compact_clients.discard(sid)
+    bindings.pop(sid, None)
+    group_bindings.pop(sid, None)
+    session_claims.pop(sid, None)
+    rate_limiter.prune()
     # Clean up user connections
     for username, rooms in active_connections.items():
         if sid in rooms:
@@ -33,29 +301,50 @@ async def disconnect(sid):
 @sio.event
 async def join_chat(sid, data):
     """Handle user joining a chat room"""
-    username = data.get('username')
     target_username = data.get('targetUsername')
+    username, error = identify(sid, data)
+    if error:
+        return error
     
     if not username or not target_username:
         return
     
-    # Create room ID for the chat
-    room_id = f"chat_{min(username, target_username)}_{max(username, target_username)}"
+    # Only connected users share a room, keyed by the connection id
+    connection_id = await authorize_pair(username, target_username)
+    if connection_id is None:
+        return {'error': 'No connection between these users'}
+    room_id = room_name(connection_id)
+    bindings.setdefault(sid, {})[connection_id] = username
     
-    # Join the room
-    await sio.enter_room(sid, room_id)
+    # Join the room (compact clients get frames instead of JSON messages)
+    if sid in compact_clients:
+        await sio.enter_room(sid, compact_room(room_id))
+    else:
+        await sio.enter_room(sid, room_id)
     
     # Store connection info
     if username not in active_connections:
         active_connections[username] = set()
     active_connections[username].add(sid)
     user_rooms[username] = room_id
+    update_room_gauge()
     
     # Notify others in the room
-    await sio.emit('user_joined', {
+    notice = {
         'username': username,
         'timestamp': datetime.now().isoformat()
-    }, room=room_id, skip_sid=sid)
+    }
+    await sio.emit('user_joined', notice, room=room_id, skip_sid=sid)
+    if has_members(compact_room(room_id)):
+        await sio.emit('user_joined', notice, room=compact_room(room_id), skip_sid=sid)
+    
+    # A reconnecting client sends the last seq it has and gets only what it missed
+    # (a live message can arrive while the gap loads; it carries the same seq)
+    resume_from = data.get('resumeFrom')
+    if isinstance(resume_from, int) and not isinstance(resume_from, bool):
+        messages, has_more = await run_in_threadpool(load_gap, connection_id, resume_from)
+        await sio.emit('sync', {'room': connection_id, 'messages': messages, 'has_more': has_more}, to=sid)
+    return {'room': connection_id, 'users': chat_rooms[connection_id]}
 
 @sio.event
 async def message(sid, data):
@@ -66,13 +355,32 @@ async def message(sid, data):
     
     if not username or not target_username or not message_text:
         return
+    # Authenticated connections can only send as their own user
+    claims = session_claims.get(sid)
+    if (claims.username != username) if claims is not None else AUTH_REQUIRED:
+        return
     
-    # Create room ID
-    room_id = f"chat_{min(username, target_username)}_{max(username, target_username)}"
+    # Only to a room this sid joined as the sender (and has not been removed from)
+    connection_id, _ = pair_rooms.get(pair_key(username, target_username), (None, None))
+    room_id = bound_room(sid, username, connection_id)
+    if room_id is None:
+        await reject_message(sid, data.get('id'), "not_authorized")
+        return
+    if not await accept_message(sid, data.get('id'), message_text, chat_rooms.get(connection_id, {}).get(username)):
+        return
+    
+    # Store it first: the client id is the idempotency key, so a resent message is acked, not repeated
+    stored = await persist_message(sid, connection_id, username, data.get('id'), message_text)
+    if stored is None:
+        return
+    seq, created = stored
+    if not created:
+        return {'seq': seq, 'duplicate': True}
     
     # Prepare message data
     message_data = {
         'id': data.get('id'),
+        'seq': seq,
         'text': message_text,
         'sender': username,
         'timestamp': data.get('timestamp'),
@@ -81,35 +389,160 @@ async def message(sid, data):
     
     # Send message to all users in the room
     await sio.emit('message', message_data, room=room_id)
+    deliver_compact(connection_id, username, data.get('id'), epoch_ms(data.get('timestamp')), message_text, seq)
+    WS_MESSAGES.inc()
+    return {'seq': seq}
+
+@sio.event
+async def message_compact(sid, payload):
+    """Handle a msgpack message from a compact client"""
+    message = decode_message(payload) if isinstance(payload, bytes) else None
+    if sid not in compact_clients or message is None:
+        return
+    connection_id, message_id, timestamp_ms, message_text = message
+    username = bindings.get(sid, {}).get(connection_id)
+    room_id = bound_room(sid, username, connection_id)
+    if room_id is None:
+        await reject_message(sid, message_id, "not_authorized")
+        return
+    if not await accept_message(sid, message_id, message_text, chat_rooms.get(connection_id, {}).get(username)):
+        return
+    stored = await persist_message(sid, connection_id, username, message_id, message_text)
+    if stored is None:
+        return
+    seq, created = stored
+    if not created:
+        return {'seq': seq, 'duplicate': True}
+    timestamp_ms = epoch_ms(timestamp_ms)
+
+    # Older clients in the room still get the JSON message
+    await sio.emit('message', {
+        'id': message_id,
+        'seq': seq,
+        'text': message_text,
+        'sender': username,
+        'timestamp': iso_timestamp(timestamp_ms),
+        'room_id': room_id
+    }, room=room_id)
+    deliver_compact(connection_id, username, message_id, timestamp_ms, message_text, seq)
+    WS_MESSAGES.inc()
+    return {'seq': seq}
+
+@sio.event
+async def watch_cooldowns(sid, data):
+    """Receive cooldown_expired events for the token holder (the connection attempt page)
+
+    Unlike the chat events this needs a verified token even when AUTH_REQUIRED
+    is off: a claimed username would let anyone watch another user's attempts.
+    """
+    username, error = identify(sid, data if isinstance(data, dict) else {})
+    if error:
+        return error
+    if sid not in session_claims:
+        return {'error': 'Authentication required'}
+    await sio.enter_room(sid, cooldown_room(username))
+    return {'username': username}
+
+@sio.event
+async def join_group(sid, data):
+    """Join a group room the user is a member of"""
+    room = data.get('room') if isinstance(data, dict) else None
+    username, error = identify(sid, data if isinstance(data, dict) else {})
+    if error:
+        return error
+    if not username or not isinstance(room, str):
+        return
+    if not await authorize_group(room, username):
+        return {'error': 'Not a member of this room'}
+    group_bindings.setdefault(sid, {})[room] = username
+    await sio.enter_room(sid, group_room(room))
+    await sio.emit('user_joined', {
+        'username': username,
+        'room': room,
+        'timestamp': datetime.now().isoformat()
+    }, room=group_room(room), skip_sid=sid)
+    return {'room': room, 'members': len(group_members[room][0])}
+
+@sio.event
+async def group_message(sid, data):
+    """Send a message to everyone in a group room (live only, not stored)"""
+    if not isinstance(data, dict):
+        return
+    room = data.get('room')
+    message_text = data.get('text')
+    if not isinstance(room, str) or not message_text:
+        return
+    # Only to a group this sid joined (the sender is the user it joined as)
+    username = group_bindings.get(sid, {}).get(room)
+    if username is None or not in_room(sid, group_room(room)):
+        await reject_message(sid, data.get('id'), "not_authorized")
+        return
+    if not await accept_message(sid, data.get('id'), message_text, group_members.get(room, ({}, 0))[0].get(username)):
+        return
+    
+    # One emit to the room: the packet is encoded once for all members (FanoutManager)
+    await sio.emit('group_message', {
+        'id': data.get('id'),
+        'room': room,
+        'text': message_text,
+        'sender': username,
+        'timestamp': data.get('timestamp')
+    }, room=group_room(room))
+    WS_MESSAGES.inc()
+    return {'room': room}
+
+@sio.event
+async def leave_group(sid, data):
+    """Leave a group room"""
+    room = data.get('room') if isinstance(data, dict) else None
+    username = group_bindings.get(sid, {}).pop(room, None)
+    if username is None:
+        return
+    await sio.leave_room(sid, group_room(room))
+    await sio.emit('user_left', {
+        'username': username,
+        'room': room,
+        'timestamp': datetime.now().isoformat()
+    }, room=group_room(room), skip_sid=sid)
 
 @sio.event
 async def leave_chat(sid, data):
-    """Handle user leaving a chat room"""
-    username = data.get('username')
+    """Handle user leaving a chat room (only rooms this sid joined, as the user it joined as)"""
+    claimed = data.get('username') if isinstance(data, dict) else None
+    rooms = bindings.get(sid, {})
+    leaving = [(connection_id, username) for connection_id, username in rooms.items() if claimed in (None, username)]
     
-    if username in user_rooms:
-        room_id = user_rooms[username]
+    for connection_id, username in leaving:
+        room_id = bound_room(sid, username, connection_id)
+        del rooms[connection_id]
+        if room_id is None:
+            continue
         
         # Leave the room
         await sio.leave_room(sid, room_id)
+        await sio.leave_room(sid, compact_room(room_id))
         
         # Notify others in the room
-        await sio.emit('user_left', {
+        notice = {
             'username': username,
             'timestamp': datetime.now().isoformat()
-        }, room=room_id, skip_sid=sid)
+        }
+        await sio.emit('user_left', notice, room=room_id, skip_sid=sid)
+        if has_members(compact_room(room_id)):
+            await sio.emit('user_left', notice, room=compact_room(room_id), skip_sid=sid)
         
-        # Clean up
-        if username in active_connections:
+        # Clean up (messages from this sid need a new join_chat)
+        if username in active_connections and username not in rooms.values():
             active_connections[username].discard(sid)
             if not active_connections[username]:
                 del active_connections[username]
         
-        if username in user_rooms:
+        if user_rooms.get(username) == room_id:
             del user_rooms[username]
+    update_room_gauge()
 
-# Create the SocketIO app
-socket_app = socketio.ASGIApp(sio)
+# Create the SocketIO app, serving /metrics for everything that isn't Socket.IO
+socket_app = socketio.ASGIApp(sio, other_asgi_app=metrics_app)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,158 @@
+"""
+Benchmark fixtures for Halloween Poe Chat
+Provides a pytest-benchmark style `benchmark` fixture that times a hot path
+and compares its fastest round against benchmarks/baselines.json. The
+minimum is used because it is far less sensitive to scheduler noise than
+the median on shared machines.
+
+Baselines are scaled to the machine running the comparison: every session
+first times a fixed calibration workload, and each baseline is multiplied
+by how much slower (or faster) that workload runs than when the baselines
+were saved. Regressions are reported in the summary; they only fail the run
+with BENCH_GATE=1, so a noisy runner does not break the default test run.
+
+Environment:
+    BENCH_GATE=1     fail benchmarks that regress (default: report only)
+    BENCH_THRESHOLD  allowed slowdown vs. the scaled baseline (default 1.5 = +50%)
+    BENCH_SAVE=1     write this run's timings as the new baselines
+    BENCH_MIN_TIME   seconds to spend per benchmark (default 0.2)
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import statistics
+
+import pytest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(BENCH_DIR), "backend")
+BASELINES_PATH = os.path.join(BENCH_DIR, "baselines.json")
+RESULTS_PATH = os.path.join(BENCH_DIR, "results.json")
+
+BENCH_GATE = os.getenv("BENCH_GATE", "") == "1"
+BENCH_THRESHOLD = float(os.getenv("BENCH_THRESHOLD", "1.5"))
+BENCH_SAVE = os.getenv("BENCH_SAVE", "") == "1"
+BENCH_MIN_TIME = float(os.getenv("BENCH_MIN_TIME", "0.2"))
+BENCH_MIN_ROUNDS = 3
+BENCH_MAX_ROUNDS = 10000
+CALIBRATION = "_calibration"
+
+# The backend reads its configuration at import time
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="poe_bench_"), "bench.db")
+os.environ.setdefault("MESSAGE_HISTORY_LIMIT", "100000")
+os.environ.pop("AWS_ACCESS_KEY_ID", None)
+os.environ["ANSWER_HASH_KEY"] = "bench-answer-hash-key"
+sys.path.insert(0, BACKEND_DIR)
+
+_results = {}
+_regressions = []
+
+def load_baselines():
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as f:
+            return json.load(f)
+    return {}
+
+def time_rounds(fn, *args, **kwargs):
+    """Warm up, then time fn for BENCH_MIN_TIME; returns (timings, last result)"""
+    result = fn(*args, **kwargs)
+    timings = []
+    deadline = time.perf_counter() + BENCH_MIN_TIME
+    while len(timings) < BENCH_MAX_ROUNDS and (len(timings) < BENCH_MIN_ROUNDS or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+def calibration_workload():
+    """Fixed interpreter-bound work (string, dict and hashing) to gauge this machine's speed"""
+    words = {}
+    for i in range(5000):
+        key = f"raven-{i % 97}"
+        words[key] = words.get(key, 0) + hash((key, i)) % 7
+    return len(words)
+
+def machine_speed(baselines):
+    """This machine's calibration time over the one the baselines were saved with"""
+    timings, _ = time_rounds(calibration_workload)
+    current = min(timings)
+    _results[CALIBRATION] = {"rounds": len(timings), "min": current, "median": statistics.median(timings),
+                             "mean": statistics.fmean(timings)}
+    saved = baselines.get(CALIBRATION)
+    return current / saved["min"] if saved else 1.0
+
+class Benchmark:
+    """Callable timer, mirroring pytest-benchmark's benchmark(fn, *args)"""
+
+    def __init__(self, name, baselines, speed=1.0):
+        self.name = name
+        self.baselines = baselines
+        self.speed = speed
+        self.stats = None
+
+    def __call__(self, fn, *args, **kwargs):
+        timings, result = time_rounds(fn, *args, **kwargs)
+        self.stats = {
+            "rounds": len(timings),
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.fmean(timings),
+        }
+        _results[self.name] = self.stats
+
+        baseline = self.baselines.get(self.name)
+        if baseline and not BENCH_SAVE:
+            expected = baseline["min"] * self.speed
+            if self.stats["min"] > expected * BENCH_THRESHOLD:
+                message = (f"{self.name} regressed: {self.stats['min'] * 1e6:.1f}us vs baseline "
+                           f"{expected * 1e6:.1f}us (x{self.speed:.2f} machine speed, threshold x{BENCH_THRESHOLD})")
+                _regressions.append(message)
+                if BENCH_GATE:
+                    pytest.fail(message)
+        return result
+
+@pytest.fixture(scope="session")
+def baselines():
+    return load_baselines()
+
+@pytest.fixture(scope="session")
+def speed(baselines):
+    return machine_speed(baselines)
+
+@pytest.fixture
+def benchmark(request, baselines, speed):
+    return Benchmark(request.node.name, baselines, speed)
+
+@pytest.fixture(scope="session")
+def backend():
+    """Import the app once with a fresh SQLite database and no Bedrock"""
+    import database
+    database.engine.echo = False
+    database.create_tables()
+
+    import main
+    main.bedrock_available = False
+    main.bedrock_client = None
+    return main
+
+def pytest_terminal_summary(terminalreporter):
+    if _regressions and not BENCH_GATE:
+        terminalreporter.section("benchmark regressions (report only, BENCH_GATE=1 fails on them)")
+        for message in _regressions:
+            terminalreporter.write_line(message)
+
+def pytest_sessionfinish(session, exitstatus):
+    if not _results:
+        return
+
+    with open(RESULTS_PATH, "w") as f:
+        json.dump(_results, f, indent=2, sort_keys=True)
+
+    if BENCH_SAVE:
+        merged = load_baselines()
+        merged.update({name: {"min": stats["min"], "median": stats["median"]} for name, stats in _results.items()})
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+            f.write("\n")
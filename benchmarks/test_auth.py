@@ -0,0 +1,38 @@
+"""
+Benchmarks for identifying the caller: username lookup vs. signed token
+"""
+import uuid
+
+import pytest
+
+@pytest.fixture(scope="module")
+def caller(backend):
+    from database import SessionLocal, User
+    from auth import issue_token
+
+    db = SessionLocal()
+    user = User(username=f"bench_caller_{uuid.uuid4().hex[:6]}", password_hash=backend.hash_password("nevermore"),
+                questions="[]", answers="[]", poem="")
+    db.add(user)
+    db.commit()
+    yield db, user.id, user.username, issue_token(user.id, user.username)
+    db.close()
+
+def test_identify_caller_lookup(backend, caller, benchmark):
+    db, user_id, username, _ = caller
+    assert benchmark(backend.resolve_caller, db, None, username) == (user_id, username)
+
+def test_identify_caller_token(backend, caller, benchmark):
+    db, user_id, username, token = caller
+
+    def identify():
+        return backend.resolve_caller(db, backend.get_caller(f"Bearer {token}"), None)
+
+    assert benchmark(identify) == (user_id, username)
+
+def test_identify_caller_token_uncached(backend, caller, benchmark):
+    # Worst case: first request with a token, full HMAC and claim checks
+    from auth import check_signature
+
+    _, user_id, _, token = caller
+    assert benchmark(check_signature.__wrapped__, token).user_id == user_id
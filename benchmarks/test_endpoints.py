@@ -0,0 +1,78 @@
+"""
+Benchmarks for the chat history and user directory read paths
+"""
+import asyncio
+import pytest
+
+MESSAGE_COUNTS = [10, 1000, 100000]
+DIRECTORY_SIZE = 1000
+
+@pytest.fixture(scope="module")
+def chat_data(backend):
+    """One connection per history size plus a user directory, bulk-loaded"""
+    import random
+    from database import SessionLocal, User, Connection, Message
+    from generate_data import bulk_insert, generate_users, generate_messages
+
+    rng = random.Random(1849)
+    bulk_insert(User.__table__, generate_users(DIRECTORY_SIZE, "bench_user_", 30, rng), 10000)
+
+    db = SessionLocal()
+    users = {user.username: user for user in db.query(User).filter(User.username.like("bench_user_%")).limit(len(MESSAGE_COUNTS) + 1)}
+    reader, *targets = sorted(users.values(), key=lambda user: user.id)
+
+    for target, count in zip(targets, MESSAGE_COUNTS):
+        connection = Connection(user1_id=reader.id, user2_id=target.id, last_seq=count)
+        db.add(connection)
+        db.commit()
+        bulk_insert(Message.__table__, generate_messages([(connection.id, reader.id, target.id)], count, 30, rng), 10000)
+
+    yield db, reader, dict(zip(MESSAGE_COUNTS, targets))
+    db.close()
+
+@pytest.mark.parametrize("count", MESSAGE_COUNTS)
+def test_get_messages(backend, chat_data, benchmark, count):
+    db, reader, targets = chat_data
+
+    def fetch():
+        return asyncio.run(backend.get_messages(reader.id, targets[count].username, limit=count, db=db, caller=None))
+
+    messages = benchmark(fetch)
+    assert len(messages) == count
+
+def test_get_users(backend, chat_data, benchmark):
+    db, _, _ = chat_data
+    users = benchmark(lambda: asyncio.run(backend.get_users(db=db)))
+    assert len(users) >= DIRECTORY_SIZE
+
+SERIALIZED_HISTORY = 10000
+
+@pytest.fixture(scope="module")
+def history_rows():
+    from datetime import datetime, timedelta
+    start = datetime(2025, 10, 1)
+    return [
+        {"id": i, "seq": i + 1, "content": f"Quoth the raven, nevermore ({i})", "sender": "bench_user_0000001",
+         "timestamp": start + timedelta(seconds=i * 37)}
+        for i in range(SERIALIZED_HISTORY)
+    ]
+
+@pytest.mark.parametrize("encoder", ["jsonable_encoder", "response_model"])
+def test_serialize_messages(backend, history_rows, benchmark, encoder):
+    """A 10k-message /messages body: the old dict + jsonable_encoder path vs the response model + orjson"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.routing import serialize_response
+    from starlette.responses import JSONResponse
+
+    route = next(route for route in backend.app.routes if getattr(route, "path", None) == "/messages/{user_id}/{target_username}")
+
+    def legacy():
+        rows = [{**row, "timestamp": row["timestamp"].isoformat()} for row in history_rows]
+        return JSONResponse(jsonable_encoder(rows)).body
+
+    def current():
+        content = asyncio.run(serialize_response(field=route.response_field, response_content=history_rows))
+        return backend.ProfiledJSONResponse(content).body
+
+    body = benchmark(legacy if encoder == "jsonable_encoder" else current)
+    assert body.count(b'"seq":') == SERIALIZED_HISTORY
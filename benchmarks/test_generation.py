@@ -0,0 +1,32 @@
+"""
+Benchmarks for poem/cryptic message fallback rendering and answer checks
+"""
+import asyncio
+
+from answers import hash_answers
+
+ANSWERS = ["Dracula", "Deep purple", "Raven"]
+
+def run_on(loop, coroutine_function, *args):
+    return loop.run_until_complete(coroutine_function(*args))
+
+def test_generate_poe_poem_fallback(backend, benchmark):
+    loop = asyncio.new_event_loop()
+    try:
+        poem = benchmark(run_on, loop, backend.generate_poe_poem, ANSWERS)
+    finally:
+        loop.close()
+    assert "Dracula" in poem or "Raven" in poem
+
+def test_generate_cryptic_message_fallback(backend, benchmark):
+    loop = asyncio.new_event_loop()
+    try:
+        message = benchmark(run_on, loop, backend.generate_cryptic_message, ANSWERS)
+    finally:
+        loop.close()
+    assert message
+
+def test_count_correct_answers(backend, benchmark):
+    stored = hash_answers(ANSWERS)
+    correct = benchmark(backend.count_correct_answers, stored, [" dracula", "DEEP PURPLE ", "crow"])
+    assert correct == 2
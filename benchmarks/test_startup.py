@@ -0,0 +1,37 @@
+"""
+Cold-start benchmarks: import cost of the app measured with `python -X importtime`
+"""
+import os
+import sys
+import subprocess
+
+from conftest import BACKEND_DIR
+
+# Created on first use, so importing the app must not pull these in
+LAZY_MODULES = ["boto3", "botocore"]
+
+def import_times(module: str) -> dict:
+    """Cumulative import time in microseconds per module, from a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, env=os.environ.copy(), capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def test_import_main(benchmark):
+    times = benchmark(import_times, "main")
+    assert "main" in times
+    for module in LAZY_MODULES:
+        assert module not in times, f"{module} imported at startup"
+
+def test_import_combined_app(benchmark):
+    times = benchmark(import_times, "main_advanced")
+    assert "websocket_server" in times
+    for module in LAZY_MODULES:
+        assert module not in times, f"{module} imported at startup"
@@ -0,0 +1,169 @@
+"""
+Benchmarks for websocket room join and broadcast
+Clients are registered directly with the Socket.IO manager and the engine.io
+transport is replaced with a counter, so this measures the server-side
+room bookkeeping and per-recipient fan-out rather than network I/O.
+Message storage is timed on its own (test_store_message).
+Group rooms are timed from a message arriving to a packet being handed to
+every member (test_group_delivery).
+"""
+import asyncio
+import itertools
+import pytest
+
+ROOM_SIZES = [2, 100]
+GROUP_SIZES = [2, 100, 5000]
+
+@pytest.fixture(scope="module")
+def socket_server(backend):
+    import websocket_server
+
+    sio = websocket_server.sio
+    sio.logger.disabled = True
+    sio.eio.logger.disabled = True
+    sent = {"count": 0}
+    original = (sio.eio.send, sio.eio.send_packet)
+
+    async def counting_send(eio_sid, data):
+        sent["count"] += 1
+
+    sio.eio.send = sio.eio.send_packet = counting_send
+    # One sender floods the room here, which is exactly what the rate limiter stops
+    rate = websocket_server.rate_limiter.rate
+    websocket_server.rate_limiter.rate = 0
+    seqs = itertools.count(1)
+    persist_message = websocket_server.persist_message
+
+    async def skip_storage(sid, connection_id, sender, client_id, text):
+        return next(seqs), True
+
+    websocket_server.persist_message = skip_storage
+    loop = asyncio.new_event_loop()
+    yield websocket_server, loop, sent
+    sio.eio.send, sio.eio.send_packet = original
+    websocket_server.rate_limiter.rate = rate
+    websocket_server.persist_message = persist_message
+    loop.close()
+
+def connect_clients(websocket_server, loop, count, prefix):
+    manager = websocket_server.sio.manager
+    return [loop.run_until_complete(manager.connect(f"{prefix}_eio_{i}", "/")) for i in range(count)]
+
+def connect_users(username, target_username) -> int:
+    """Register two users with a Connection between them, return the connection id"""
+    from database import SessionLocal, User, Connection
+
+    db = SessionLocal()
+    try:
+        users = [User(username=name, password_hash="", questions="[]", answers="[]") for name in (username, target_username)]
+        db.add_all(users)
+        db.flush()
+        connection = Connection(user1_id=users[0].id, user2_id=users[1].id)
+        db.add(connection)
+        db.commit()
+        return connection.id
+    finally:
+        db.close()
+
+def test_join_chat(socket_server, benchmark):
+    websocket_server, loop, _ = socket_server
+    sid = connect_clients(websocket_server, loop, 1, "join")[0]
+    connection_id = connect_users("alice", "bob")
+    data = {"username": "alice", "targetUsername": "bob"}
+    # The first join checks the database, the timed ones hit the authorization cache
+    ack = benchmark(lambda: loop.run_until_complete(websocket_server.join_chat(sid, data)))
+    assert ack["room"] == connection_id
+    assert websocket_server.room_name(connection_id) in websocket_server.user_rooms.values()
+
+@pytest.mark.parametrize("size", ROOM_SIZES)
+def test_broadcast(socket_server, benchmark, size):
+    websocket_server, loop, sent = socket_server
+    sids = connect_clients(websocket_server, loop, size, f"room{size}")
+    pair = (f"raven{size}", f"lenore{size}")
+    connect_users(*pair)
+    for i, sid in enumerate(sids):
+        username, target = pair if i % 2 == 0 else pair[::-1]
+        loop.run_until_complete(websocket_server.join_chat(sid, {"username": username, "targetUsername": target}))
+
+    data = {"id": 1, "sender": pair[0], "targetUsername": pair[1], "text": "Quoth the raven", "timestamp": "2025-10-31T00:00:00"}
+    sent["count"] = 0
+    benchmark(lambda: loop.run_until_complete(websocket_server.message(sids[0], data)))
+    assert sent["count"] > 0 and sent["count"] % size == 0
+
+def create_group(usernames) -> str:
+    """Register the users and put them all in one group, return its room id"""
+    from database import SessionLocal, User
+    from group_rooms import create_group, add_members
+
+    db = SessionLocal()
+    try:
+        db.add_all([User(username=name, password_hash="", questions="[]", answers="[]") for name in usernames])
+        db.commit()
+        creator_id = db.query(User.id).filter(User.username == usernames[0]).scalar()
+        room = create_group(db, creator_id, "The Raven Society")
+        add_members(db, room.id, usernames[1:])
+        return room.room_id
+    finally:
+        db.close()
+
+@pytest.mark.parametrize("size", GROUP_SIZES)
+def test_group_delivery(socket_server, benchmark, size):
+    websocket_server, loop, sent = socket_server
+    usernames = [f"group{size}_raven{i}" for i in range(size)]
+    room_id = create_group(usernames)
+    sids = connect_clients(websocket_server, loop, size, f"group{size}")
+    ack = loop.run_until_complete(websocket_server.join_group(sids[0], {"room": room_id, "username": usernames[0]}))
+    assert ack["members"] == size
+    # The other members enter the room directly (each join_group would also notify the whole room)
+    for sid in sids[1:]:
+        loop.run_until_complete(websocket_server.sio.enter_room(sid, websocket_server.group_room(room_id)))
+
+    data = {"id": 1, "room": room_id, "text": "Quoth the raven", "timestamp": "2025-10-31T00:00:00"}
+    sent["count"] = 0
+    benchmark(lambda: loop.run_until_complete(websocket_server.group_message(sids[0], data)))
+    assert sent["count"] > 0 and sent["count"] % size == 0
+
+def test_store_message(socket_server, benchmark):
+    """One websocket message written with its seq and idempotency key"""
+    from database import SessionLocal, Connection
+    from message_log import store_message
+
+    connection_id = connect_users("usher", "madeline")
+    client_ids = itertools.count()
+    db = SessionLocal()
+    try:
+        sender_id = db.get(Connection, connection_id).user1_id
+        message, created = benchmark(lambda: store_message(db, connection_id, sender_id, "The house fell", str(next(client_ids))))
+    finally:
+        db.close()
+    assert created and message.seq > 1
+
+BURST = 50
+
+def burst_messages():
+    return [
+        {"id": 1761955199000 + i, "text": f"Quoth the raven {i}", "sender": "raven",
+         "timestamp": "2025-10-31T23:59:59.000Z", "room_id": "chat_lenore_raven"}
+        for i in range(BURST)
+    ]
+
+def test_encode_burst_json(benchmark):
+    from socketio import packet
+
+    messages = burst_messages()
+    encode = lambda: [packet.Packet(packet.EVENT, data=["message", message]).encode() for message in messages]
+    frames = benchmark(encode)
+    assert len(frames) == BURST
+
+def test_encode_burst_compact(benchmark):
+    from socketio import packet
+    from compact_protocol import encode_frame, epoch_ms
+
+    messages = burst_messages()
+    records = [[7, 1, message["id"], epoch_ms(message["timestamp"]), message["text"]] for message in messages]
+    encode = lambda: packet.Packet(packet.EVENT, data=["frames", encode_frame(records)]).encode()
+    frame = benchmark(encode)
+
+    json_bytes = sum(len(packet.Packet(packet.EVENT, data=["message", message]).encode()) for message in messages)
+    compact_bytes = len(frame[0]) + len(frame[1])
+    assert compact_bytes < json_bytes / 2
@@ -201,6 +201,13 @@ const Chat = ({ currentUser, onBack }) => {
   const [loading, setLoading] = useState(true);
   const [targetUser, setTargetUser] = useState(null);
   const messagesEndRef = useRef(null);
+  const lastSeqRef = useRef(null);
+
+  const trackSeq = (seq) => {
+    if (seq && (lastSeqRef.current === null || seq > lastSeqRef.current)) {
+      lastSeqRef.current = seq;
+    }
+  };
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -253,10 +260,11 @@ const Chat = ({ currentUser, onBack }) => {
       console.log('Connected to server');
       setConnected(true);
       
-      // Join the chat room
+      // Join the chat room (after a reconnect, ask only for what we missed)
       newSocket.emit('join_chat', {
         username: currentUser.username,
-        targetUsername: targetUser.username
+        targetUsername: targetUser.username,
+        ...(lastSeqRef.current !== null && { resumeFrom: lastSeqRef.current })
       });
     });
 
@@ -265,9 +273,19 @@ const Chat = ({ currentUser, onBack }) => {
       setConnected(false);
     });
 
+    newSocket.on('sync', (data) => {
+      const missed = data.messages.filter(msg => lastSeqRef.current === null || msg.seq > lastSeqRef.current);
+      missed.forEach(msg => trackSeq(msg.seq));
+      setMessages(prev => [...prev, ...missed.map(msg => ({
+        ...msg,
+        isOwn: msg.sender === currentUser.username
+      }))]);
+    });
+
     newSocket.on('message', (data) => {
       console.log('Received message:', data);
-      setMessages(prev => [...prev, {
+      trackSeq(data.seq);
+      setMessages(prev => prev.some(msg => msg.isOwn && msg.id === data.id) ? prev : [...prev, {
         id: data.id || Date.now(),
         text: data.text,
         sender: data.sender,
@@ -321,6 +339,7 @@ const Chat = ({ currentUser, onBack }) => {
         ...msg,
         isOwn: msg.sender === currentUser.username
       }));
+      history.forEach(msg => trackSeq(msg.seq));
       setMessages(history);
     } catch (error) {
       console.error('Error loading message history:', error);
@@ -340,8 +359,17 @@ const Chat = ({ currentUser, onBack }) => {
       timestamp: new Date().toISOString()
     };
 
-    // Send via WebSocket
-    socket.emit('message', messageData);
+    // Send via WebSocket; the id makes resending after a timeout safe
+    const send = (attempt) => {
+      socket.timeout(5000).emit('message', messageData, (err, ack) => {
+        if (err && attempt < 3) {
+          send(attempt + 1);
+        } else if (ack) {
+          trackSeq(ack.seq);
+        }
+      });
+    };
+    send(1);
 
     // Add to local state immediately
     setMessages(prev => [...prev, {
@@ -1,8 +1,9 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import { motion } from 'framer-motion';
 import styled from 'styled-components';
 import axios from 'axios';
+import io from 'socket.io-client';
 
 const ConnectionContainer = styled.div`
   max-width: 800px;
@@ -226,6 +227,8 @@ const ConnectionAttempt = ({ currentUser, audioManager }) => {
   const [cooldown, setCooldown] = useState(null);
   const [crypticMessage, setCrypticMessage] = useState('');
 
+  const cooldownTimerRef = useRef(null);
+
   useEffect(() => {
     fetchTargetUser();
     if (audioManager) {
@@ -233,6 +236,34 @@ const ConnectionAttempt = ({ currentUser, audioManager }) => {
     }
   }, [username, audioManager]);
 
+  useEffect(() => {
+    // Cooldown pushes go only to the token holder; users saved before tokens just see the countdown
+    if (!currentUser || !currentUser.accessToken) return;
+
+    // The server says when a cooldown is over, so the countdown is only for display
+    const socket = io('http://localhost:8000', {
+      transports: ['websocket', 'polling'],
+      auth: { token: currentUser.accessToken }
+    });
+
+    socket.on('connect', () => {
+      socket.emit('watch_cooldowns', {});
+    });
+
+    socket.on('cooldown_expired', (data) => {
+      if (data.target_username !== username) return;
+      clearInterval(cooldownTimerRef.current);
+      setCooldown(null);
+      setMessage('The shadows part. You may try again.');
+      setMessageType('success');
+    });
+
+    return () => {
+      clearInterval(cooldownTimerRef.current);
+      socket.close();
+    };
+  }, [currentUser, username]);
+
   const fetchTargetUser = async () => {
     try {
       const response = await axios.get('http://localhost:8000/users');
@@ -304,6 +335,7 @@ const ConnectionAttempt = ({ currentUser, audioManager }) => {
         setCooldown(120); // 2 minutes in seconds
         
         // Start cooldown timer
+        clearInterval(cooldownTimerRef.current);
         const timer = setInterval(() => {
           setCooldown(prev => {
             if (prev <= 1) {
@@ -313,6 +345,7 @@ const ConnectionAttempt = ({ currentUser, audioManager }) => {
             return prev - 1;
           });
         }, 1000);
+        cooldownTimerRef.current = timer;
         
         if (audioManager) {
           audioManager.setPitch(0.5); // Very low pitch for cooldown
@@ -210,7 +210,8 @@ const Registration = ({ onRegistration }) => {
         onRegistration({
           id: response.data.user_id,
           username: formData.username,
-          poem: response.data.poem
+          poem: response.data.poem,
+          accessToken: response.data.access_token
         });
       }, 2000);
 
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Load-testing harness for Halloween Poe Chat
+Runs concurrent scenarios (registration storms, batch imports, connection-attempt bursts,
+chat send/poll mixes and websocket fan-out) and reports throughput and
+p50/p95/p99 latencies.
+
+By default everything runs in-process: the FastAPI app is driven through
+httpx's ASGI transport against a temporary SQLite database with a stubbed
+Bedrock client, and the Socket.IO server is started on a local port.
+Pass --target/--ws-target to load a running deployment instead.
+
+Examples:
+    python load_test.py
+    python load_test.py --scenario chat --users 200 --requests 5000 --concurrency 50
+    python load_test.py --scenario import --users 5000 --batch-size 500
+    python load_test.py --scenario fanout --rooms 20 --clients-per-room 10
+    python load_test.py --target http://localhost:8000 --ws-target http://localhost:8001
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+STUB_POEM = """In the crypt where secrets lie entombed,
+A specter haunts the midnight gloom.
+Through veils of shadow, whispers creep,
+While ravens guard the secrets deep."""
+
+class StubBedrockClient:
+    """Stands in for boto3's bedrock-runtime client with a fixed latency"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def invoke_model(self, modelId, body, contentType=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if 'claude-3' in modelId:
+            payload = {"content": [{"type": "text", "text": STUB_POEM}]}
+        else:
+            payload = {"completion": STUB_POEM}
+        return {"body": io.BytesIO(json.dumps(payload).encode())}
+
+class Stats:
+    """Latency samples and outcome counts for one scenario"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    def record(self, latency: float, status, ok: bool = True):
+        self.latencies.append(latency)
+        key = str(status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if not ok:
+            self.errors += 1
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def percentile(self, pct: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+        return ordered[index]
+
+    def summary(self) -> Dict:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        count = len(self.latencies)
+        return {
+            "scenario": self.name,
+            "operations": count,
+            "errors": self.errors,
+            "statuses": self.statuses,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(count / elapsed, 1) if elapsed > 0 else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 2),
+            "p95_ms": round(self.percentile(95) * 1000, 2),
+            "p99_ms": round(self.percentile(99) * 1000, 2),
+        }
+
+    def report(self):
+        s = self.summary()
+        print(f"\n📊 {s['scenario']}")
+        print(f"   operations: {s['operations']}  errors: {s['errors']}  statuses: {s['statuses']}")
+        print(f"   throughput: {s['throughput_per_s']}/s over {s['elapsed_s']}s")
+        print(f"   latency:    p50 {s['p50_ms']}ms  p95 {s['p95_ms']}ms  p99 {s['p99_ms']}ms")
+
+async def run_pool(total: int, concurrency: int, operation: Callable):
+    """Run operation(i) for i in range(total) with at most `concurrency` in flight"""
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            await operation(i)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, total)))))
+
+async def timed_request(client: httpx.AsyncClient, stats: Stats, method: str, url: str,
+                        ok_statuses=(200,), **kwargs) -> Optional[httpx.Response]:
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except Exception as e:
+        stats.record(time.perf_counter() - start, type(e).__name__, ok=False)
+        return None
+    stats.record(time.perf_counter() - start, response.status_code, ok=response.status_code in ok_statuses)
+    return response
+
+def registration_payload(username: str, answers: List[str]) -> Dict:
+    return {
+        "username": username,
+        "password": "password123",
+        "questions": [
+            "What is your favorite color?",
+            "What is your pet's name?",
+            "What is your favorite food?"
+        ],
+        "answers": answers
+    }
+
+# Scenarios
+
+async def registration_storm(client: httpx.AsyncClient, args) -> Stats:
+    stats = Stats(f"registration storm ({args.users} users, concurrency {args.concurrency})")
+
+    async def register(i):
+        payload = registration_payload(f"storm_{args.run_id}_{i}", ["blue", "fluffy", "pizza"])
+        await timed_request(client, stats, "POST", "/register", json=payload)
+
+    await run_pool(args.users, args.concurrency, register)
+    stats.stop()
+    return stats
+
+async def batch_import(client: httpx.AsyncClient, args) -> Stats:
+    """Cohort import through /register/batch; every user counts as one operation"""
+    stats = Stats(f"batch import ({args.users} users, batches of {args.batch_size}, concurrency {args.concurrency})")
+    batches = (args.users + args.batch_size - 1) // args.batch_size
+
+    async def register_batch(b):
+        first = b * args.batch_size
+        users = [
+            registration_payload(f"import_{args.run_id}_{i}", ["blue", "fluffy", "pizza"])
+            for i in range(first, min(first + args.batch_size, args.users))
+        ]
+        start = time.perf_counter()
+        try:
+            response = await client.post("/register/batch", json={"users": users})
+        except Exception as e:
+            for _ in users:
+                stats.record(time.perf_counter() - start, type(e).__name__, ok=False)
+            return
+        latency = time.perf_counter() - start
+        if response.status_code != 200:
+            for _ in users:
+                stats.record(latency, response.status_code, ok=False)
+            return
+        for result in response.json()["results"]:
+            stats.record(latency, result["status"], ok=result["success"])
+
+    await run_pool(batches, args.concurrency, register_batch)
+    stats.stop()
+    return stats
+
+async def setup_users(client: httpx.AsyncClient, prefix: str, count: int, concurrency: int) -> List[Dict]:
+    """Register users and return their ids and answers"""
+    users = []
+
+    async def register(i):
+        username = f"{prefix}_{i}"
+        answers = [f"color{i}", f"pet{i}", f"food{i}"]
+        response = await client.post("/register", json=registration_payload(username, answers))
+        response.raise_for_status()
+        users.append({"id": response.json()["user_id"], "username": username, "answers": answers})
+
+    await run_pool(count, concurrency, register)
+    users.sort(key=lambda user: user["id"])
+    return users
+
+async def connection_attempt_burst(client: httpx.AsyncClient, args) -> Stats:
+    users = await setup_users(client, f"attempt_{args.run_id}", args.users, args.concurrency)
+    rng = random.Random(args.seed)
+    stats = Stats(f"connection-attempt burst ({args.requests} attempts over {len(users)} users)")
+
+    async def attempt(i):
+        current, target = rng.sample(users, 2)
+        # Roughly one in five attempts knows the answers
+        answers = target["answers"] if rng.random() < 0.2 else ["wrong", "wrong", target["answers"][2]]
+        payload = {
+            "target_username": target["username"],
+            "current_username": current["username"],
+            "answers": answers
+        }
+        # 429 is the cooldown doing its job, not a failure
+        await timed_request(client, stats, "POST", "/attempt-connection", ok_statuses=(200, 429), json=payload)
+
+    await run_pool(args.requests, args.concurrency, attempt)
+    stats.stop()
+    return stats
+
+async def chat_mix(client: httpx.AsyncClient, args) -> Stats:
+    users = await setup_users(client, f"chat_{args.run_id}", max(2, args.users), args.concurrency)
+    rng = random.Random(args.seed)
+
+    # Pair users up so every user has one chat partner
+    pairs = []
+    for a, b in zip(users[0::2], users[1::2]):
+        response = await client.post("/create-connection", params={"user1_username": a["username"], "user2_username": b["username"]})
+        response.raise_for_status()
+        pairs.append((a, b))
+
+    stats = Stats(f"chat mix ({args.requests} ops, {int(args.send_ratio * 100)}% sends, {len(pairs)} chats)")
+
+    async def operation(i):
+        a, b = rng.choice(pairs)
+        sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+        if rng.random() < args.send_ratio:
+            payload = {
+                "content": f"message {i} from {sender['username']}",
+                "target_username": receiver["username"],
+                "current_username": sender["username"]
+            }
+            await timed_request(client, stats, "POST", "/send-message", json=payload)
+        else:
+            await timed_request(client, stats, "GET", f"/messages/{sender['id']}/{receiver['username']}")
+
+    await run_pool(args.requests, args.concurrency, operation)
+    stats.stop()
+    return stats
+
+async def connect_pairs(client: httpx.AsyncClient, pairs: List) -> None:
+    """Register each pair of users and connect them, so join_chat lets them into a room"""
+    users = [registration_payload(username, ["blue", "fluffy", "pizza"]) for pair in pairs for username in pair]
+    for first in range(0, len(users), 500):
+        response = await client.post("/register/batch", json={"users": users[first:first + 500]})
+        response.raise_for_status()
+    for user1, user2 in pairs:
+        response = await client.post("/create-connection", params={"user1_username": user1, "user2_username": user2})
+        response.raise_for_status()
+
+async def websocket_fanout(client: httpx.AsyncClient, ws_url: str, args) -> Stats:
+    """Send-to-delivery latency on one clock: the server echoes the sender's perf_counter() timestamp
+    and this process subtracts it on receipt, so it measures the round trip through the server"""
+    import socketio
+
+    stats = Stats(f"websocket fan-out ({args.rooms} rooms x {args.clients_per_room} clients, {args.ws_messages} msgs/room)")
+    expected = args.rooms * args.ws_messages * args.clients_per_room
+    received = 0
+    done = asyncio.Event()
+    clients = []
+
+    def on_message_factory():
+        async def on_message(data):
+            nonlocal received
+            sent_at = float(data.get("timestamp") or 0)
+            stats.record(time.perf_counter() - sent_at, "delivered")
+            received += 1
+            if received >= expected:
+                done.set()
+        return on_message
+
+    # Rooms are 1:1 chats, so each room's clients are several sessions of the same two users
+    pairs = [(f"ghost_{args.run_id}_{room}_a", f"ghost_{args.run_id}_{room}_b") for room in range(args.rooms)]
+    await connect_pairs(client, pairs)
+    for pair in pairs:
+        members = []
+        for member in range(args.clients_per_room):
+            socket_client = socketio.AsyncClient(reconnection=False)
+            socket_client.on("message", on_message_factory())
+            await socket_client.connect(ws_url, transports=["websocket"])
+            username, target = pair if member % 2 == 0 else pair[::-1]
+            await socket_client.call("join_chat", {"username": username, "targetUsername": target})
+            members.append((socket_client, username, target))
+        clients.append(members)
+
+    stats.started = time.perf_counter()
+
+    for i in range(args.ws_messages):
+        for members in clients:
+            sender, username, target = members[0]
+            await sender.emit("message", {
+                "id": i,
+                "sender": username,
+                "targetUsername": target,
+                "text": f"fan-out {i}",
+                "timestamp": time.perf_counter()
+            })
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.ws_timeout)
+    except asyncio.TimeoutError:
+        stats.errors += expected - received
+        print(f"   ⚠️  only {received}/{expected} deliveries before timeout")
+
+    stats.stop()
+    for members in clients:
+        for socket_client, _, _ in members:
+            await socket_client.disconnect()
+    return stats
+
+# In-process target
+
+def setup_in_process(args):
+    """Point the backend at a temporary SQLite database with a stubbed Bedrock"""
+    db_path = os.path.join(tempfile.mkdtemp(prefix="poe_loadtest_"), "loadtest.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    sys.path.insert(0, BACKEND_DIR)
+
+    import database
+    from sqlalchemy.pool import NullPool
+
+    # The endpoints run sync queries on the event loop, so a bounded pool can block
+    # the loop while the sessions that would free a connection wait to be closed on it
+    database.get_engine(poolclass=NullPool)
+    database.create_tables()
+
+    import main
+    main.bedrock_client = StubBedrockClient(args.bedrock_latency)
+    main.bedrock_available = True
+    print(f"🧪 In-process target: SQLite at {db_path}, stub Bedrock latency {args.bedrock_latency * 1000:.0f}ms")
+    return main.app
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def start_socket_server():
+    """Serve the Socket.IO app on a local port inside this event loop"""
+    import uvicorn
+    from websocket_server import socket_app, sio, rate_limiter
+
+    # Each room's sender bursts --ws-messages at once; measure fan-out, not the flood limit
+    rate_limiter.rate = 0
+    sio.logger.disabled = True
+    sio.eio.logger.disabled = True
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(socket_app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task, f"http://127.0.0.1:{port}"
+
+async def main_async(args) -> List[Dict]:
+    scenarios = ["register", "import", "attempt", "chat", "fanout"] if args.scenario == "all" else [args.scenario]
+    results = []
+
+    if args.target:
+        client = httpx.AsyncClient(base_url=args.target, timeout=args.timeout)
+    else:
+        app = setup_in_process(args)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=args.timeout)
+
+    async with client:
+        for scenario in scenarios:
+            if scenario == "register":
+                stats = await registration_storm(client, args)
+            elif scenario == "import":
+                stats = await batch_import(client, args)
+            elif scenario == "attempt":
+                stats = await connection_attempt_burst(client, args)
+            elif scenario == "chat":
+                stats = await chat_mix(client, args)
+            else:
+                server = task = None
+                ws_url = args.ws_target
+                if not ws_url:
+                    if not args.target:
+                        server, task, ws_url = await start_socket_server()
+                    else:
+                        ws_url = args.target
+                try:
+                    stats = await websocket_fanout(client, ws_url, args)
+                finally:
+                    if server:
+                        server.should_exit = True
+                        await task
+            stats.report()
+            results.append(stats.summary())
+
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Halloween Poe Chat - load test")
+    parser.add_argument("--scenario", choices=["all", "register", "import", "attempt", "chat", "fanout"], default="all")
+    parser.add_argument("--target", help="base URL of a running API (default: in-process)")
+    parser.add_argument("--ws-target", help="Socket.IO URL (default: in-process server, or --target)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=100, help="users per /register/batch call (import)")
+    parser.add_argument("--send-ratio", type=float, default=0.3, help="share of chat ops that send")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--clients-per-room", type=int, default=5)
+    parser.add_argument("--ws-messages", type=int, default=20, help="messages sent per room")
+    parser.add_argument("--ws-timeout", type=float, default=30.0)
+    parser.add_argument("--bedrock-latency", type=float, default=0.0, help="stub Bedrock latency in seconds")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1849)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+    args.run_id = uuid.uuid4().hex[:6]
+    return args
+
+def main():
+    args = parse_args()
+    print("🎃 Halloween Poe Chat - Load Test")
+    print("=" * 50)
+    results = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Results written to {args.json}")
+    return all(result["errors"] == 0 for result in results)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -9,6 +9,10 @@ import subprocess
 import time
 from pathlib import Path
 
+# Backend modules import each other by name (e.g. `from database import ...`)
+BACKEND_DIR = Path(__file__).resolve().parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
 def check_requirements():
     """Check if all requirements are installed"""
     try:
@@ -27,7 +31,7 @@ def check_requirements():
 def check_database():
     """Check if database is accessible"""
     try:
-        from backend.database import engine
+        from database import engine
         from sqlalchemy import text
         with engine.connect() as conn:
             conn.execute(text("SELECT 1"))
@@ -59,7 +63,7 @@ def start_server():
     
     try:
         # Start the server
-        from backend.main_advanced import socket_app
+        from main_advanced import socket_app
         import uvicorn
         uvicorn.run(socket_app, host="0.0.0.0", port=8000, log_level="info")
     except KeyboardInterrupt:
@@ -0,0 +1,27 @@
+"""
+Test fixtures for Halloween Poe Chat
+Points the backend at a throwaway SQLite database with Bedrock disabled.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(TESTS_DIR), "backend")
+
+# The backend reads its configuration at import time
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="poe_test_"), "test.db")
+os.environ.pop("AWS_ACCESS_KEY_ID", None)
+os.environ["ANSWER_HASH_KEY"] = "test-answer-hash-key"
+sys.path.insert(0, BACKEND_DIR)
+
+@pytest.fixture(scope="session")
+def backend():
+    """Import the app once, with tables created"""
+    import database
+    database.create_tables()
+
+    import main
+    return main
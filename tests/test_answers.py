@@ -0,0 +1,84 @@
+"""
+Security answers: keyed hashes stored at registration, checked without
+parsing, and hashed in place for users created by older versions
+"""
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+import pytest
+
+from sqlalchemy import create_engine, text
+
+from answers import ANSWER_DIGEST_CHARS, hash_answer, hash_answers, count_matching_answers
+from conftest import BACKEND_DIR
+
+def test_answers_are_normalized_then_hashed():
+    stored = hash_answers(["Dracula", "Deep purple", "Raven"])
+    assert len(stored) == 3 * ANSWER_DIGEST_CHARS
+    assert "raven" not in stored.lower()
+    assert hash_answer("  DRACULA ") == hash_answer("dracula")
+    assert count_matching_answers(stored, [" dracula", "DEEP PURPLE ", "crow"]) == 2
+    # Extra answers never match, missing ones just count as wrong
+    assert count_matching_answers(stored, ["dracula", "deep purple", "raven", "owl"]) == 3
+    assert count_matching_answers(stored, ["deep purple"]) == 0
+    assert count_matching_answers("", ["dracula"]) == 0
+
+@pytest.mark.parametrize("debug, starts", [("false", False), ("true", True)])
+def test_missing_key_fails_outside_development(debug, starts):
+    env = {key: value for key, value in os.environ.items() if key != "ANSWER_HASH_KEY"}
+    env["DEBUG"] = debug
+    # From an empty directory, so no .env file supplies a key
+    result = subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {BACKEND_DIR!r}); import answers"],
+                            cwd=tempfile.mkdtemp(), env=env, capture_output=True, text=True, timeout=60)
+    assert (result.returncode == 0) == starts
+    assert ("ANSWER_HASH_KEY is not set" in result.stderr) != starts
+
+def test_model_only_tools_run_without_a_key():
+    env = {key: value for key, value in os.environ.items() if key != "ANSWER_HASH_KEY"}
+    env["DEBUG"] = "false"
+    result = subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {BACKEND_DIR!r}); import database"],
+                            cwd=tempfile.mkdtemp(), env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+def test_registration_stores_hashes_not_plaintext(backend):
+    import uuid
+    from fastapi.testclient import TestClient
+    from database import SessionLocal, User
+
+    username = f"{uuid.uuid4().hex[:6]}_poe"
+    TestClient(backend.app).post("/register", json={"username": username, "password": "nevermore",
+                                                    "questions": ["q1", "q2"], "answers": ["Lenore", "Raven"]}).raise_for_status()
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.username == username).one()
+    finally:
+        db.close()
+    assert user.answers == "[]"
+    assert user.answer_hashes == hash_answers(["lenore", "raven"])
+
+def test_upgrade_hashes_existing_answers():
+    from database import upgrade_schema
+
+    path = os.path.join(tempfile.mkdtemp(prefix="poe_upgrade_"), "old.db")
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(50), password_hash VARCHAR(255), "
+                                "questions TEXT, answers TEXT, poem TEXT, created_at DATETIME)"))
+        connection.execute(text("INSERT INTO users (id, username, password_hash, questions, answers) VALUES "
+                                "(1, 'poe', '', '[]', :poe), (2, 'lenore', '', '[]', :lenore), (3, 'broken', '', '[]', 'not json')"),
+                           {"poe": json.dumps(["Dracula", " Deep purple", "Raven"]), "lenore": json.dumps(["Owl"])})
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)  # idempotent
+
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT id, answers, answer_hashes FROM users ORDER BY id")).all()
+    engine.dispose()
+    assert [tuple(row) for row in rows] == [
+        (1, "[]", hash_answers(["dracula", "deep purple", "raven"])),
+        (2, "[]", hash_answer("owl")),
+        (3, "[]", ""),
+    ]
@@ -0,0 +1,128 @@
+"""
+Signed session tokens: issuing, verification, key rotation, and the
+endpoints and websocket handlers that trust them instead of usernames
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import subprocess
+
+import pytest
+from fastapi.testclient import TestClient
+
+import auth
+from auth import AuthError, issue_token, verify_token, bearer_token
+from conftest import BACKEND_DIR
+
+@pytest.fixture
+def client(backend):
+    return TestClient(backend.app)
+
+def register(client, username, password="nevermore"):
+    response = client.post("/register", json={"username": username, "password": password,
+                                              "questions": ["q1", "q2", "q3"], "answers": ["a", "b", "c"]})
+    response.raise_for_status()
+    return response.json()
+
+def test_token_round_trip():
+    claims = verify_token(issue_token(7, "poe"))
+    assert (claims.user_id, claims.username, claims.key_version) == (7, "poe", auth.CURRENT_KEY_VERSION)
+
+def test_rejects_tampered_expired_and_retired_tokens(monkeypatch):
+    token = issue_token(7, "poe")
+    header, payload, signature = token.split(".")
+    with pytest.raises(AuthError):
+        verify_token(f"{header}.{payload}.{signature[::-1]}")
+    with pytest.raises(AuthError):
+        verify_token("not a token")
+    with pytest.raises(AuthError):
+        verify_token(issue_token(7, "poe", ttl=-1))
+
+    # Cached verifications still honour expiry and key retirement
+    verify_token(token)
+    later = time.time() + auth.AUTH_TOKEN_TTL + 1
+    monkeypatch.setattr("auth.time.time", lambda: later)
+    with pytest.raises(AuthError, match="expired"):
+        verify_token(token)
+    monkeypatch.undo()
+    monkeypatch.setattr(auth, "SECRET_KEYS", {auth.CURRENT_KEY_VERSION + 1: "rotated"})
+    with pytest.raises(AuthError, match="retired"):
+        verify_token(token)
+
+def test_parse_keys_puts_the_current_key_first():
+    assert auth.parse_keys("2:new, 1:old") == (2, {2: "new", 1: "old"})
+    with pytest.raises(ValueError):
+        auth.parse_keys("just-a-secret")
+
+def test_bearer_token():
+    assert bearer_token(None) is None
+    assert bearer_token("Bearer abc") == "abc"
+    with pytest.raises(AuthError):
+        bearer_token("Basic abc")
+
+def test_login_and_token_identified_requests(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe = register(client, f"{prefix}_poe")
+    register(client, f"{prefix}_lenore")
+    client.post("/create-connection", params={"user1_username": f"{prefix}_poe",
+                                              "user2_username": f"{prefix}_lenore"}).raise_for_status()
+
+    assert client.post("/login", json={"username": f"{prefix}_poe", "password": "wrong"}).status_code == 401
+    login = client.post("/login", json={"username": f"{prefix}_poe", "password": "nevermore"}).json()
+    assert login["user_id"] == poe["user_id"]
+    assert verify_token(poe["access_token"]).username == f"{prefix}_poe"
+    headers = {"Authorization": f"Bearer {login['access_token']}"}
+
+    sent = client.post("/send-message", json={"content": "Quoth the raven", "target_username": f"{prefix}_lenore"},
+                       headers=headers)
+    assert sent.status_code == 200 and sent.json()["sender"] == f"{prefix}_poe"
+    messages = client.get(f"/messages/{poe['user_id']}/{prefix}_lenore", headers=headers).json()
+    assert [message["content"] for message in messages] == ["Quoth the raven"]
+
+    # A token cannot be used to act as someone else
+    impersonate = client.post("/send-message", json={"content": "boo", "target_username": f"{prefix}_poe",
+                                                     "current_username": f"{prefix}_lenore"}, headers=headers)
+    assert impersonate.status_code == 403
+    assert client.get(f"/messages/{poe['user_id'] + 1}/{prefix}_poe", headers=headers).status_code == 403
+    assert client.post("/send-message", json={"content": "boo", "target_username": f"{prefix}_lenore"},
+                       headers={"Authorization": "Bearer forged"}).status_code == 401
+    assert client.post("/send-message", json={"content": "boo", "target_username": f"{prefix}_lenore"}).status_code == 401
+
+    attempt = client.post("/attempt-connection", json={"target_username": f"{prefix}_lenore", "answers": ["a", "b", "c"]},
+                          headers=headers)
+    assert attempt.status_code == 200 and attempt.json()["success"]
+
+@pytest.mark.parametrize("method, url, body", [
+    ("post", "/register/batch", {"users": [{"username": "x", "password": "p", "questions": ["q"], "answers": ["a"]}]}),
+    ("post", "/attempt-connection/batch", {"attempts": [{"target_username": "x", "answers": ["a"]}]}),
+    ("get", "/search/1?q=raven", None),
+])
+def test_every_endpoint_rejects_invalid_tokens(client, method, url, body):
+    response = getattr(client, method)(url, headers={"Authorization": "Bearer forged"}, **({"json": body} if body else {}))
+    assert response.status_code == 401
+
+@pytest.mark.parametrize("env, error", [
+    ({"SOCKETIO_REDIS_URL": "redis://nowhere"}, "AUTH_SECRET_KEYS"),
+    ({"AUTH_SECRET_KEYS": "1:secret"}, "SOCKETIO_REDIS_URL"),
+])
+def test_serve_refuses_workers_that_cannot_share_state(env, error):
+    base = {key: value for key, value in os.environ.items() if key not in ("SOCKETIO_REDIS_URL", "AUTH_SECRET_KEYS")}
+    result = subprocess.run([sys.executable, "serve.py", "--workers", "2", "--skip-db-setup"], cwd=BACKEND_DIR,
+                            env={**base, **env}, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 2 and error in result.stderr
+
+def test_join_chat_checks_the_token(backend):
+    import websocket_server
+
+    async def run():
+        forged = await websocket_server.join_chat("sid", {"username": "poe", "targetUsername": "lenore", "token": "forged"})
+        mismatched = await websocket_server.join_chat("sid", {"username": "lenore", "targetUsername": "poe",
+                                                              "token": issue_token(1, "poe")})
+        return forged, mismatched
+
+    forged, mismatched = asyncio.run(run())
+    websocket_server.session_claims.pop("sid", None)
+    assert "error" in forged
+    assert mismatched == {"error": "Token does not belong to this user"}
@@ -0,0 +1,163 @@
+"""
+Websocket backpressure: bounded outbound queues, drop/coalesce policies,
+inbound rate limiting and payload limits
+"""
+import asyncio
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+from backpressure import OutboundQueue, RateLimiter, packet_header
+from metrics import WS_DROPPED, WS_OUTBOUND_QUEUED
+
+def encode(event, data):
+    encoded = packet.Packet(packet.EVENT, data=[event, data]).encode()
+    if not isinstance(encoded, list):
+        encoded = [encoded]
+    return [eio_packet.Packet(eio_packet.MESSAGE, part) for part in encoded]
+
+class FakeSocket:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+class FakeEngineIO:
+    """Engine.IO server whose client only reads when read_all() is awaited"""
+
+    def __init__(self):
+        self.sockets = {"eio": FakeSocket()}
+        self.sent = []
+
+    async def send_packet(self, eio_sid, pkt):
+        self.sent.append(pkt)
+        await self.sockets[eio_sid].queue.put(pkt)
+
+    async def read_all(self):
+        """Let the client catch up: keep reading until nothing more arrives"""
+        queue = self.sockets["eio"].queue
+        for _ in range(20):
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+            await asyncio.sleep(0.005)
+
+def sent_events(eio):
+    return [packet_header(pkt)[0] for pkt in eio.sent]
+
+def sent_ids(eio):
+    return [int(pkt.data.split('"id":')[1].rstrip("}]")) for pkt in eio.sent]
+
+def test_packet_header():
+    assert packet_header(encode("message", {"text": "boo"})[0]) == ("message", 0)
+    header, attachment = encode("frames", b"\x93\x01\x02\x03")
+    assert packet_header(header) == ("frames", 1)
+    assert packet_header(attachment) == (None, 0)
+
+def test_slow_client_queue_is_bounded_and_drops_oldest():
+    eio = FakeEngineIO()
+    dropped = WS_DROPPED.value(reason="queue_full")
+
+    async def run():
+        queue = OutboundQueue(eio, "eio", maxsize=3, policy="drop_oldest", window=2)
+        for i in range(10):
+            for pkt in encode("message", {"id": i}):
+                await queue.send(pkt)
+        queued = len(queue)
+        await eio.read_all()
+        return queued
+
+    assert asyncio.run(run()) == 3
+    assert sent_ids(eio) == [0, 1, 7, 8, 9]  # two went straight to the transport, the newest three waited
+    assert WS_DROPPED.value(reason="queue_full") - dropped == 5
+    assert WS_OUTBOUND_QUEUED.value() == 0
+
+def test_drop_newest_policy_keeps_the_backlog():
+    eio = FakeEngineIO()
+
+    async def run():
+        queue = OutboundQueue(eio, "eio", maxsize=2, policy="drop_newest", window=1)
+        for i in range(6):
+            for pkt in encode("message", {"id": i}):
+                await queue.send(pkt)
+        await eio.read_all()
+
+    asyncio.run(run())
+    assert sent_ids(eio) == [0, 1, 2]
+
+def test_presence_events_coalesce_per_user():
+    eio = FakeEngineIO()
+    coalesced = WS_DROPPED.value(reason="coalesced")
+
+    async def run():
+        queue = OutboundQueue(eio, "eio", maxsize=10, window=1)
+        for pkt in encode("message", {"id": 0}):
+            await queue.send(pkt)
+        for event, username in [("user_joined", "poe"), ("user_joined", "lenore"), ("user_joined", "poe"),
+                                ("user_left", "poe"), ("user_joined", "poe")]:
+            for pkt in encode(event, {"username": username}):
+                await queue.send(pkt)
+        queued = len(queue)
+        await eio.read_all()
+        return queued
+
+    assert asyncio.run(run()) == 3
+    assert sent_events(eio) == ["message", "user_joined", "user_joined", "user_left"]
+    assert WS_DROPPED.value(reason="coalesced") - coalesced == 2
+
+def test_binary_frames_stay_whole():
+    eio = FakeEngineIO()
+
+    async def run():
+        queue = OutboundQueue(eio, "eio", maxsize=1, window=1)
+        for i in range(4):
+            for pkt in encode("frames", bytes([i])):
+                await queue.send(pkt)
+        await eio.read_all()
+
+    asyncio.run(run())
+    # The first frame went out directly, only the newest of the rest was kept
+    assert [pkt.data for pkt in eio.sent if isinstance(pkt.data, bytes)] == [b"\x00", b"\x03"]
+    assert sent_events(eio) == ["frames", None, "frames", None]
+
+def test_rate_limiter_allows_bursts_then_refills(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("backpressure.time.monotonic", lambda: now[0])
+    limiter = RateLimiter(rate=2, burst=3)
+
+    assert [limiter.allow("sid") for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow("other")
+    now[0] += 0.5
+    assert [limiter.allow("sid") for _ in range(2)] == [True, False]
+    assert RateLimiter(rate=0).allow("sid")
+
+    # Buckets that have refilled completely are dropped; partly used ones are kept
+    now[0] += 1.5
+    limiter.allow("other")
+    limiter.prune()
+    assert set(limiter.buckets) == {"other"}
+
+def test_server_rejects_oversized_and_flooded_messages(backend, monkeypatch):
+    import websocket_server
+
+    rejected = []
+
+    async def fake_emit(event, data, **kwargs):
+        rejected.append((event, data, kwargs.get("to")))
+
+    monkeypatch.setattr(websocket_server.sio, "emit", fake_emit)
+    monkeypatch.setattr(websocket_server, "rate_limiter", RateLimiter(rate=1, burst=1))
+
+    async def run():
+        big = "x" * (websocket_server.WS_MAX_MESSAGE_CHARS + 1)
+        return [
+            await websocket_server.accept_message("sid", 1, big, 7),
+            await websocket_server.accept_message("sid", 2, "boo", 7),
+            # Another socket of the same user shares the limit; other users have their own
+            await websocket_server.accept_message("sid2", 3, "boo again", 7),
+            await websocket_server.accept_message("sid3", 4, "boo", 8),
+        ]
+
+    assert asyncio.run(run()) == [False, True, False, True]
+    assert rejected == [
+        ("message_rejected", {"id": 1, "reason": "payload_too_large"}, "sid"),
+        ("message_rejected", {"id": 3, "reason": "rate_limited"}, "sid2"),
+    ]
@@ -0,0 +1,116 @@
+"""
+Batch registration and connection-attempt endpoints
+"""
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+QUESTIONS = ["Favorite color?", "Pet's name?", "Favorite food?"]
+
+@pytest.fixture
+def client(backend):
+    return TestClient(backend.app)
+
+def registration(username, answers=("black", "raven", "wine")):
+    return {"username": username, "password": "nevermore", "questions": QUESTIONS, "answers": list(answers)}
+
+def test_register_batch_reports_each_item(client):
+    prefix = uuid.uuid4().hex[:6]
+    client.post("/register", json=registration(f"{prefix}_taken")).raise_for_status()
+
+    response = client.post("/register/batch", json={"users": [
+        registration(f"{prefix}_a"),
+        registration(f"{prefix}_taken"),
+        registration(f"{prefix}_b"),
+        registration(f"{prefix}_a"),
+        {**registration(f"{prefix}_c"), "answers": ["only one"]},
+    ]})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (2, 3)
+    results = body["results"]
+    assert [result["success"] for result in results] == [True, False, True, False, False]
+    assert results[1]["error"] == "Username already exists"
+    assert results[3]["error"] == "Duplicate username in batch"
+    assert results[0]["user_id"] != results[2]["user_id"]
+    assert "black" in results[0]["poem"] or "raven" in results[0]["poem"] or "wine" in results[0]["poem"]
+
+    users = {user["username"]: user["id"] for user in client.get("/users").json()}
+    assert users[f"{prefix}_a"] == results[0]["user_id"]
+    assert users[f"{prefix}_b"] == results[2]["user_id"]
+
+def test_register_batch_limits(client, backend, monkeypatch):
+    assert client.post("/register/batch", json={"users": []}).status_code == 400
+    monkeypatch.setattr(backend, "BATCH_MAX_ITEMS", 1)
+    users = [registration(uuid.uuid4().hex), registration(uuid.uuid4().hex)]
+    assert client.post("/register/batch", json={"users": users}).status_code == 413
+
+def test_attempt_batch_applies_rules_in_order(client):
+    prefix = uuid.uuid4().hex[:6]
+    client.post("/register/batch", json={"users": [
+        registration(f"{prefix}_seeker", ("a", "b", "c")),
+        registration(f"{prefix}_target", ("black", "raven", "wine")),
+    ]}).raise_for_status()
+
+    wrong = {"current_username": f"{prefix}_seeker", "target_username": f"{prefix}_target",
+             "answers": ["black", "crow", "ale"]}
+    right = {**wrong, "answers": [" Black", "RAVEN", "wine "]}
+    missing = {**wrong, "target_username": f"{prefix}_nobody"}
+
+    response = client.post("/attempt-connection/batch", json={"attempts": [missing, right] + [wrong] * 5})
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == [404, 200, 200, 200, 200, 200, 429]
+    assert results[1]["success"] and results[1]["cryptic_message"]
+    assert results[2]["correct_answers"] == 1 and results[2]["pitch_level"] == "low"
+    assert results[6]["error"] == "Too many attempts. 2-minute cooldown activated."
+
+    seeker = next(user for user in client.get("/users").json() if user["username"] == f"{prefix}_seeker")
+    connections = client.get(f"/connections/{seeker['id']}").json()
+    assert [connection["username"] for connection in connections] == [f"{prefix}_target"]
+
+def test_register_batch_reports_a_username_taken_meanwhile(client, backend, monkeypatch):
+    prefix = uuid.uuid4().hex[:6]
+    generate = backend.generate_poe_poem
+
+    async def racing_generate(answers):
+        # Another request registers the same username while the batch writes its poems
+        if not racing_generate.raced:
+            racing_generate.raced = True
+            client.post("/register", json=registration(f"{prefix}_raced")).raise_for_status()
+        return await generate(answers)
+    racing_generate.raced = False
+    monkeypatch.setattr(backend, "generate_poe_poem", racing_generate)
+
+    response = client.post("/register/batch", json={"users": [registration(f"{prefix}_raced"), registration(f"{prefix}_calm")]})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (1, 1)
+    raced, calm = body["results"]
+    assert (raced["status"], raced["error"]) == (409, "Username already exists")
+    assert calm["success"] and calm["user_id"]
+
+def test_attempt_batch_acts_as_the_token_holder(client):
+    from auth import issue_token
+
+    prefix = uuid.uuid4().hex[:6]
+    registered = client.post("/register/batch", json={"users": [
+        registration(f"{prefix}_seeker", ("a", "b", "c")),
+        registration(f"{prefix}_other", ("a", "b", "c")),
+        registration(f"{prefix}_target", ("black", "raven", "wine")),
+    ]}).json()["results"]
+    token = {"Authorization": f"Bearer {issue_token(registered[0]['user_id'], f'{prefix}_seeker')}"}
+    wrong = {"target_username": f"{prefix}_target", "answers": ["black", "crow", "ale"]}
+
+    response = client.post("/attempt-connection/batch", headers=token, json={"attempts": [
+        wrong, {**wrong, "current_username": f"{prefix}_seeker"}, {**wrong, "current_username": f"{prefix}_other"},
+    ]})
+    assert [result["status"] for result in response.json()["results"]] == [200, 200, 403]
+
+    # Without a token every item has to say who is attempting
+    results = client.post("/attempt-connection/batch", json={"attempts": [wrong]}).json()["results"]
+    assert (results[0]["status"], results[0]["error"]) == (401, "Authentication required")
@@ -0,0 +1,143 @@
+"""
+Compact msgpack framing: encoding helpers, per-tick batching, and a mixed
+JSON/compact room over a real Socket.IO connection
+"""
+import socket
+import asyncio
+import uuid
+
+import msgpack
+
+from compact_protocol import FrameBatcher, decode_frame, decode_message, epoch_ms, iso_timestamp
+
+def test_epoch_ms_accepts_iso_and_epoch_values():
+    assert epoch_ms("2025-10-31T23:59:59.500Z") == 1761955199500
+    assert epoch_ms("2025-10-31T23:59:59.500+00:00") == 1761955199500
+    assert epoch_ms(1761955199.5) == 1761955199500
+    assert epoch_ms(1761955199500) == 1761955199500
+    assert iso_timestamp(1761955199500) == "2025-10-31T23:59:59.500Z"
+
+def test_decode_message_rejects_malformed_payloads():
+    assert decode_message(msgpack.packb([7, 1, 1761955199500, "boo"])) == [7, 1, 1761955199500, "boo"]
+    assert decode_message(msgpack.packb([7, 1, 1761955199500, ""])) is None
+    assert decode_message(msgpack.packb({"text": "boo"})) is None
+    assert decode_message(b"\xc1") is None
+
+def test_batcher_sends_one_frame_per_room_per_tick():
+    sent = []
+
+    async def emit(room, frame):
+        sent.append((room, decode_frame(frame)))
+
+    async def run():
+        batcher = FrameBatcher(emit, tick=0.01)
+        for i in range(3):
+            batcher.add("chat_a_b", [1, 10, i, 1000 + i, f"message {i}"])
+        batcher.add("chat_c_d", [2, 20, 0, 2000, "other room"])
+        await asyncio.sleep(0.05)
+        batcher.add("chat_a_b", [1, 11, 3, 1003, "next tick"])
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert sent == [
+        ("chat_a_b", [[1, 10, i, 1000 + i, f"message {i}"] for i in range(3)]),
+        ("chat_c_d", [[2, 20, 0, 2000, "other room"]]),
+        ("chat_a_b", [[1, 11, 3, 1003, "next tick"]]),
+    ]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_mixed_room_delivers_json_and_compact(backend, monkeypatch):
+    import socketio
+    import uvicorn
+    from fastapi.testclient import TestClient
+    from main_advanced import socket_app
+    import websocket_server
+
+    # No timed flush: the test flushes once every message is pending, so all of them share one frame
+    monkeypatch.setattr(websocket_server.frame_batcher, "tick", 3600)
+
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    api = TestClient(backend.app)
+    for username in (poe, lenore):
+        api.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    api.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).raise_for_status()
+
+    async def run():
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(socket_app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+
+        json_messages, frames = [], []
+        framed = asyncio.Event()
+        legacy = socketio.AsyncClient(reconnection=False)
+        compact = socketio.AsyncClient(reconnection=False)
+        legacy.on("message", lambda data: json_messages.append(data))
+
+        def on_frames(frame):
+            frames.append(decode_frame(frame))
+            framed.set()
+        compact.on("frames", on_frames)
+
+        async def until(condition):
+            while not condition():
+                await asyncio.sleep(0.01)
+        try:
+            await legacy.connect(f"http://127.0.0.1:{port}", transports=["websocket"])
+            await compact.connect(f"http://127.0.0.1:{port}", transports=["websocket"], auth={"protocol": "compact"})
+            await legacy.call("join_chat", {"username": poe, "targetUsername": lenore})
+            ack = await compact.call("join_chat", {"username": lenore, "targetUsername": poe})
+
+            for i in range(3):
+                await legacy.emit("message", {"id": i, "sender": poe, "targetUsername": lenore,
+                                              "text": f"quoth {i}", "timestamp": "2025-10-31T23:59:59.000Z"})
+            await compact.emit("message_compact", msgpack.packb([ack["room"], 99, 1761955200000, "nevermore"]))
+            batcher = websocket_server.frame_batcher
+            await asyncio.wait_for(until(lambda: sum(len(records) for records in batcher.pending.values()) == 4), timeout=10)
+            for room_id in list(batcher.pending):
+                await batcher.flush(room_id)
+            await asyncio.wait_for(framed.wait(), timeout=10)
+            await asyncio.wait_for(until(lambda: len(json_messages) == 4), timeout=10)
+        finally:
+            for flush in list(websocket_server.frame_batcher.tasks):
+                flush.cancel()
+            await legacy.disconnect()
+            await compact.disconnect()
+            server.should_exit = True
+            await task
+        return ack, json_messages, frames
+
+    ack, json_messages, frames = asyncio.run(run())
+    room, users = ack["room"], ack["users"]
+    assert set(users) == {poe, lenore}
+
+    # Socket.IO handles each event in its own task, so only compare contents
+    # The JSON client sees every message, including the compact one, in the legacy shape
+    json_messages.sort(key=lambda message: message["id"])
+    assert [message["text"] for message in json_messages] == ["quoth 0", "quoth 1", "quoth 2", "nevermore"]
+    assert json_messages[3]["sender"] == lenore
+    assert json_messages[3]["timestamp"] == "2025-11-01T00:00:00.000Z"
+
+    # The compact client gets integer ids and epoch-ms timestamps, several messages per frame
+    records = sorted((record for frame in frames for record in frame), key=lambda record: record[2])
+    assert [record[:5] for record in records] == [
+        [room, users[poe], 0, 1761955199000, "quoth 0"],
+        [room, users[poe], 1, 1761955199000, "quoth 1"],
+        [room, users[poe], 2, 1761955199000, "quoth 2"],
+        [room, users[lenore], 99, 1761955200000, "nevermore"],
+    ]
+    # Both shapes carry the stored sequence number
+    assert sorted(record[5] for record in records) == [1, 2, 3, 4]
+    assert {message["id"]: message["seq"] for message in json_messages} == {record[2]: record[5] for record in records}
+    assert len(frames) == 1
+
+def test_compact_join_requires_connection(backend):
+    import websocket_server
+
+    assert websocket_server.lookup_room_ids(f"{uuid.uuid4().hex}", f"{uuid.uuid4().hex}") is None
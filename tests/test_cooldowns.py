@@ -0,0 +1,143 @@
+"""
+Connection-attempt cooldowns: the expiry scheduler, loading it from the
+table, the websocket push, and batched cleanup of stale attempt rows
+"""
+import time
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+
+from cooldowns import CooldownScheduler, purge_stale_attempts
+
+def register_pair(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "nevermore",
+                                       "questions": ["q1", "q2", "q3"], "answers": ["a", "b", "c"]}).raise_for_status()
+    return poe, lenore
+
+def test_scheduler_pops_in_expiry_order_and_honours_reschedules():
+    scheduler = CooldownScheduler()
+    start = datetime.now()
+    scheduler.schedule(1, 2, "poe", "lenore", start + timedelta(seconds=30))
+    scheduler.schedule(3, 4, "annabel", "ligeia", start + timedelta(seconds=10))
+    scheduler.schedule(5, 6, "morella", "berenice", start + timedelta(seconds=20))
+    # A new cooldown for the same pair replaces the old deadline
+    scheduler.schedule(1, 2, "poe", "lenore", start + timedelta(seconds=90))
+
+    now = start.timestamp()
+    assert len(scheduler) == 3
+    assert scheduler.pop_expired(now + 5) == []
+    assert scheduler.pop_expired(now + 40) == [("annabel", "ligeia"), ("morella", "berenice")]
+    assert scheduler.pop_expired(now + 60) == []
+    assert scheduler.pop_expired(now + 90) == [("poe", "lenore")]
+    assert len(scheduler) == 0 and not scheduler.heap
+
+def test_run_loop_calls_hooks_when_a_cooldown_ends():
+    scheduler = CooldownScheduler()
+    fired = []
+
+    async def hook(username, target_username):
+        fired.append((username, target_username, time.time()))
+
+    async def run():
+        scheduler.hooks.append(hook)
+        scheduler.start()
+        await asyncio.sleep(0.01)
+        scheduler.schedule(1, 2, "poe", "lenore", datetime.now() + timedelta(seconds=0.1))
+        # An earlier deadline wakes the sleeping loop
+        scheduler.schedule(3, 4, "annabel", "ligeia", datetime.now() + timedelta(seconds=0.02))
+        scheduled = time.time()
+        await asyncio.sleep(0.2)
+        scheduler.stop()
+        return scheduled
+
+    scheduled = asyncio.run(run())
+    assert [(username, target) for username, target, _ in fired] == [("annabel", "ligeia"), ("poe", "lenore")]
+    assert fired[0][2] - scheduled < 0.08
+
+def test_cooldown_is_scheduled_loaded_and_pushed(backend, monkeypatch):
+    import websocket_server
+    from database import SessionLocal
+
+    client = TestClient(backend.app)
+    poe, lenore = register_pair(client)
+    attempt = {"target_username": lenore, "current_username": poe, "answers": ["x", "y", "z"]}
+    statuses = [client.post("/attempt-connection", json=attempt).status_code for _ in range(6)]
+    assert statuses == [200] * 5 + [429]
+
+    pending = [entry for entry in backend.cooldowns.heap if entry[3] == poe]
+    assert len(pending) == 1 and pending[0][4] == lenore
+    assert 110 < pending[0][0] - time.time() <= 120
+
+    # A restarted process finds the same cooldown in the table
+    restarted = CooldownScheduler()
+    db = SessionLocal()
+    try:
+        restarted.load(db)
+    finally:
+        db.close()
+    assert [entry[3:] for entry in restarted.heap if entry[3] == poe] == [(poe, lenore)]
+
+    emitted = []
+
+    async def fake_emit(event, data, room=None, **kwargs):
+        emitted.append((event, data["target_username"], room))
+
+    monkeypatch.setattr(websocket_server.sio, "emit", fake_emit)
+    assert asyncio.run(websocket_server.notify_cooldown_expired(poe, lenore)) is None
+    assert emitted == [("cooldown_expired", lenore, websocket_server.cooldown_room(poe))]
+
+def test_cooldown_pushes_need_the_users_token(backend, monkeypatch):
+    import websocket_server
+    from auth import issue_token
+
+    entered = []
+
+    async def fake_enter_room(sid, room):
+        entered.append((sid, room))
+
+    monkeypatch.setattr(websocket_server.sio, "enter_room", fake_enter_room)
+
+    async def run():
+        return [
+            await websocket_server.watch_cooldowns("sid", {"username": "poe"}),
+            await websocket_server.watch_cooldowns("sid", {"username": "lenore", "token": issue_token(1, "poe")}),
+            await websocket_server.watch_cooldowns("sid", {"token": issue_token(1, "poe")}),
+        ]
+
+    try:
+        claimed, mismatched, verified = asyncio.run(run())
+    finally:
+        websocket_server.session_claims.pop("sid", None)
+    assert claimed == {"error": "Authentication required"}
+    assert mismatched == {"error": "Token does not belong to this user"}
+    assert verified == {"username": "poe"}
+    assert entered == [("sid", websocket_server.cooldown_room("poe"))]
+
+def test_stale_attempts_are_deleted_in_batches(backend):
+    from database import SessionLocal, User, ConnectionAttempt
+
+    client = TestClient(backend.app)
+    poe, lenore = register_pair(client)
+    now = datetime.now()
+    db = SessionLocal()
+    try:
+        user_id, target_id = [db.query(User.id).filter(User.username == name).scalar() for name in (poe, lenore)]
+        old = now - timedelta(days=3)
+        rows = [ConnectionAttempt(user_id=user_id, target_user_id=target_id, attempts=2, last_attempt=old) for _ in range(5)]
+        rows.append(ConnectionAttempt(user_id=user_id, target_user_id=target_id, attempts=0, last_attempt=old,
+                                      cooldown_until=now + timedelta(minutes=1)))
+        rows.append(ConnectionAttempt(user_id=user_id, target_user_id=target_id, attempts=1, last_attempt=now))
+        db.add_all(rows)
+        db.commit()
+
+        assert purge_stale_attempts(db, now=now, batch_size=2) == 5
+        kept = db.query(ConnectionAttempt).filter(ConnectionAttempt.user_id == user_id).all()
+        assert sorted(row.attempts for row in kept) == [0, 1]
+        assert purge_stale_attempts(db, now=now) == 0
+    finally:
+        db.close()
@@ -0,0 +1,112 @@
+"""
+Conversation export: NDJSON or gzip streamed from the archives and the hot
+table, with memory that stays flat for a million-message conversation
+"""
+import os
+import gzip
+import json
+import uuid
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+def connected_pair(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    return poe, lenore, connection
+
+def test_export_includes_archived_and_hot_messages(backend, monkeypatch):
+    import retention
+    from database import SessionLocal
+
+    client = TestClient(backend.app)
+    poe, lenore, connection = connected_pair(client)
+    for i in range(5):
+        sender, target = (poe, lenore) if i % 2 == 0 else (lenore, poe)
+        client.post("/send-message", json={"content": f"line {i}", "target_username": target, "current_username": sender}).raise_for_status()
+    # The first three move to the archive table
+    monkeypatch.setattr(retention, "MESSAGE_HOT_LIMIT", 2)
+    monkeypatch.setattr(retention, "ARCHIVE_BACKEND", "table")
+    db = SessionLocal()
+    try:
+        assert retention.archive_connection(db, connection["connection_id"]) == 3
+    finally:
+        db.close()
+
+    url = f"/messages/{connection['user1_id']}/{lenore}/export"
+    response = client.get(url)
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert f"conversation-{connection['connection_id']}.ndjson" in response.headers["content-disposition"]
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["seq"], row["content"], row["sender"]) for row in rows] == [
+        (i + 1, f"line {i}", poe if i % 2 == 0 else lenore) for i in range(5)
+    ]
+    assert set(rows[0]) == {"id", "seq", "content", "sender", "timestamp"}
+    assert rows[0]["timestamp"][10] == "T" and rows[4]["timestamp"][10] == "T"
+
+    compressed = client.get(url, params={"format": "gzip"})
+    assert compressed.headers["content-type"] == "application/gzip"
+    assert gzip.decompress(compressed.content).decode() == response.text
+
+    assert client.get(url, params={"format": "xml"}).status_code == 400
+    assert client.get(f"/messages/{connection['user1_id']}/nobody_at_all/export").status_code == 404
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="reads RSS from /proc")
+def test_million_message_export_streams_in_flat_memory(backend):
+    from database import get_engine
+
+    client = TestClient(backend.app)
+    poe, lenore, connection = connected_pair(client)
+    connection_id, poe_id, lenore_id = connection["connection_id"], connection["user1_id"], connection["user2_id"]
+    count = 1_000_000
+    # Generated inside SQLite, which is several times faster than binding a million rows
+    with get_engine().begin() as db:
+        db.exec_driver_sql(
+            "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1) "
+            "INSERT INTO messages (connection_id, sender_id, content, timestamp, seq) "
+            "SELECT ?, CASE i % 2 WHEN 0 THEN ? ELSE ? END, 'Quoth the raven, nevermore ' || i, "
+            "datetime('2025-10-31', '+' || i || ' seconds'), i + 1 FROM n",
+            (count, connection_id, poe_id, lenore_id)
+        )
+
+    # Drive the ASGI app directly: TestClient would collect the whole body in memory
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": f"/messages/{poe_id}/{lenore}/export", "raw_path": b"", "query_string": b"",
+        "root_path": "", "headers": [(b"host", b"testserver")], "client": ("test", 1), "server": ("testserver", 80),
+    }
+    seen = {"bytes": 0, "lines": 0, "baseline": None, "peak": 0, "status": None}
+    received = []
+
+    async def receive():
+        # The request, then nothing more: the client stays connected until the response ends
+        if received:
+            await asyncio.Event().wait()
+        received.append(True)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            seen["status"] = message["status"]
+            return
+        body = message.get("body", b"")
+        seen["bytes"] += len(body)
+        seen["lines"] += body.count(b"\n")
+        if seen["baseline"] is None and seen["lines"] >= 50_000:
+            seen["baseline"] = rss_bytes()
+        elif seen["baseline"] is not None:
+            seen["peak"] = max(seen["peak"], rss_bytes())
+
+    asyncio.run(backend.app(scope, receive, send))
+    assert seen["status"] == 200 and seen["lines"] == count
+    # About 130 MB goes out, while the process grows by no more than a few batches
+    assert seen["bytes"] > 120 * 1024 * 1024
+    assert seen["peak"] - seen["baseline"] < 16 * 1024 * 1024
@@ -0,0 +1,113 @@
+"""
+Group rooms: creating groups and adding members in batches, joins checked
+against the member list, one encoded packet fanned out to every member,
+and relaxing chat_rooms.user2_id on older databases
+"""
+import os
+import uuid
+import asyncio
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, text
+
+@pytest.fixture
+def client(backend):
+    return TestClient(backend.app)
+
+def register(client, count):
+    prefix = uuid.uuid4().hex[:6]
+    usernames = [f"{prefix}_raven{i}" for i in range(count)]
+    users = [{"username": username, "password": "nevermore", "questions": ["q"], "answers": ["a"]} for username in usernames]
+    client.post("/register/batch", json={"users": users}).raise_for_status()
+    return usernames
+
+def test_create_group_and_add_members(client):
+    poe, *members = register(client, 4)
+    created = client.post("/rooms", json={"name": "The Raven Society", "current_username": poe,
+                                          "members": members[:2] + [poe, "nobody_at_all"]}).json()
+    room_id = created["room_id"]
+    assert created["added"] == members[:2] and created["missing"] == ["nobody_at_all"]
+
+    added = client.post(f"/rooms/{room_id}/members", json={"usernames": members, "current_username": members[0]}).json()
+    assert added["added"] == members[2:]
+    listed = client.get(f"/rooms/{room_id}/members", params={"current_username": poe}).json()
+    assert sorted(user["username"] for user in listed) == sorted([poe] + members)
+    assert client.get("/rooms", params={"current_username": members[2]}).json() == [
+        {"room_id": room_id, "name": "The Raven Society", "members": 4}
+    ]
+
+    stranger = register(client, 1)[0]
+    assert client.get(f"/rooms/{room_id}/members", params={"current_username": stranger}).status_code == 403
+    assert client.post(f"/rooms/{room_id}/members", json={"usernames": [stranger], "current_username": stranger}).status_code == 403
+    assert client.get("/rooms/nosuchroom/members", params={"current_username": poe}).status_code == 404
+
+def test_group_is_capped(client):
+    from database import SessionLocal
+    from group_rooms import GroupFullError, add_members, find_group
+
+    poe, *members = register(client, 4)
+    room_id = client.post("/rooms", json={"name": "Usher", "current_username": poe}).json()["room_id"]
+    db = SessionLocal()
+    try:
+        room = find_group(db, room_id)
+        with pytest.raises(GroupFullError):
+            add_members(db, room.id, members, max_members=3)
+        assert add_members(db, room.id, members[:2], max_members=3) == (members[:2], [])
+    finally:
+        db.close()
+
+def test_group_messages_fan_out_to_members_only(client, backend, monkeypatch):
+    import websocket_server as ws
+
+    poe, lenore, annabel, stranger = register(client, 4)
+    room_id = client.post("/rooms", json={"name": "Nevermore", "current_username": poe,
+                                          "members": [lenore, annabel]}).json()["room_id"]
+    delivered = []
+
+    async def record_send(eio_sid, eio_pkt):
+        delivered.append((eio_sid, eio_pkt))
+
+    monkeypatch.setattr(ws.sio.eio, "send_packet", record_send)
+
+    async def run():
+        clients = {}
+        for username in (poe, lenore, annabel, stranger):
+            eio_sid = f"eio_{uuid.uuid4().hex}"
+            clients[username] = (eio_sid, await ws.sio.manager.connect(eio_sid, "/"))
+        acks = [await ws.join_group(sid, {"room": room_id, "username": username}) for username, (_, sid) in clients.items()]
+        delivered.clear()
+        ack = await ws.group_message(clients[lenore][1], {"id": 7, "room": room_id, "text": "Quoth the raven",
+                                                          "timestamp": "2025-10-31T00:00:00"})
+        rejected = await ws.group_message(clients[stranger][1], {"id": 8, "room": room_id, "text": "Let me in"})
+        return clients, acks, ack, rejected
+
+    clients, acks, ack, rejected = asyncio.run(run())
+    assert acks[:3] == [{"room": room_id, "members": 3}] * 3
+    assert acks[3] == {"error": "Not a member of this room"}
+    assert ack == {"room": room_id} and rejected is None
+
+    members = [clients[username][0] for username in (poe, lenore, annabel)]
+    group_packets = [(eio_sid, eio_pkt) for eio_sid, eio_pkt in delivered if "group_message" in eio_pkt.data]
+    assert sorted(eio_sid for eio_sid, _ in group_packets) == sorted(members)
+    # Encoded once: every member is handed the same packet object
+    assert len({id(eio_pkt) for _, eio_pkt in group_packets}) == 1
+    assert '"sender":"%s"' % lenore in group_packets[0][1].data
+    assert any("not_authorized" in eio_pkt.data for eio_sid, eio_pkt in delivered if eio_sid == clients[stranger][0])
+
+def test_upgrade_relaxes_user2_on_old_chat_rooms():
+    from database import upgrade_schema
+
+    path = os.path.join(tempfile.mkdtemp(prefix="poe_upgrade_"), "old.db")
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE chat_rooms (id INTEGER PRIMARY KEY, room_id VARCHAR(100) NOT NULL, "
+                                "user1_id INTEGER NOT NULL, user2_id INTEGER NOT NULL, created_at DATETIME, is_active BOOLEAN)"))
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)  # idempotent
+
+    columns = {column["name"]: column for column in inspect(engine).get_columns("chat_rooms")}
+    engine.dispose()
+    assert columns["user2_id"]["nullable"] and "name" in columns
@@ -0,0 +1,45 @@
+"""
+Lazy startup: importing the app opens no database pool, loads no Bedrock
+client and reads no knowledge base; each is created on first use
+"""
+import os
+import sys
+import subprocess
+
+from conftest import BACKEND_DIR
+
+IMPORT_ONLY = """
+import sys
+import database, knowledge, main
+
+assert database._engine is None, "engine created at import"
+assert not knowledge.is_loaded(), "knowledge base read at import"
+assert not main.bedrock_initialized, "Bedrock initialized at import"
+assert "boto3" not in sys.modules and "botocore" not in sys.modules, "boto3 imported at import"
+assert "psycopg2" not in sys.modules, "database driver loaded at import"
+print("lazy")
+"""
+
+def test_importing_the_app_creates_nothing():
+    # An unreachable PostgreSQL URL: anything that connected, or even loaded the driver, would show
+    env = {**os.environ, "DATABASE_URL": "postgresql://nobody@127.0.0.1:1/nothing", "PYTHONPATH": BACKEND_DIR}
+    result = subprocess.run([sys.executable, "-c", IMPORT_ONLY], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith("lazy")
+
+def test_components_are_created_on_first_use(backend, monkeypatch):
+    import database
+    import knowledge
+
+    monkeypatch.setattr(knowledge, "_knowledge_base", None)
+    assert not knowledge.is_loaded()
+    assert knowledge.poems(), "the bundled knowledge base has poems"
+    assert knowledge.is_loaded()
+
+    session = database.SessionLocal()
+    try:
+        assert session.get_bind() is database.get_engine()
+    finally:
+        session.close()
+    assert database.engine is database.get_engine()
@@ -0,0 +1,140 @@
+"""
+LLM gateway: concurrency limit, request coalescing and error handling,
+driven by FakeLLMClient so no test touches Bedrock
+"""
+import asyncio
+import json
+import threading
+
+from llm import FakeLLMClient, LLMGateway, LLMError
+from metrics import LLM_COALESCED, LLM_IN_FLIGHT
+
+CLAUDE_3 = "anthropic.claude-3-haiku-20240307-v1:0"
+CLAUDE_2 = "anthropic.claude-v2"
+
+def test_fake_client_is_deterministic():
+    async def run():
+        fake = FakeLLMClient()
+        first = await fake.invoke(CLAUDE_3, "same prompt")
+        second = await fake.invoke(CLAUDE_3, "same prompt")
+        other = await fake.invoke(CLAUDE_3, "other prompt")
+        return first, second, other
+
+    first, second, other = asyncio.run(run())
+    assert first == second
+    assert first != other
+    assert first["content"][0]["text"]
+
+def test_fake_client_matches_model_format():
+    fake = FakeLLMClient(responses={CLAUDE_2: "a completion"})
+    assert asyncio.run(fake.invoke(CLAUDE_2, "prompt")) == {"completion": "a completion"}
+
+def test_gateway_limits_in_flight_calls():
+    fake = FakeLLMClient(latency=0.01)
+    gateway = LLMGateway(fake, max_in_flight=3)
+
+    async def run():
+        return await asyncio.gather(*(gateway.invoke(CLAUDE_3, f"prompt {i}", "poem") for i in range(10)))
+
+    results = asyncio.run(run())
+    assert len(results) == 10
+    assert len(fake.calls) == 10
+    assert fake.max_in_flight == 3
+    assert LLM_IN_FLIGHT.value() == 0
+
+def test_gateway_coalesces_identical_prompts():
+    fake = FakeLLMClient(latency=0.01)
+    gateway = LLMGateway(fake)
+    coalesced = LLM_COALESCED.value(kind="poem")
+
+    async def run():
+        same = [gateway.invoke(CLAUDE_3, "identical", "poem") for _ in range(5)]
+        different = gateway.invoke(CLAUDE_3, "different", "poem")
+        results = await asyncio.gather(*same, different)
+        await asyncio.sleep(0)  # done callbacks
+        return results, dict(gateway.in_flight())
+
+    results, in_flight = asyncio.run(run())
+    assert len(fake.calls) == 2
+    assert all(result == results[0] for result in results[:5])
+    assert results[5] != results[0]
+    assert LLM_COALESCED.value(kind="poem") - coalesced == 4
+    assert in_flight == {}
+
+def test_gateway_coalesces_only_within_an_event_loop():
+    fake = FakeLLMClient(latency=0.05)
+    gateway = LLMGateway(fake)
+    results = []
+    both_started = threading.Barrier(2)
+
+    def run_on_own_loop():
+        async def run():
+            both_started.wait()
+            return await gateway.invoke(CLAUDE_3, "identical", "poem")
+        results.append(asyncio.run(run()))
+
+    threads = [threading.Thread(target=run_on_own_loop) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A future from another loop can't be awaited here, so each loop made its own call
+    assert len(results) == 2 and results[0] == results[1]
+    assert len(fake.calls) == 2
+
+def test_gateway_does_not_coalesce_sequential_calls():
+    fake = FakeLLMClient()
+    gateway = LLMGateway(fake)
+
+    async def run():
+        await gateway.invoke(CLAUDE_3, "prompt", "poem")
+        await gateway.invoke(CLAUDE_3, "prompt", "poem")
+
+    asyncio.run(run())
+    assert len(fake.calls) == 2
+
+def test_gateway_shares_errors_with_coalesced_callers():
+    fake = FakeLLMClient(latency=0.01, fail_models=(CLAUDE_3,))
+    gateway = LLMGateway(fake)
+
+    async def run():
+        return await asyncio.gather(*(gateway.invoke(CLAUDE_3, "prompt", "poem") for _ in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(fake.calls) == 1
+    assert all(isinstance(result, LLMError) for result in results)
+
+def test_cancelled_caller_does_not_cancel_shared_request():
+    fake = FakeLLMClient(latency=0.02)
+    gateway = LLMGateway(fake)
+
+    async def run():
+        first = asyncio.ensure_future(gateway.invoke(CLAUDE_3, "prompt", "poem"))
+        second = asyncio.ensure_future(gateway.invoke(CLAUDE_3, "prompt", "poem"))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run())["content"][0]["text"]
+    assert len(fake.calls) == 1
+
+def test_generators_use_gateway(backend, monkeypatch):
+    fake = FakeLLMClient()
+    monkeypatch.setattr(backend, "llm_client", LLMGateway(fake))
+
+    poem = asyncio.run(backend.generate_poe_poem(["Dracula", "Deep purple", "Raven"]))
+    message = asyncio.run(backend.generate_cryptic_message(["Dracula", "Deep purple", "Raven"]))
+
+    assert poem.startswith("Once upon a midnight")
+    assert message.startswith("Once upon a midnight")
+    assert "Dracula" in json.loads(fake.calls[0][1])["messages"][0]["content"]
+
+def test_generators_fall_back_when_models_fail(backend, monkeypatch):
+    models = ["anthropic.claude-3-sonnet-20240229-v1:0", CLAUDE_3, "anthropic.claude-v2:1", CLAUDE_2]
+    fake = FakeLLMClient(fail_models=tuple(models))
+    monkeypatch.setattr(backend, "llm_client", LLMGateway(fake))
+
+    poem = asyncio.run(backend.generate_poe_poem(["Dracula", "Deep purple", "Raven"]))
+    assert [model for model, _ in fake.calls] == models
+    assert "Dracula" in poem
@@ -0,0 +1,77 @@
+"""
+Structured logging: JSON and key=value records with their extra fields,
+written through the background queue, and sampled, rate-limited DEBUG
+"""
+import io
+import sys
+import json
+import logging
+
+import pytest
+
+import logging_config
+from logging_config import JsonFormatter, TextFormatter, SampledDebugFilter, parse_levels
+
+def make_record(level=logging.INFO, message="Message sent", lineno=10, **extra):
+    record = logging.LogRecord("main", level, "main.py", lineno, message, (), None)
+    record.__dict__.update(extra)
+    return record
+
+@pytest.fixture
+def json_output(monkeypatch):
+    """Restart logging with LOG_FORMAT=json into a buffer; returns a function reading the records"""
+    buffer = io.StringIO()
+    logging_config.stop_logging()
+    monkeypatch.setenv("LOG_FORMAT", "json")
+    monkeypatch.setattr(sys, "stdout", buffer)
+    logging_config.setup_logging()
+
+    def records():
+        logging_config.stop_logging()  # drains the queue
+        return [json.loads(line) for line in buffer.getvalue().splitlines()]
+
+    yield records
+    logging_config.stop_logging()
+    monkeypatch.undo()
+    logging_config.setup_logging()
+
+def test_json_records_carry_extra_fields(json_output):
+    logger = logging.getLogger("main")
+    logger.info("Message sent", extra={"connection_id": 7, "seq": 3})
+    try:
+        raise ValueError("nevermore")
+    except ValueError:
+        logger.exception("Send failed", extra={"connection_id": 7})
+
+    sent, failed = [record for record in json_output() if record["logger"] == "main"]
+    assert {key: sent[key] for key in ("level", "message", "connection_id", "seq")} == {
+        "level": "INFO", "message": "Message sent", "connection_id": 7, "seq": 3}
+    assert sent["time"].endswith("+00:00")
+    assert failed["level"] == "ERROR" and failed["connection_id"] == 7
+    assert "ValueError: nevermore" in failed["message"] + failed.get("exception", "")
+
+def test_formatters():
+    record = make_record(connection_id=7, when=None)
+    assert TextFormatter().format(record).endswith("INFO    main: Message sent connection_id=7 when=None")
+    payload = json.loads(JsonFormatter().format(make_record(sent_at=object())))
+    assert payload["message"] == "Message sent" and payload["sent_at"].startswith("<object")
+
+def test_debug_records_are_rate_limited_per_call_site(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(logging_config.time, "monotonic", lambda: now[0])
+    limiter = SampledDebugFilter(per_second=2)
+    debug = lambda lineno: limiter.filter(make_record(logging.DEBUG, lineno=lineno))
+
+    assert [debug(10) for _ in range(4)] == [True, True, False, False]
+    assert debug(11), "another call site has its own budget"
+    assert limiter.filter(make_record(logging.WARNING)), "only DEBUG is limited"
+    now[0] += 1.0
+    assert debug(10)
+
+def test_debug_sampling(monkeypatch):
+    monkeypatch.setattr(logging_config.random, "random", lambda: 0.5)
+    assert not SampledDebugFilter(sample_rate=0.25).filter(make_record(logging.DEBUG))
+    assert SampledDebugFilter(sample_rate=0.75).filter(make_record(logging.DEBUG))
+
+def test_parse_levels():
+    assert parse_levels("main=debug, sqlalchemy.engine=INFO,bogus") == {"main": "DEBUG", "sqlalchemy.engine": "INFO"}
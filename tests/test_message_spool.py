@@ -0,0 +1,154 @@
+"""
+Message spool: sends accepted while the database is down are acknowledged
+with provisional ids, replayed in order, and survive crashes of both the
+writer and the replay without loss or duplicates
+"""
+import os
+import sys
+import json
+import uuid
+import signal
+import tempfile
+import subprocess
+
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+
+from message_spool import MessageSpool
+
+class DownSession:
+    """Session for a database that has gone away"""
+
+    def query(self, *args):
+        raise OperationalError("SELECT 1", {}, Exception("could not connect to server"))
+
+    def close(self):
+        pass
+
+def connected_pair(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    return poe, lenore, connection["connection_id"]
+
+def stored_messages(connection_id):
+    from database import SessionLocal, Message
+
+    db = SessionLocal()
+    try:
+        rows = db.query(Message).filter(Message.connection_id == connection_id).order_by(Message.seq).all()
+        return [(row.seq, row.content, row.client_id) for row in rows]
+    finally:
+        db.close()
+
+def test_sends_are_spooled_while_the_database_is_down(backend, monkeypatch):
+    client = TestClient(backend.app)
+    poe, lenore, connection_id = connected_pair(client)
+    spool = MessageSpool(tempfile.mkdtemp(prefix="poe_spool_"), fsync_ms=0)
+    monkeypatch.setattr(backend, "message_spool", spool)
+
+    def database_down(*args, **kwargs):
+        raise OperationalError("INSERT INTO messages", {}, Exception("server closed the connection unexpectedly"))
+
+    monkeypatch.setattr(backend, "store_message", database_down)
+    send = lambda content, **extra: client.post("/send-message", json={
+        "content": content, "target_username": lenore, "current_username": poe, **extra})
+    spooled = [send("Once upon a midnight dreary"), send("While I pondered", client_id="c2")]
+    assert [response.status_code for response in spooled] == [202, 202]
+    first, second = [response.json() for response in spooled]
+    assert first["spooled"] and first["provisional_id"].startswith("spool-") and first["client_id"] == first["provisional_id"]
+    assert second["client_id"] == "c2" and first["seq"] is None
+
+    # Back up, but sends keep queueing behind the spool until it is replayed
+    monkeypatch.undo()
+    monkeypatch.setattr(backend, "message_spool", spool)
+    assert send("weak and weary").status_code == 202
+    assert spool.replay() == 3 and not spool.pending()
+    assert send("Nevermore").status_code == 200
+    assert [(seq, content) for seq, content, _ in stored_messages(connection_id)] == [
+        (1, "Once upon a midnight dreary"), (2, "While I pondered"), (3, "weak and weary"), (4, "Nevermore")]
+    assert stored_messages(connection_id)[0][2] == first["provisional_id"]
+    spool.close()
+    assert os.listdir(spool.directory) == []
+
+def test_a_rejected_record_is_dead_lettered_and_replay_moves_on(backend):
+    client = TestClient(backend.app)
+    poe, lenore, connection_id = connected_pair(client)
+    spool = MessageSpool(tempfile.mkdtemp(prefix="poe_spool_"), fsync_ms=0)
+    record = lambda content, timestamp: {"provisional_id": f"spool-{content}", "sender_id": None, "sender": poe,
+                                         "target": lenore, "content": content, "client_id": f"spool-{content}",
+                                         "timestamp": timestamp}
+    spool.write(record("garbled", "the witching hour"))
+    spool.write(record("Nevermore", "2025-10-31T23:59:00"))
+
+    assert spool.replay() == 1 and not spool.pending()
+    assert [(seq, content) for seq, content, _ in stored_messages(connection_id)] == [(1, "Nevermore")]
+    with open(os.path.join(spool.directory, "dead-letter.jsonl")) as dead:
+        letters = [json.loads(line) for line in dead]
+    assert [letter["content"] for letter in letters] == ["garbled"] and "ValueError" in letters[0]["error"]
+    spool.close()
+
+WRITER = """
+import os, sys, asyncio, signal
+sys.path.insert(0, sys.argv[1])
+from message_spool import MessageSpool, new_provisional_id
+
+async def main():
+    spool = MessageSpool(sys.argv[2], fsync_ms=1)
+    for i in range(int(sys.argv[5])):
+        provisional_id = new_provisional_id()
+        await spool.append({"provisional_id": provisional_id, "sender_id": None, "sender": sys.argv[3],
+                            "target": sys.argv[4], "content": f"line {i}", "client_id": provisional_id,
+                            "timestamp": "2025-10-31T23:59:00"})
+        print(provisional_id, flush=True)
+    # Killed while writing the next record: half a line, never acknowledged
+    spool.active.file.write(b'{"provisional_id": "spool-torn", "sen')
+    spool.active.file.flush()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+asyncio.run(main())
+"""
+
+def test_crash_recovery_loses_and_duplicates_nothing(backend):
+    from database import SessionLocal
+
+    client = TestClient(backend.app)
+    poe, lenore, connection_id = connected_pair(client)
+    directory = tempfile.mkdtemp(prefix="poe_spool_")
+    backend_dir = os.path.dirname(sys.modules["message_spool"].__file__)
+
+    # The writer acknowledges 50 messages and is killed
+    count = 50
+    writer = subprocess.run([sys.executable, "-c", WRITER, backend_dir, directory, poe, lenore, str(count)],
+                            capture_output=True, text=True, timeout=60)
+    assert writer.returncode == -signal.SIGKILL
+    acknowledged = writer.stdout.split()
+    assert len(acknowledged) == count
+
+    # The next process starts replaying, and the database drops out after 20 messages
+    calls = []
+
+    def flaky_sessions():
+        calls.append(1)
+        return SessionLocal() if len(calls) <= 20 else DownSession()
+
+    recovering = MessageSpool(directory)
+    assert recovering.claim_orphans() == 1
+    assert recovering.replay(flaky_sessions) == 20
+    assert recovering.pending()
+    # ...and that process crashes too, before finishing
+    recovering.segments[0].file.close()
+    del recovering
+
+    restarted = MessageSpool(directory)
+    assert restarted.claim_orphans() == 1
+    assert restarted.replay() == count - 20
+    assert not restarted.pending()
+    restarted.close()
+
+    stored = stored_messages(connection_id)
+    assert [client_id for _, _, client_id in stored] == acknowledged
+    assert [(seq, content) for seq, content, _ in stored] == [(i + 1, f"line {i}") for i in range(count)]
+    assert os.listdir(directory) == []
@@ -0,0 +1,143 @@
+"""
+Per-connection sequence numbers, idempotent sends and resumable sync
+"""
+import os
+import uuid
+import asyncio
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+@pytest.fixture
+def client(backend):
+    return TestClient(backend.app)
+
+def connected_pair(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "nevermore",
+                                       "questions": ["q1", "q2", "q3"], "answers": ["a", "b", "c"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    return poe, lenore, connection
+
+def test_send_is_idempotent_and_sequenced(client):
+    poe, lenore, connection = connected_pair(client)
+
+    def send(content, client_id, sender=poe, target=lenore):
+        response = client.post("/send-message", json={"content": content, "target_username": target,
+                                                      "current_username": sender, "client_id": client_id})
+        response.raise_for_status()
+        return response.json()
+
+    first = send("Once upon a midnight dreary", 1761955199000)
+    retry = send("Once upon a midnight dreary", 1761955199000)
+    reply = send("While I pondered, weak and weary", "abc", sender=lenore, target=poe)
+    third = send("Over many a quaint and curious volume", None)
+
+    assert (first["seq"], reply["seq"], third["seq"]) == (1, 2, 3)
+    assert retry["id"] == first["id"] and retry["seq"] == 1
+    assert (first["duplicate"], retry["duplicate"]) == (False, True)
+    assert first["client_id"] == "1761955199000"
+
+    user_id = connection["user1_id"]
+    history = client.get(f"/messages/{user_id}/{lenore}").json()
+    assert [message["seq"] for message in history] == [1, 2, 3]
+    gap = client.get(f"/messages/{user_id}/{lenore}", params={"after_seq": 1}).json()
+    assert [message["content"] for message in gap] == ["While I pondered, weak and weary", "Over many a quaint and curious volume"]
+    assert client.get(f"/messages/{user_id}/{lenore}", params={"after_seq": 2, "limit": 1}).json()[0]["seq"] == 3
+
+def test_websocket_retries_are_acked_not_rebroadcast(client, backend, monkeypatch):
+    import websocket_server as ws
+
+    poe, lenore, connection = connected_pair(client)
+    emitted = []
+
+    async def fake_emit(event, data, room=None, to=None, **kwargs):
+        emitted.append((event, data, room or to))
+
+    monkeypatch.setattr(ws.sio, "emit", fake_emit)
+    message = {"id": 42, "sender": poe, "targetUsername": lenore, "text": "Nevermore", "timestamp": "2025-10-31T00:00:00"}
+
+    async def run():
+        sid = await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/")
+        await ws.join_chat(sid, {"username": poe, "targetUsername": lenore})
+        acks = [await ws.message(sid, message), await ws.message(sid, message),
+                await ws.message(sid, {**message, "id": 43, "text": "Lenore"})]
+
+        # A second session resumes after seq 1 and only gets the gap
+        emitted.clear()
+        other = await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/")
+        await ws.join_chat(other, {"username": lenore, "targetUsername": poe, "resumeFrom": 1})
+        return acks, other
+
+    acks, other = asyncio.run(run())
+    assert acks == [{"seq": 1}, {"seq": 1, "duplicate": True}, {"seq": 2}]
+    sync = [data for event, data, target in emitted if event == "sync"]
+    assert sync == [{"room": connection["connection_id"], "has_more": False, "messages": [
+        {"id": "43", "seq": 2, "text": "Lenore", "sender": poe, "timestamp": sync[0]["messages"][0]["timestamp"]}
+    ]}]
+
+def test_upgrade_backfills_sequence_numbers():
+    from database import upgrade_schema
+
+    path = os.path.join(tempfile.mkdtemp(prefix="poe_upgrade_"), "old.db")
+    engine = create_engine(f"sqlite:///{path}")
+    # Tables as an older release created them
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(50), password_hash VARCHAR(255), "
+                                "questions TEXT, answers TEXT, poem TEXT, created_at DATETIME)"))
+        connection.execute(text("CREATE TABLE connections (id INTEGER PRIMARY KEY, user1_id INTEGER, user2_id INTEGER, "
+                                "created_at DATETIME, is_active BOOLEAN)"))
+        connection.execute(text("CREATE TABLE messages (id INTEGER PRIMARY KEY, connection_id INTEGER, sender_id INTEGER, "
+                                "content TEXT, timestamp DATETIME, is_read BOOLEAN)"))
+        connection.execute(text("INSERT INTO connections (id, user1_id, user2_id) VALUES (1, 1, 2), (2, 1, 3), (3, 2, 3)"))
+        connection.execute(text("INSERT INTO messages (id, connection_id, sender_id, content) VALUES "
+                                "(10, 1, 1, 'a'), (11, 2, 1, 'b'), (12, 1, 2, 'c'), (13, 1, 1, 'd'), (14, 2, 3, 'e')"))
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)  # idempotent
+
+    with engine.connect() as connection:
+        seqs = connection.execute(text("SELECT id, seq FROM messages ORDER BY id")).all()
+        last = connection.execute(text("SELECT id, last_seq FROM connections ORDER BY id")).all()
+        indexes = {row[1] for row in connection.execute(text("PRAGMA index_list(messages)"))}
+    engine.dispose()
+    assert [tuple(row) for row in seqs] == [(10, 1), (11, 1), (12, 2), (13, 3), (14, 2)]
+    assert [tuple(row) for row in last] == [(1, 3), (2, 2), (3, 0)]
+    assert {"uq_messages_connection_seq", "uq_messages_client_id"} <= indexes
+
+def test_upgrade_numbers_rows_written_without_a_seq(client):
+    import random
+    from database import get_engine, upgrade_schema
+    from generate_data import generate_messages
+
+    poe, lenore, connection = connected_pair(client)
+    connection_id = connection["connection_id"]
+    for i in range(2):
+        client.post("/send-message", json={"content": f"quoth {i}", "target_username": lenore, "current_username": poe}).raise_for_status()
+    engine = get_engine()
+    with engine.begin() as db:
+        # Retention archived a later message (last_seq ran ahead), then rows arrived without a seq
+        db.execute(text("UPDATE connections SET last_seq = 3 WHERE id = :id"), {"id": connection_id})
+        for content in ("bulk 1", "bulk 2"):
+            db.execute(text("INSERT INTO messages (connection_id, sender_id, content) VALUES (:id, :sender, :content)"),
+                       {"id": connection_id, "sender": connection["user1_id"], "content": content})
+
+    upgrade_schema(engine)
+
+    with engine.connect() as db:
+        seqs = db.execute(text("SELECT content, seq FROM messages WHERE connection_id = :id ORDER BY id"), {"id": connection_id}).all()
+        last_seq = db.execute(text("SELECT last_seq FROM connections WHERE id = :id"), {"id": connection_id}).scalar()
+    assert [tuple(row) for row in seqs] == [("quoth 0", 1), ("quoth 1", 2), ("bulk 1", 4), ("bulk 2", 5)]
+    assert last_seq == 5
+    sent = client.post("/send-message", json={"content": "nevermore", "target_username": lenore, "current_username": poe})
+    assert sent.json()["seq"] == 6
+
+    # The generator numbers each connection's messages itself
+    generated = list(generate_messages([(1, 1, 2), (2, 1, 3)], 50, 1, random.Random(7)))
+    for generated_id in (1, 2):
+        seqs = [row["seq"] for row in generated if row["connection_id"] == generated_id]
+        assert seqs == list(range(1, len(seqs) + 1))
@@ -0,0 +1,106 @@
+"""
+Metrics: Prometheus text output, per-route DB query accounting, scrape
+authorization, and one scrape adding up every worker's snapshot
+"""
+import json
+import uuid
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry, DB_QUERIES_PER_REQUEST
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Metrics created in the test register here instead of the process registry"""
+    registry = Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    return registry
+
+def test_text_exposition_format(registry):
+    requests = Counter("ravens_total", "Ravens seen", ["perch"])
+    requests.inc(perch='bust of "Pallas"')
+    requests.inc(2, perch='bust of "Pallas"')
+    Gauge("candles", "Candles lit").set(3)
+    latency = Histogram("knock_seconds", "Time between knocks", ["door"], buckets=(0.1, 1.0))
+    latency.observe(0.05, door="chamber")
+    latency.observe(0.5, door="chamber")
+    latency.observe(5, door="chamber")
+
+    assert registry.render().splitlines() == [
+        "# HELP ravens_total Ravens seen",
+        "# TYPE ravens_total counter",
+        'ravens_total{perch="bust of \\"Pallas\\""} 3',
+        "# HELP candles Candles lit",
+        "# TYPE candles gauge",
+        "candles 3",
+        "# HELP knock_seconds Time between knocks",
+        "# TYPE knock_seconds histogram",
+        'knock_seconds_bucket{door="chamber",le="0.1"} 1',
+        'knock_seconds_bucket{door="chamber",le="1"} 2',
+        'knock_seconds_bucket{door="chamber",le="+Inf"} 3',
+        'knock_seconds_sum{door="chamber"} 5.55',
+        'knock_seconds_count{door="chamber"} 3',
+    ]
+
+def test_requests_record_their_query_count_by_route(backend):
+    client = TestClient(backend.app)
+    username = f"{uuid.uuid4().hex[:6]}_poe"
+    response = client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]})
+    user_id = response.json()["user_id"]
+
+    route = "/connections/{user_id}"
+    before = DB_QUERIES_PER_REQUEST.series.get((route,), [None, 0.0, 0])
+    before_count, before_queries = before[2], before[1]
+    client.get(f"/connections/{user_id}").raise_for_status()
+    after = DB_QUERIES_PER_REQUEST.series[(route,)]
+    # Labelled by the route template, not the path, and at least the connection lookup was counted
+    assert after[2] == before_count + 1
+    assert after[1] - before_queries >= 1
+    assert (f"/connections/{user_id}",) not in DB_QUERIES_PER_REQUEST.series
+
+def test_scrapes_need_the_metrics_token(backend, monkeypatch):
+    client = TestClient(backend.app)
+    # TestClient is not a loopback client, so without a token nothing is served
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "")
+    assert client.get("/metrics").status_code == 403
+    assert metrics.metrics_allowed(None, "127.0.0.1")
+
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "nevermore")
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    response = client.get("/metrics", headers={"Authorization": "Bearer nevermore"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+
+def test_one_scrape_adds_up_every_worker(registry, monkeypatch):
+    directory = tempfile.mkdtemp(prefix="poe_metrics_")
+    monkeypatch.setattr(metrics, "METRICS_DIR", directory)
+    sent = Counter("messages_total", "Messages sent", ["kind"])
+    online = Gauge("online", "Connected sockets")
+    latency = Histogram("send_seconds", "Send latency", buckets=(1.0,))
+    sent.inc(2, kind="chat")
+    online.set(4)
+    latency.observe(0.5)
+
+    # A running worker's snapshot, and one from a worker that stopped (written without its gauges)
+    with open(f"{directory}/metrics-1.json", "w") as f:
+        json.dump({"messages_total": [[["chat"], 3], [["group"], 1]], "online": [[[], 6]],
+                   "send_seconds": [[[], [0, 2], 4.0, 2]]}, f)
+    with open(f"{directory}/metrics-3.json", "w") as f:
+        json.dump({"messages_total": [[["chat"], 10]]}, f)
+
+    lines = metrics.render_metrics().splitlines()
+    assert 'messages_total{kind="chat"} 15' in lines and 'messages_total{kind="group"} 1' in lines
+    assert "online 10" in lines
+    assert 'send_seconds_bucket{le="1"} 1' in lines and 'send_seconds_bucket{le="+Inf"} 3' in lines
+    assert "send_seconds_count 3" in lines
+
+    # This worker's own snapshot is not added twice, and a stopping worker leaves its gauges out
+    metrics.write_snapshot(gauges=False)
+    with open(metrics.snapshot_path()) as f:
+        assert set(json.load(f)) == {"messages_total", "send_seconds"}
+    assert metrics.render_metrics().splitlines() == lines
@@ -0,0 +1,112 @@
+"""
+Poem pool: skeleton filling, watermarks, refill sources and hit/miss metrics
+"""
+import random
+import asyncio
+
+from llm import FakeLLMClient, LLMGateway
+from metrics import POEM_POOL_HITS, POEM_POOL_MISSES, POEM_POOL_REFILLS
+from poem_pool import SkeletonPool, fill_skeleton, is_skeleton, knowledge_skeleton
+
+async def unavailable():
+    return False
+
+async def available():
+    return True
+
+async def never_called(answers, templates=True):
+    raise AssertionError("model used while unavailable")
+
+def test_fill_skeleton_replaces_placeholders_once():
+    skeleton = "{answer1} and {answer2}, then {answer3} and {answer1} again"
+    assert fill_skeleton(skeleton, ["Raven", " ", "{answer1}"]) == "Raven and shadow, then {answer1} and Raven again"
+
+def test_knowledge_skeletons_keep_every_placeholder():
+    rng = random.Random(7)
+    for kind in ("poem", "cryptic"):
+        for _ in range(20):
+            skeleton = knowledge_skeleton(kind, rng)
+            assert is_skeleton(skeleton)
+            assert "$" not in skeleton
+
+def test_pool_fills_to_high_watermark_and_counts_hits():
+    pool = SkeletonPool("poem", never_called, unavailable, low_watermark=2, high_watermark=4, refill_rate=0)
+    hits = POEM_POOL_HITS.value(kind="poem")
+    misses = POEM_POOL_MISSES.value(kind="poem")
+
+    asyncio.run(pool.fill())
+    assert len(pool) == 4
+    taken = [pool.take() for _ in range(5)]
+
+    assert all(is_skeleton(skeleton) for skeleton in taken[:4])
+    assert taken[4] is None
+    assert POEM_POOL_HITS.value(kind="poem") - hits == 4
+    assert POEM_POOL_MISSES.value(kind="poem") - misses == 1
+
+def test_refill_wakes_below_low_watermark():
+    pool = SkeletonPool("cryptic", never_called, unavailable, low_watermark=2, high_watermark=3, refill_rate=0)
+
+    async def run():
+        pool.start()
+        await asyncio.sleep(0.01)
+        full = len(pool)
+        pool.take()
+        await asyncio.sleep(0.01)
+        above_low = len(pool)
+        pool.take()
+        await asyncio.sleep(0.01)
+        refilled = len(pool)
+        pool.stop()
+        return full, above_low, refilled
+
+    assert asyncio.run(run()) == (3, 2, 3)
+
+def test_pool_uses_model_skeletons_when_available(backend, monkeypatch):
+    fake = FakeLLMClient(responses={
+        "anthropic.claude-3-sonnet-20240229-v1:0": "In {answer1}'s tomb the {answer2} sleeps, and {answer3} wakes; " * 2,
+    })
+    monkeypatch.setattr(backend, "llm_client", LLMGateway(fake))
+    pool = SkeletonPool("poem", backend.compose_poe_poem, lambda: backend.llm_client.available(),
+                        low_watermark=1, high_watermark=1, refill_rate=0)
+    refills = POEM_POOL_REFILLS.value(kind="poem", source="bedrock")
+
+    asyncio.run(pool.fill())
+    poem = fill_skeleton(pool.take(), ["Dracula", "Deep purple", "Raven"])
+
+    assert poem.startswith("In Dracula's tomb the Deep purple sleeps, and Raven wakes")
+    assert "{answer1}" in fake.calls[0][1]
+    assert POEM_POOL_REFILLS.value(kind="poem", source="bedrock") - refills == 1
+
+def test_pool_rejects_model_text_without_placeholders(backend, monkeypatch):
+    monkeypatch.setattr(backend, "llm_client", LLMGateway(FakeLLMClient()))
+    pool = SkeletonPool("cryptic", backend.compose_cryptic_message, available,
+                        low_watermark=1, high_watermark=1, refill_rate=0)
+    refills = POEM_POOL_REFILLS.value(kind="cryptic", source="template")
+
+    asyncio.run(pool.fill())
+
+    assert is_skeleton(pool.take())
+    assert POEM_POOL_REFILLS.value(kind="cryptic", source="template") - refills == 1
+
+def test_failed_model_refills_are_counted_as_templates(backend, monkeypatch):
+    models = ("anthropic.claude-3-sonnet-20240229-v1:0", "anthropic.claude-3-haiku-20240307-v1:0",
+              "anthropic.claude-v2:1", "anthropic.claude-v2")
+    monkeypatch.setattr(backend, "llm_client", LLMGateway(FakeLLMClient(fail_models=models)))
+    pool = SkeletonPool("cryptic", backend.compose_cryptic_message, available,
+                        low_watermark=3, high_watermark=3, refill_rate=0)
+    bedrock = POEM_POOL_REFILLS.value(kind="cryptic", source="bedrock")
+    template = POEM_POOL_REFILLS.value(kind="cryptic", source="template")
+
+    asyncio.run(pool.fill())
+
+    assert all(is_skeleton(pool.take()) for _ in range(3))
+    assert POEM_POOL_REFILLS.value(kind="cryptic", source="bedrock") == bedrock
+    assert POEM_POOL_REFILLS.value(kind="cryptic", source="template") - template == 3
+
+def test_generate_fills_pooled_skeleton(backend, monkeypatch):
+    pool = SkeletonPool("poem", never_called, unavailable)
+    pool.skeletons.append("Nevermore, {answer1}; nevermore, {answer2}; nevermore, {answer3}.")
+    monkeypatch.setattr(backend, "poem_pool", pool)
+
+    poem = asyncio.run(backend.generate_poe_poem(["Dracula", "", "Raven"]))
+    assert poem == "Nevermore, Dracula; nevermore, shadow; nevermore, Raven."
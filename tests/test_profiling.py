@@ -0,0 +1,77 @@
+"""
+Request profiling: the middleware records spans and stacks for requests
+that ask for it, one request at a time, and the admin endpoints serve them
+"""
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import profiling
+from profiling import ProfilingMiddleware
+
+@pytest.fixture
+def profiled_client(backend, monkeypatch):
+    """The app behind the profiling middleware, with an admin token set"""
+    monkeypatch.setattr(backend, "ADMIN_TOKEN", "raven")
+    monkeypatch.setattr(profiling, "profiles", profiling.deque(maxlen=10))
+    monkeypatch.setattr(backend, "profiles", profiling.profiles)
+    return TestClient(ProfilingMiddleware(backend.app))
+
+@pytest.mark.parametrize("mode", ["sampling", "cprofile"])
+def test_profiled_request_is_served_by_the_admin_endpoints(profiled_client, monkeypatch, mode):
+    monkeypatch.setattr(profiling, "PROFILE_MODE", mode)
+    monkeypatch.setattr(profiling, "PROFILE_INTERVAL", 0.0005)
+    admin = {"X-Admin-Token": "raven"}
+
+    assert "x-profile-id" not in profiled_client.get("/users").headers
+    response = profiled_client.get("/users", headers={"X-Profile": "1"})
+    profile_id = response.headers["x-profile-id"]
+
+    assert profiled_client.get("/admin/profiles").status_code == 403
+    assert profiled_client.get("/admin/profiles", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    summary, = profiled_client.get("/admin/profiles", headers=admin).json()
+    assert (summary["id"], summary["route"], summary["status"], summary["mode"]) == (profile_id, "/users", 200, mode)
+    assert summary["spans"]["db"]["count"] >= 1 and "serialization" in summary["spans"]
+    collapsed = profiled_client.get(f"/admin/profiles/{profile_id}", params={"format": "collapsed"}, headers=admin)
+    if mode == "cprofile":
+        assert collapsed.text and all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.text.splitlines())
+    assert profiled_client.get("/admin/profiles/missing", headers=admin).status_code == 404
+
+@pytest.mark.parametrize("mode", ["sampling", "cprofile"])
+def test_one_profile_at_a_time(monkeypatch, mode):
+    monkeypatch.setattr(profiling, "PROFILE_MODE", mode)
+    monkeypatch.setattr(profiling, "profiles", profiling.deque(maxlen=10))
+    started = []
+    gate = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        started.append(scope["path"])
+        await gate.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def request(app, path):
+        headers = {}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                headers.update(message["headers"])
+
+        scope = {"type": "http", "method": "GET", "path": path, "headers": [(b"x-profile", b"1")]}
+        await app(scope, None, send)
+        return headers
+
+    async def main():
+        app = ProfilingMiddleware(slow_app)
+        both = asyncio.gather(request(app, "/first"), request(app, "/second"))
+        while len(started) < 2:
+            await asyncio.sleep(0)
+        gate.set()
+        return await both
+
+    first, second = asyncio.run(main())
+    assert b"x-profile-id" in first and b"x-profile-id" not in second
+    assert second[b"x-profile-skipped"] == b"busy"
+    assert [profile.path for profile in profiling.profiles] == ["/first"]
+    assert not profiling.profiling_lock.locked()
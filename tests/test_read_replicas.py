@@ -0,0 +1,120 @@
+"""
+Read/write splitting: read-only endpoints use the replicas, and a user who
+just wrote reads from the primary until READ_YOUR_WRITES_SECONDS pass,
+on this worker by its marks and on any worker by the cookie. A second
+SQLite file stands in for the replica.
+"""
+import os
+import time
+import uuid
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+
+@pytest.fixture
+def replica(backend, monkeypatch):
+    """A replica database (empty apart from what the test writes) wired into database.router"""
+    import database
+
+    path = os.path.join(tempfile.mkdtemp(prefix="poe_replica_"), "replica.db")
+    url = f"sqlite:///{path}"
+    engine = create_engine(url)
+    database.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    router = database.router
+    monkeypatch.setattr(router, "replica_urls", [url])
+    monkeypatch.setattr(router, "sticky_seconds", 30)
+    monkeypatch.setattr(router, "engines", [])
+    monkeypatch.setattr(router, "replicas", [])
+    monkeypatch.setattr(router, "recent_writes", {})
+    yield router.replica_sessionmakers()[0]
+    router.dispose()
+
+def test_reads_go_to_the_replica_until_the_user_writes(backend, replica):
+    from database import User, router
+
+    client = TestClient(backend.app)
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    poe_id = connection["user1_id"]
+    db = replica()
+    try:
+        db.add(User(username=f"{prefix}_replica_only", password_hash="", questions="[]", answers="[]"))
+        db.commit()
+    finally:
+        db.close()
+
+    # The user directory has no user to stick to: a client that has not written reads the replica
+    reader = TestClient(backend.app)
+    assert [user["username"] for user in reader.get("/users").json()] == [f"{prefix}_replica_only"]
+
+    # Creating the connection made both users sticky: they see it on the primary
+    assert reader.get(f"/connections/{poe_id}").json() == [{"username": lenore}]
+    router.recent_writes.clear()
+    assert reader.get(f"/connections/{poe_id}").json() == []
+    assert reader.get(f"/messages/{poe_id}/{lenore}").status_code == 404
+
+    # A send sticks the sender to the primary, so they read their own message
+    client.post("/send-message", json={"content": "nevermore", "target_username": lenore, "current_username": poe}).raise_for_status()
+    assert [message["content"] for message in client.get(f"/messages/{poe_id}/{lenore}").json()] == ["nevermore"]
+    assert router.is_sticky(poe_id) and not router.is_sticky(connection["user2_id"])
+
+def test_the_cookie_carries_read_your_writes_to_other_workers(backend, replica):
+    from database import READ_YOUR_WRITES_COOKIE, router
+
+    writer = TestClient(backend.app)
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        writer.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    assert READ_YOUR_WRITES_COOKIE not in writer.cookies
+    poe_id = writer.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()["user1_id"]
+    until = float(writer.cookies[READ_YOUR_WRITES_COOKIE])
+    assert time.time() < until <= time.time() + router.sticky_seconds
+
+    # Another worker has none of this worker's marks: the cookie alone sends the writer to the primary
+    router.recent_writes.clear()
+    assert writer.get(f"/connections/{poe_id}").json() == [{"username": lenore}]
+    assert writer.get(f"/messages/{poe_id}/{lenore}").json() == []
+    assert TestClient(backend.app).get(f"/connections/{poe_id}").json() == []
+
+    # An expired or garbled cookie is ignored
+    for value in (str(time.time() - 1), "nevermore"):
+        writer.cookies.clear()
+        writer.cookies.set(READ_YOUR_WRITES_COOKIE, value)
+        assert writer.get(f"/connections/{poe_id}").json() == []
+
+def test_stickiness_expires_and_rotates_replicas(monkeypatch):
+    import database
+    from database import SessionRouter
+
+    now = [1000.0]
+    monkeypatch.setattr(database.time, "monotonic", lambda: now[0])
+    router = SessionRouter(["sqlite://", "sqlite://"], sticky_seconds=5)
+    try:
+        first, second = router.replica_sessionmakers()
+        sessions = [router.read_session() for _ in range(3)]
+        assert [session.get_bind() for session in sessions] == [first.kw["bind"], second.kw["bind"], first.kw["bind"]]
+
+        router.mark_write(7)
+        assert router.read_session(7).get_bind() is database.get_engine()
+        assert router.read_session(8).get_bind() is not database.get_engine()
+        now[0] += 5
+        assert not router.is_sticky(7)
+        assert router.read_session(7).get_bind() is not database.get_engine()
+
+        # Without replicas every read uses the primary and nothing is tracked
+        primary_only = SessionRouter([], sticky_seconds=5)
+        primary_only.mark_write(7)
+        assert primary_only.recent_writes == {}
+        assert primary_only.read_session(8).get_bind() is database.get_engine()
+    finally:
+        for session in sessions:
+            session.close()
+        router.dispose()
@@ -0,0 +1,68 @@
+"""
+Response encoding: typed response models rendered with orjson, and the
+optional Brotli/gzip compression middleware
+"""
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from compression import CompressionMiddleware, accepted_encodings
+
+def test_history_keeps_its_shape(backend):
+    client = TestClient(backend.app)
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).raise_for_status()
+    client.post("/send-message", json={"content": "nevermore", "target_username": lenore, "current_username": poe}).raise_for_status()
+
+    user_id = next(user["id"] for user in client.get("/users").json() if user["username"] == poe)
+    response = client.get(f"/messages/{user_id}/{lenore}")
+    assert response.headers["content-type"] == "application/json"
+    [message] = response.json()
+    assert set(message) == {"id", "seq", "content", "sender", "timestamp"}
+    assert (message["seq"], message["content"], message["sender"]) == (1, "nevermore", poe)
+    assert message["timestamp"][10] == "T" and not message["timestamp"].endswith("Z")
+    assert client.get(f"/connections/{user_id}").json() == [{"username": lenore}]
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br") == {"gzip", "deflate", "br"}
+    assert accepted_encodings("br;q=0, gzip;q=0.5") == {"gzip"}
+    assert accepted_encodings("") == set()
+
+def compressed_app():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=1024)
+
+    @app.get("/big")
+    async def big():
+        return [{"line": "Once upon a midnight dreary, while I pondered, weak and weary"}] * 200
+
+    @app.get("/small")
+    async def small():
+        return {"line": "Nevermore"}
+
+    return TestClient(app)
+
+def test_large_responses_are_gzipped():
+    client = compressed_app()
+    response = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert int(response.headers["content-length"]) < 1024
+    assert len(response.json()) == 200
+
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    identity = client.get("/big", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identity.headers
+    assert identity.json() == response.json()
+
+def test_brotli_preferred_when_installed():
+    pytest.importorskip("brotli")
+    client = compressed_app()
+    response = client.get("/big", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["content-encoding"] == "br"
+    assert len(response.json()) == 200
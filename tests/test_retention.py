@@ -0,0 +1,128 @@
+"""
+Retention: expired messages move to cold storage exactly once, even when
+archiving runs in two processes at once or a commit fails after the JSONL
+file was written
+"""
+import os
+import uuid
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+@pytest.fixture
+def conversation(backend):
+    """A connection holding 60 messages, one minute apart"""
+    from database import SessionLocal, Message
+
+    client = TestClient(backend.app)
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    start = datetime(2025, 10, 31, 23, 0)
+    db = SessionLocal()
+    try:
+        db.add_all([
+            Message(connection_id=connection["connection_id"], sender_id=connection["user1_id"],
+                    content=f"line {i}", timestamp=start + timedelta(minutes=i), seq=i + 1)
+            for i in range(60)
+        ])
+        db.commit()
+    finally:
+        db.close()
+    return client, connection, lenore
+
+@pytest.fixture
+def jsonl(monkeypatch):
+    import retention
+
+    monkeypatch.setattr(retention, "ARCHIVE_BACKEND", "jsonl")
+    monkeypatch.setattr(retention, "ARCHIVE_DIR", tempfile.mkdtemp(prefix="poe_archive_"))
+    monkeypatch.setattr(retention, "MESSAGE_RETENTION_DAYS", 0)
+    monkeypatch.setattr(retention, "MESSAGE_HOT_LIMIT", 10)
+    monkeypatch.setattr(retention, "ARCHIVE_BATCH_SIZE", 7)
+
+def archive(connection_id):
+    from database import SessionLocal
+    from retention import archive_connection
+
+    db = SessionLocal()
+    try:
+        return archive_connection(db, connection_id)
+    finally:
+        db.close()
+
+def archived_contents(connection_id):
+    from database import SessionLocal
+    from retention import load_archived_messages
+
+    db = SessionLocal()
+    try:
+        return [row["content"] for row in load_archived_messages(db, connection_id)]
+    finally:
+        db.close()
+
+def test_archive_keeps_the_newest_messages_hot(conversation, jsonl):
+    import retention
+
+    client, connection, lenore = conversation
+    assert archive(connection["connection_id"]) == 50
+    assert archived_contents(connection["connection_id"]) == [f"line {i}" for i in range(50)]
+    history = client.get(f"/messages/{connection['user1_id']}/{lenore}").json()
+    assert [message["content"] for message in history] == [f"line {i}" for i in range(50, 60)]
+    # Oldest archive first, as export reads them
+    names = sorted(os.listdir(os.path.join(retention.ARCHIVE_DIR, f"connection_{connection['connection_id']}")))
+    assert len(names) == 8 and names[0].startswith("2025-10-")
+
+def test_concurrent_archivers_archive_each_message_once(conversation, jsonl):
+    _, connection, _ = conversation
+    counts = []
+    barrier = threading.Barrier(2)
+
+    def archiver():
+        barrier.wait()
+        counts.append(archive(connection["connection_id"]))
+
+    threads = [threading.Thread(target=archiver) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(counts) == 50
+    assert sorted(archived_contents(connection["connection_id"]), key=lambda content: int(content.split()[1])) == [
+        f"line {i}" for i in range(50)]
+
+def test_failed_commit_leaves_no_duplicate_archive(conversation, jsonl, monkeypatch):
+    import retention
+    from database import SessionLocal
+
+    _, connection, _ = conversation
+
+    def fail():
+        raise RuntimeError("connection lost during commit")
+
+    db = SessionLocal()
+    try:
+        with monkeypatch.context() as patch:
+            patch.setattr(db, "commit", fail)
+            # Also as if the process died before it could remove the file it wrote
+            patch.setattr(retention.os, "remove", lambda path: None)
+            with pytest.raises(RuntimeError):
+                retention.archive_connection(db, connection["connection_id"])
+    finally:
+        db.close()
+
+    # The retry rewrites the same first batch instead of adding a second copy
+    assert archive(connection["connection_id"]) == 50
+    assert archived_contents(connection["connection_id"]) == [f"line {i}" for i in range(50)]
+
+def test_history_limit_must_be_positive(conversation):
+    client, connection, lenore = conversation
+    url = f"/messages/{connection['user1_id']}/{lenore}"
+    assert client.get(url, params={"limit": -1}).status_code == 422
+    assert client.get(url, params={"limit": 0}).status_code == 422
+    assert len(client.get(url, params={"limit": 1}).json()) == 1
@@ -0,0 +1,139 @@
+"""
+Websocket room authorization: joins are checked against active Connections
+once and cached, messages only go to rooms the sender joined, and
+deactivating a connection closes its room
+"""
+import uuid
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+@pytest.fixture
+def client(backend):
+    return TestClient(backend.app)
+
+@pytest.fixture
+def ws(backend, monkeypatch):
+    """websocket_server with emits recorded instead of sent"""
+    import websocket_server
+
+    emitted = []
+
+    async def fake_emit(event, data, room=None, to=None, skip_sid=None, **kwargs):
+        emitted.append((event, data, room or to))
+
+    monkeypatch.setattr(websocket_server.sio, "emit", fake_emit)
+    websocket_server.emitted = emitted
+    return websocket_server
+
+def connected_pair(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "nevermore",
+                                       "questions": ["q1", "q2", "q3"], "answers": ["a", "b", "c"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    return poe, lenore, connection["connection_id"]
+
+def test_join_is_checked_once_then_cached(client, ws, monkeypatch):
+    poe, lenore, connection_id = connected_pair(client)
+    lookups = []
+    lookup = ws.lookup_room_ids
+    monkeypatch.setattr(ws, "lookup_room_ids", lambda *args: lookups.append(args) or lookup(*args))
+
+    async def run():
+        sids = [await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/") for _ in range(3)]
+        acks = [
+            await ws.join_chat(sids[0], {"username": poe, "targetUsername": lenore}),
+            await ws.join_chat(sids[1], {"username": lenore, "targetUsername": poe}),
+            await ws.join_chat(sids[2], {"username": poe, "targetUsername": f"{poe}_stranger"}),
+        ]
+        return sids, acks
+
+    sids, acks = asyncio.run(run())
+    assert acks[0]["room"] == acks[1]["room"] == connection_id
+    assert set(acks[0]["users"]) == {poe, lenore}
+    assert acks[2] == {"error": "No connection between these users"}
+    assert len(lookups) == 2  # one for the pair, one for the stranger
+    assert ws.bindings[sids[0]] == {connection_id: poe}
+
+def test_messages_need_a_bound_room(client, ws):
+    poe, lenore, connection_id = connected_pair(client)
+    message = {"id": 1, "sender": poe, "targetUsername": lenore, "text": "Quoth the raven", "timestamp": "2025-10-31T00:00:00"}
+
+    async def run():
+        joined = await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/")
+        outsider = await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/")
+        await ws.join_chat(joined, {"username": poe, "targetUsername": lenore})
+        ws.emitted.clear()
+        await ws.message(joined, message)
+        await ws.message(outsider, message)
+        await ws.message(joined, {**message, "sender": lenore})
+        return joined, outsider
+
+    joined, outsider = asyncio.run(run())
+    room = ws.room_name(connection_id)
+    assert [(event, target) for event, _, target in ws.emitted] == [
+        ("message", room),
+        ("message_rejected", outsider),
+        ("message_rejected", joined),
+    ]
+    assert ws.emitted[1][1] == {"id": 1, "reason": "not_authorized"}
+
+def test_deactivation_closes_the_room(client, ws, backend, monkeypatch):
+    poe, lenore, connection_id = connected_pair(client)
+    revoked = []
+
+    async def hook(deactivated_id):
+        revoked.append(deactivated_id)
+
+    monkeypatch.setattr(backend, "connection_deactivated_hooks", [hook])
+    loop = asyncio.new_event_loop()
+    sid = loop.run_until_complete(ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/"))
+    loop.run_until_complete(ws.join_chat(sid, {"username": poe, "targetUsername": lenore}))
+    assert ws.in_room(sid, ws.room_name(connection_id))
+
+    path = f"/connections/{connection_id}/deactivate"
+    client.post("/register", json={"username": f"{poe}_other", "password": "p", "questions": ["q"], "answers": ["a"]})
+    assert client.post(path, params={"current_username": f"{poe}_other"}).status_code == 403
+    assert client.post(path, params={"current_username": lenore}).status_code == 200
+    assert revoked == [connection_id]
+
+    # main_advanced registers revoke_connection as the hook; run it on the loop that owns the sid
+    loop.run_until_complete(ws.revoke_connection(connection_id))
+    assert not ws.in_room(sid, ws.room_name(connection_id))
+    assert ("chat_closed", {"room": connection_id}, ws.room_name(connection_id)) in ws.emitted
+    ack = loop.run_until_complete(ws.join_chat(sid, {"username": poe, "targetUsername": lenore}))
+    assert ack == {"error": "No connection between these users"}
+    loop.close()
+
+    poe_id = next(user["id"] for user in client.get("/users").json() if user["username"] == poe)
+    assert client.get(f"/connections/{poe_id}").json() == []
+    sent = client.post("/send-message", json={"content": "boo", "target_username": lenore, "current_username": poe})
+    assert sent.status_code == 404
+
+    # Answering the questions again reactivates it
+    attempt = client.post("/attempt-connection", json={"target_username": lenore, "current_username": poe,
+                                                       "answers": ["a", "b", "c"]})
+    assert attempt.json()["success"]
+    assert client.get(f"/connections/{poe_id}").json() == [{"username": lenore}]
+
+def test_leave_only_affects_the_senders_own_rooms(client, ws):
+    poe, lenore, connection_id = connected_pair(client)
+
+    async def run():
+        raven = await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/")
+        outsider = await ws.sio.manager.connect(f"eio_{uuid.uuid4().hex}", "/")
+        await ws.join_chat(raven, {"username": poe, "targetUsername": lenore})
+        ws.emitted.clear()
+        await ws.leave_chat(outsider, {"username": poe})
+        forged = list(ws.emitted)
+        await ws.leave_chat(raven, {"username": poe})
+        return raven, forged
+
+    raven, forged = asyncio.run(run())
+    room = ws.room_name(connection_id)
+    assert forged == []
+    assert [(event, data["username"], target) for event, data, target in ws.emitted] == [("user_left", poe, room)]
+    assert ws.bindings[raven] == {} and not ws.in_room(raven, room)
@@ -0,0 +1,122 @@
+"""
+Message search: escaped snippets on every backend, owner-only access, and
+an in-memory index that forgets archived messages
+"""
+import os
+import sys
+import uuid
+import subprocess
+
+import pytest
+from fastapi.testclient import TestClient
+
+import search
+from auth import issue_token
+
+@pytest.fixture
+def client(backend):
+    return TestClient(backend.app)
+
+def connected_pair(client):
+    prefix = uuid.uuid4().hex[:6]
+    poe, lenore = f"{prefix}_poe", f"{prefix}_lenore"
+    for username in (poe, lenore):
+        client.post("/register", json={"username": username, "password": "p", "questions": ["q"], "answers": ["a"]}).raise_for_status()
+    connection = client.post("/create-connection", params={"user1_username": poe, "user2_username": lenore}).json()
+    return poe, lenore, connection
+
+def empty_index():
+    """A memory index that only tracks messages written from now on (loading every test's messages is slow)"""
+    index = search.InvertedIndex()
+    index.loaded = True
+    return index
+
+def send(client, sender, target, content):
+    client.post("/send-message", json={"content": content, "target_username": target, "current_username": sender}).raise_for_status()
+
+@pytest.mark.parametrize("backend_name", ["fts5", "memory"])
+def test_snippets_escape_message_html(client, monkeypatch, backend_name):
+    search.setup_search_index()
+    if backend_name == "fts5" and search._backend != "fts5":
+        pytest.skip("SQLite was built without FTS5")
+    monkeypatch.setattr(search, "_backend", backend_name)
+    monkeypatch.setattr(search, "memory_index", empty_index())
+
+    poe, lenore, connection = connected_pair(client)
+    send(client, poe, lenore, "<img src=x onerror=alert(1)> the raven & the bust")
+    send(client, lenore, poe, "no birds here")
+    body = client.get(f"/search/{connection['user1_id']}", params={"q": "raven"}).json()
+    assert body["total"] == 1
+    snippet = body["results"][0]["snippet"]
+    assert "<img" not in snippet and "&lt;img" in snippet and "&amp;" in snippet
+    assert "<mark>raven</mark>" in snippet
+
+def test_search_is_limited_to_the_token_holder(client):
+    poe, lenore, connection = connected_pair(client)
+    send(client, poe, lenore, "nevermore")
+    url = f"/search/{connection['user1_id']}"
+    own = {"Authorization": f"Bearer {issue_token(connection['user1_id'], poe)}"}
+    other = {"Authorization": f"Bearer {issue_token(connection['user2_id'], lenore)}"}
+    assert client.get(url, params={"q": "nevermore"}, headers=own).json()["total"] == 1
+    assert client.get(url, params={"q": "nevermore"}, headers=other).status_code == 403
+
+def test_memory_index_forgets_archived_messages(client, monkeypatch):
+    import retention
+    from database import SessionLocal
+
+    monkeypatch.setattr(search, "_backend", "memory")
+    monkeypatch.setattr(search, "memory_index", empty_index())
+    monkeypatch.setattr(retention, "ARCHIVE_BACKEND", "table")
+    monkeypatch.setattr(retention, "MESSAGE_HOT_LIMIT", 1)
+
+    poe, lenore, connection = connected_pair(client)
+    url = f"/search/{connection['user1_id']}"
+    send(client, poe, lenore, "quoth the raven")
+    assert client.get(url, params={"q": "quoth"}).json()["total"] == 1
+    send(client, poe, lenore, "quoth the raven again")
+    found = client.get(url, params={"q": "quoth"}).json()
+    assert found["total"] == 2
+    oldest = found["results"][-1]["id"]
+
+    db = SessionLocal()
+    try:
+        assert retention.archive_connection(db, connection["connection_id"]) == 1
+    finally:
+        db.close()
+    assert client.get(url, params={"q": "quoth"}).json()["total"] == 1
+    assert not any(oldest in search.memory_index.postings.get(token, {}) for token in ("quoth", "the", "raven"))
+
+SEARCH_AFTER_SETUP = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+os.environ["DATABASE_URL"] = sys.argv[2]
+import database, retention, search
+from database import SessionLocal, User, Connection
+from message_log import store_message
+
+database.create_tables()
+# Either order leaves a working index: search first (as setup_database used to), then partitioning
+search.setup_search_index()
+assert retention.partition_messages_table()
+db = SessionLocal()
+try:
+    users = [User(username=f"{sys.argv[3]}_{name}", password_hash="", questions="[]", answers="[]") for name in ("poe", "lenore")]
+    db.add_all(users)
+    db.flush()
+    connection = Connection(user1_id=users[0].id, user2_id=users[1].id)
+    db.add(connection)
+    db.commit()
+    store_message(db, connection.id, users[0].id, "Quoth the raven, nevermore", None)
+    found = search.search_messages(db, users[0].id, "raven")
+    assert found["total"] == 1, found
+    assert "<mark>raven</mark>" in found["results"][0]["snippet"].lower(), found
+finally:
+    db.close()
+"""
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_URL"), reason="set TEST_POSTGRES_URL to a scratch PostgreSQL database")
+def test_postgres_search_finds_messages_sent_after_partitioning():
+    backend_dir = os.path.dirname(sys.modules["search"].__file__)
+    result = subprocess.run([sys.executable, "-c", SEARCH_AFTER_SETUP, backend_dir, os.environ["TEST_POSTGRES_URL"],
+                             uuid.uuid4().hex[:6]], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr